@@ -0,0 +1,203 @@
+import asyncio
+import time
+from threading import Thread, Event
+import logging
+
+from amusementpark.codec import CodecError, create_codec, encode_preamble, decode_preamble
+from amusementpark.network import Network, Peer, INT_BYTE_LENGTH, MAX_FRAME_SIZE
+
+log = logging.getLogger('amusementpark.async_network')
+
+class AsyncNetwork(Network):
+    """
+    AsyncNetwork serves all incoming and outgoing connections of a node from a single asyncio event loop.
+    It has the same contract with the broker as the threaded Network class.
+    """
+
+    def __init__(self, port, broker, *args, **kwargs):
+        super().__init__(port, broker, *args, **kwargs)
+        self.loop = None
+        self.started = Event()
+
+    def run(self, daemon=False):
+        thread = Thread(target=self.run_loop, daemon=daemon)
+        thread.start()
+        self.started.wait() # return once the server is accepting connections
+
+        Thread(target=self.send_messages, daemon=daemon).start()
+
+        return thread
+
+    def run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        # without a port the network only connects to other nodes and receives replies on those connections
+        if self.port is not None:
+            self.loop.run_until_complete(self.start_server())
+
+        self.started.set()
+        self.loop.run_forever()
+
+    async def start_server(self):
+        await asyncio.start_server(self.receive_messages, '0.0.0.0', self.port, backlog=1024)
+
+        log.debug('Network %s start server' % self.port)
+
+    async def receive_messages(self, reader, writer):
+        _, port = writer.get_extra_info('peername')[:2]
+        log.debug('Network %s receive connection from %d' % (self.port, port))
+
+        senders = set() # nodes which can be answered through this connection
+
+        try:
+            codec = decode_preamble(await receive_data(reader), self.allow_pickle)
+
+            while True:
+                data = await receive_data(reader)
+                message = codec.decode(data)
+
+                log.debug('Network %s received message from %d: %s' % (self.port, port, message))
+
+                if message.sender not in senders:
+                    senders.add(message.sender)
+                    self.add_channel(message.sender, writer)
+
+                self.broker.add_incoming_message(message)
+        except asyncio.IncompleteReadError: # the other side closed the connection
+            log.debug('Network %s connection from %d closed' % (self.port, port))
+        except CodecError as error:
+            log.warning('Network %s refuse connection from %d: %s' % (self.port, port, error))
+        except OSError as error:
+            log.debug('Network %s connection from %d failed: %s' % (self.port, port, error))
+        finally:
+            writer.close()
+
+    def send_messages(self):
+        # the broker queue is blocking, so it is read outside of the event loop
+        while True:
+            messages = self.broker.get_outgoing_messages()
+            self.loop.call_soon_threadsafe(self.add_outgoing_messages, messages)
+            self.broker.finish_outgoing_message(len(messages))
+
+    def create_peer(self, node):
+        return AsyncPeer(self, node)
+
+class AsyncPeer(Peer):
+    """
+    AsyncPeer is a Peer which sends its messages from a task in the event loop of the network.
+    """
+
+    def __init__(self, network, node):
+        super().__init__(network, node)
+        self.writer = None
+        self.has_messages = asyncio.Event()
+
+    def run(self):
+        self.network.loop.create_task(self.send_messages())
+
+    def add_message(self, message):
+        self.messages.append((time.monotonic() + self.network.message_lifetime, message))
+        self.has_messages.set()
+
+    def evict(self):
+        self.evicted = True
+        self.has_messages.set()
+
+    async def send_messages(self):
+        while True:
+            if not self.messages:
+                if self.evicted:
+                    self.evicted = False
+                    self.disconnect()
+
+                self.has_messages.clear()
+
+                try:
+                    await asyncio.wait_for(self.has_messages.wait(), timeout=self.network.idle_timeout)
+                except asyncio.TimeoutError:
+                    if self.network.remove_peer(self):
+                        self.disconnect()
+                        return
+
+                continue
+
+            messages = self.take_batch()
+
+            if not messages:
+                continue
+
+            try:
+                if self.writer is None:
+                    await self.connect()
+
+                buffers, failed_count = self.encode_batch(messages)
+                self.writer.writelines(buffers)
+                self.write_count += 1
+                await asyncio.wait_for(self.writer.drain(), timeout=self.network.connect_timeout)
+            except (OSError, asyncio.TimeoutError) as error:
+                # keep the messages and try again with a new connection until they expire
+                log.warning('Network %s cannot send to %d: %s' % (self.network.port, self.node.id, error))
+                self.disconnect()
+                self.failure_count += 1
+                await asyncio.sleep(self.get_retry_delay())
+                continue
+
+            self.failure_count = 0
+            self.network.use_connection(self)
+            self.finish_batch(messages, failed_count)
+
+            if failed_count:
+                # the codec state cannot be trusted after a failure, the next message starts a new connection
+                self.disconnect()
+
+    async def connect(self):
+        writer = self.channel
+        self.channel = None
+
+        if writer is not None:
+            # answer on the connection opened by the node
+            log.debug('Network %s reply to %d on its connection' % (self.network.port, self.node.id))
+        elif self.node.address is not None:
+            host, port = self.node.address
+            connection = asyncio.open_connection(host, port)
+            reader, writer = await asyncio.wait_for(connection, timeout=self.network.connect_timeout)
+
+            # the node can answer on this connection as well
+            self.network.loop.create_task(self.network.receive_messages(reader, writer))
+
+            log.debug('Network %s connect to %d' % (self.network.port, self.node.id))
+        else:
+            raise ConnectionError('Node does not accept connections')
+
+        # tell the other side which codec will be used on this connection
+        await send_data(writer, encode_preamble(self.network.codec_id))
+
+        self.writer = writer
+        self.codec = create_codec(self.network.codec_id)
+
+        self.network.add_connection(self)
+        self.connect_count += 1
+
+    def disconnect(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.codec = None
+
+            self.network.remove_connection(self)
+
+async def send_data(writer, data_buffer):
+    # first send the size of the data as a 4-byte integer, then send the data
+    size_buffer = len(data_buffer).to_bytes(INT_BYTE_LENGTH, byteorder='big')
+    writer.write(size_buffer + data_buffer)
+    await writer.drain()
+
+async def receive_data(reader):
+    size_buffer = await reader.readexactly(INT_BYTE_LENGTH)
+    size = int.from_bytes(size_buffer, byteorder='big')
+
+    if size > MAX_FRAME_SIZE:
+        raise CodecError('Frame of %d bytes is too large' % size)
+
+    return await reader.readexactly(size)
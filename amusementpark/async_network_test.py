@@ -0,0 +1,73 @@
+import pytest
+from unittest.mock import Mock
+from amusementpark.async_network import AsyncNetwork
+from amusementpark.broker import Broker
+from amusementpark.codec import CODEC_BINARY, CODEC_PICKLE
+from amusementpark.messages import NetworkMessage
+from amusementpark.node_info import NodeInfo
+from amusementpark.network_test import create_receivers
+from helpers import get_free_port, wait_until
+
+@pytest.mark.parametrize('codec_id', [CODEC_BINARY, CODEC_PICKLE])
+def test_send_and_receive(codec_id):
+    sender_port = get_free_port()
+    receiver_port = get_free_port()
+
+    # brokers are not started, so received messages stay in the incoming queue
+    sender_broker = Broker(Mock())
+    receiver_broker = Broker(Mock())
+
+    AsyncNetwork(receiver_port, receiver_broker, allow_pickle=True).run(daemon=True)
+    AsyncNetwork(sender_port, sender_broker, codec_id).run(daemon=True)
+
+    sender = NodeInfo(100, ('localhost', sender_port), 4)
+    receiver = NodeInfo(200, ('localhost', receiver_port), 8)
+    messages = [NetworkMessage('hello', sender, receiver, number=i) for i in range(10)]
+
+    for message in messages:
+        sender_broker.outgoing_messages.put(message)
+    
+    assert [receiver_broker.incoming_messages.get(timeout=5) for _ in messages] == messages
+
+def test_unreachable_peer_does_not_block_others():
+    sender_port = get_free_port()
+    receiver_port = get_free_port()
+    unreachable_port = get_free_port() # nobody listens on this port
+
+    sender_broker = Broker(Mock())
+    receiver_broker = Broker(Mock())
+
+    AsyncNetwork(receiver_port, receiver_broker).run(daemon=True)
+    sender_network = AsyncNetwork(sender_port, sender_broker, message_lifetime=0.2)
+    sender_network.run(daemon=True)
+
+    sender = NodeInfo(100, ('localhost', sender_port), 4)
+    receiver = NodeInfo(200, ('localhost', receiver_port), 8)
+    unreachable = NodeInfo(300, ('localhost', unreachable_port), 3)
+
+    sender_broker.outgoing_messages.put(NetworkMessage('hello', sender, unreachable))
+    sender_broker.outgoing_messages.put(NetworkMessage('hello', sender, receiver))
+
+    assert receiver_broker.incoming_messages.get(timeout=5) == NetworkMessage('hello', sender, receiver)
+
+    wait_until(lambda: sender_network.get_stats()[300]['dropped'] == 1)
+
+    assert sender_network.get_stats() == {
+        200: {'queued': 0, 'sent': 1, 'dropped': 0, 'writes': 1},
+        300: {'queued': 0, 'sent': 0, 'dropped': 1, 'writes': 0},
+    }
+
+def test_reply_on_incoming_connection():
+    [(gate, gate_broker)] = create_receivers(1, AsyncNetwork)
+    visitor = NodeInfo(2000, None, 1)
+
+    # the visitor has no server, so the gate has to answer on the connection opened by the visitor
+    visitor_broker = Broker(Mock())
+    AsyncNetwork(None, visitor_broker).run(daemon=True)
+
+    visitor_broker.outgoing_messages.put(NetworkMessage('enter_request', visitor, gate))
+    assert gate_broker.incoming_messages.get(timeout=5) == NetworkMessage('enter_request', visitor, gate)
+
+    gate_broker.outgoing_messages.put(NetworkMessage('enter_response', gate, visitor, allowed=True))
+    assert visitor_broker.incoming_messages.get(timeout=5) == \
+        NetworkMessage('enter_response', gate, visitor, allowed=True)
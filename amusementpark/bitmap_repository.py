@@ -0,0 +1,153 @@
+import os
+import mmap
+import struct
+
+from amusementpark.visitor_repository import State
+
+MAGIC = b'PARKBMP1'
+
+# magic, capacity, number of visitors, number of visitor ids in the bitmap
+HEADER = struct.Struct('<8sQQQ')
+COUNT_OFFSET = 16
+
+# the bitmap is scanned in chunks, so that empty parts of it are skipped quickly
+SCAN_CHUNK_SIZE = 4096
+EMPTY_CHUNK = bytes(SCAN_CHUNK_SIZE)
+
+class BitmapState(State):
+    """
+    BitmapState is a park state which changes a memory-mapped bitmap in place, with one bit for every
+    visitor id. The number of visitors is kept in the header of the bitmap.
+    """
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+        _, self.capacity, _, self.id_limit = HEADER.unpack_from(mapping)
+        self.changes = [] # visitors whose bit was flipped since the state was last written
+
+    @property
+    def visitors(self):
+        # the visitors are ordered by their id and not by the order in which they entered
+        visitors = []
+
+        for offset in range(HEADER.size, len(self.mapping), SCAN_CHUNK_SIZE):
+            chunk = self.mapping[offset:offset + SCAN_CHUNK_SIZE]
+
+            if chunk == EMPTY_CHUNK[:len(chunk)]:
+                continue
+
+            bits = int.from_bytes(chunk, 'little')
+            first_id = (offset - HEADER.size) * 8
+
+            while bits:
+                bit = bits & -bits
+                visitors.append(first_id + bit.bit_length() - 1)
+                bits ^= bit
+
+        return visitors
+
+    @property
+    def count(self):
+        count, = struct.unpack_from('<Q', self.mapping, COUNT_OFFSET)
+        return count
+
+    def set_count(self, count):
+        struct.pack_into('<Q', self.mapping, COUNT_OFFSET, count)
+
+    def enter(self, visitor):
+        assert visitor not in self
+        assert self.count < self.capacity
+        self.flip(visitor)
+        self.set_count(self.count + 1)
+        self.changes.append(visitor)
+
+    def leave(self, visitor):
+        assert visitor in self
+        self.flip(visitor)
+        self.set_count(self.count - 1)
+        self.changes.append(visitor)
+
+    def rollback(self):
+        # undo the changes which were not written, newest first
+        for visitor in reversed(self.changes):
+            self.set_count(self.count + (-1 if visitor in self else 1))
+            self.flip(visitor)
+
+        self.changes = []
+
+    def flip(self, visitor):
+        self.mapping[HEADER.size + (visitor >> 3)] ^= 1 << (visitor & 7)
+
+    def __contains__(self, visitor):
+        assert 0 <= visitor < self.id_limit
+        return bool(self.mapping[HEADER.size + (visitor >> 3)] & (1 << (visitor & 7)))
+
+class BitmapRepository:
+    """
+    BitmapRepository keeps the park state in a memory-mapped file with one bit for every visitor id, so it
+    is suited for dense integer visitor ids.
+
+    Reading the state maps the file without parsing it, entering and leaving flips bits in the mapped file
+    and writing the state flushes the changed pages to disk. The file holds id_limit visitor ids and is
+    created when a state is written to the repository for the first time.
+    """
+
+    def __init__(self, filename, id_limit=2 ** 26):
+        self.filename = str(filename)
+        self.id_limit = id_limit
+        self.state = None
+
+    def read_state(self):
+        if self.state is not None:
+            self.state.rollback()
+            return self.state
+
+        try:
+            file = open(self.filename, 'r+b')
+        except FileNotFoundError:
+            return None
+
+        with file:
+            mapping = mmap.mmap(file.fileno(), 0)
+
+        if mapping[:len(MAGIC)] != MAGIC:
+            mapping.close()
+            raise ValueError('%s is not a bitmap repository' % self.filename)
+
+        self.state = BitmapState(mapping)
+        return self.state
+
+    def write_state(self, state):
+        if state is self.state:
+            self.state.mapping.flush()
+            self.state.changes = []
+            return
+
+        # the state does not come from this repository, so a new bitmap is written and replaces the old one
+        self.close()
+
+        visitors = state.visitors
+        id_limit = max([self.id_limit] + [visitor + 1 for visitor in visitors])
+        bitmap = bytearray(-(-id_limit // SCAN_CHUNK_SIZE // 8) * SCAN_CHUNK_SIZE)
+
+        for visitor in visitors:
+            bitmap[visitor >> 3] |= 1 << (visitor & 7)
+
+        temporary_filename = self.filename + '.tmp'
+
+        with open(temporary_filename, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, state.capacity, len(visitors), id_limit))
+            file.write(bitmap)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(temporary_filename, self.filename)
+
+    def delete_state(self):
+        self.close()
+        os.remove(self.filename)
+
+    def close(self):
+        if self.state is not None:
+            self.state.mapping.close()
+            self.state = None
@@ -0,0 +1,55 @@
+import pytest
+from amusementpark.bitmap_repository import BitmapRepository
+from amusementpark.visitor_repository import State
+
+def test_read_write_delete(tmpdir):
+    repository = BitmapRepository(tmpdir.join('repository.bitmap'), id_limit=1000)
+
+    assert repository.read_state() is None
+
+    repository.write_state(State(capacity=10, visitors=[3, 1, 2]))
+    assert repository.read_state() == State(capacity=10, visitors=[1, 2, 3])
+
+    repository.delete_state()
+    assert repository.read_state() is None
+
+def test_enter_and_leave(tmpdir):
+    filename = tmpdir.join('repository.bitmap')
+    repository = BitmapRepository(filename, id_limit=100000)
+    repository.write_state(State(capacity=2, visitors=[100]))
+
+    state = repository.read_state()
+
+    with pytest.raises(AssertionError):
+        state.enter(100)
+
+    state.enter(99999)
+
+    with pytest.raises(AssertionError):
+        state.enter(300)
+
+    with pytest.raises(AssertionError):
+        state.leave(300)
+
+    state.leave(100)
+    repository.write_state(state)
+
+    state = BitmapRepository(filename).read_state()
+    assert state == State(capacity=2, visitors=[99999])
+    assert state.count == 1
+
+    with pytest.raises(AssertionError):
+        state.enter(100000) # outside of the bitmap
+
+def test_unwritten_changes_are_discarded(tmpdir):
+    repository = BitmapRepository(tmpdir.join('repository.bitmap'), id_limit=1000)
+    repository.write_state(State(capacity=10, visitors=[1]))
+
+    state = repository.read_state()
+    state.enter(2)
+    state.leave(1)
+    state.enter(1)
+
+    state = repository.read_state()
+    assert state == State(capacity=10, visitors=[1])
+    assert state.count == 1
@@ -1,55 +1,133 @@
-from queue import Queue
 from threading import Thread
 from collections import defaultdict
+from queue import Empty
+import time
 import logging
 
 from amusementpark.messages import NetworkMessage, LocalMessage
+from amusementpark.message_queue import MessageQueue
 
 log = logging.getLogger('amusementpark.broker')
 
+# lanes of the prioritized incoming queue, protocol messages overtake requests from visitors
+CONTROL_LANE = 0
+VISITOR_LANE = 1
+
+VISITOR_MESSAGE_TYPES = {'enter_request', 'leave_request'}
+
+# passed to the node regularly when the broker has a tick interval
+TICK_MESSAGE = LocalMessage('tick')
+
+def classify_message(message):
+    return VISITOR_LANE if message.type in VISITOR_MESSAGE_TYPES else CONTROL_LANE
+
 class Broker:
     """
     Broker routes incoming messages to a node and collects produced outgoing messages.
+
+    The broker takes up to batch_size waiting incoming messages at once and passes the outgoing messages
+    produced for the whole batch to the outgoing queue together. Messages are still processed in the order
+    they were added.
+
+    A prioritized broker keeps control messages and visitor requests in separate lanes and processes control
+    messages first. Visitor requests are still processed regularly, so they cannot starve.
+
+    With tick_interval set, the broker passes a local tick message to the node every tick_interval seconds,
+    so that the node can handle timeouts.
+
+    With a heartbeat set, every incoming network message is reported to it as a sign of life of the sender,
+    and heartbeat messages are dropped instead of being passed to the node.
     """
 
-    def __init__(self, node):
+    def __init__(self, node, batch_size=1, prioritized=False, tick_interval=None):
         self.node = node
-        self.incoming_messages = Queue()
-        self.outgoing_messages = Queue()
+        self.batch_size = batch_size
+        self.tick_interval = tick_interval
+        self.heartbeat = None
+
+        if prioritized:
+            self.incoming_messages = MessageQueue(lanes=('control', 'visitor'), classify=classify_message)
+        else:
+            self.incoming_messages = MessageQueue()
+
+        self.outgoing_messages = MessageQueue()
     
-    def run(self):
-        thread = Thread(target=self.process_messages)
+    def run(self, daemon=False):
+        thread = Thread(target=self.process_messages, daemon=daemon)
         thread.start()
         return thread
     
     def process_messages(self):
+        next_tick = time.monotonic() + self.tick_interval if self.tick_interval is not None else None
+
         while True:
-            incoming_message = self.incoming_messages.get()
-            
-            self.log_incoming_message(incoming_message)
-            
-            for outgoing_message in self.node.process_message(incoming_message):
-                # if outgoing message is None it means the node will not send any more messages
-                if outgoing_message is not None:
-                    self.log_outgoing_message(outgoing_message)
-                    self.outgoing_messages.put(outgoing_message)
-                else:
-                    self.log_end()
-                    return
+            incoming_messages = self.get_incoming_messages(next_tick)
+            outgoing_messages = []
+
+            if next_tick is not None and time.monotonic() >= next_tick:
+                incoming_messages.append(TICK_MESSAGE)
+                next_tick = time.monotonic() + self.tick_interval
+
+            for incoming_message in incoming_messages:
+                self.log_incoming_message(incoming_message)
+
+                for outgoing_message in self.node.process_message(incoming_message):
+                    # if outgoing message is None it means the node will not send any more messages
+                    if outgoing_message is not None:
+                        self.log_outgoing_message(outgoing_message)
+                        outgoing_messages.append(outgoing_message)
+                    else:
+                        self.outgoing_messages.put_many(outgoing_messages)
+                        self.log_end()
+                        return
+
+            self.outgoing_messages.put_many(outgoing_messages)
+    
+    def get_incoming_messages(self, next_tick):
+        if next_tick is None:
+            return self.incoming_messages.get_batch(self.batch_size)
+
+        try:
+            return self.incoming_messages.get_batch(self.batch_size, timeout=max(next_tick - time.monotonic(), 0))
+        except Empty:
+            return []
     
     def add_incoming_message(self, message):
+        if self.heartbeat is not None and isinstance(message, NetworkMessage):
+            self.heartbeat.receive(message.sender)
+
+            if message.type == 'heartbeat':
+                return
+
         # add the message to the incoming message queue
         self.incoming_messages.put(message)
+
+    def add_outgoing_message(self, message):
+        # send a message which was not produced by the node
+        self.outgoing_messages.put(message)
     
     def get_outgoing_message(self, block=True):
         # pop the first message from the outgoing message queue
         return self.outgoing_messages.get(block=block)
+
+    def get_outgoing_messages(self, block=True):
+        # pop all messages from the outgoing message queue
+        return self.outgoing_messages.get_batch(block=block)
     
-    def finish_outgoing_message(self):
-        # mark an outgoing message as processed
-        self.outgoing_messages.task_done()
+    def finish_outgoing_message(self, count=1):
+        # mark outgoing messages as processed
+        self.outgoing_messages.task_done(count)
+
+    def get_stats(self):
+        return {
+            'incoming': self.incoming_messages.get_stats(),
+            'outgoing': self.outgoing_messages.get_stats(),
+        }
     
     def log_incoming_message(self, message):
+        if message is TICK_MESSAGE: # ticks would flood the log
+            return
+
         if isinstance(message, LocalMessage):
             log.info('Node %s receive local message: %s', self.node, message)
         elif isinstance(message, NetworkMessage):
@@ -37,3 +37,65 @@ def test_passing_messages():
     assert broker.get_outgoing_message(block=False) == out_message_1
     assert broker.get_outgoing_message(block=False) == out_message_2
     assert broker.get_outgoing_message(block=False) == out_message_3
+
+def test_batched_processing():
+    in_messages = [Mock(LocalMessage) for _ in range(5)]
+    out_messages = [Mock() for _ in range(5)]
+
+    node = Mock()
+    node.process_message.side_effect = [[out_message] for out_message in out_messages[:4]] + [[out_messages[4], None]]
+
+    broker = Broker(node, batch_size=3)
+
+    for in_message in in_messages:
+        broker.add_incoming_message(in_message)
+
+    thread = broker.run()
+    thread.join()
+
+    assert [call[0][0] for call in node.process_message.call_args_list] == in_messages
+    assert broker.get_outgoing_messages(block=False) == out_messages
+
+    stats = broker.get_stats()
+    assert stats['incoming']['batches'] == 2
+    assert stats['incoming']['max_batch_size'] == 3
+    assert stats['outgoing']['depth'] == 0
+
+def test_prioritized_processing():
+    visitor_message = LocalMessage('enter_request')
+    control_message = LocalMessage('mutex_granted')
+
+    node = Mock()
+    node.process_message.side_effect = [[], [None]]
+
+    broker = Broker(node, prioritized=True)
+    broker.add_incoming_message(visitor_message)
+    broker.add_incoming_message(control_message)
+
+    thread = broker.run()
+    thread.join()
+
+    assert [call[0][0] for call in node.process_message.call_args_list] == [control_message, visitor_message]
+    assert broker.get_stats()['incoming']['lanes']['visitor']['messages'] == 1
+
+def test_ticks():
+    node = Mock()
+    node.process_message.side_effect = [[], [None]]
+
+    broker = Broker(node, tick_interval=0.01)
+
+    thread = broker.run()
+    thread.join(timeout=5)
+
+    assert [call[0][0] for call in node.process_message.call_args_list] == [LocalMessage('tick')] * 2
+
+def test_heartbeat():
+    broker = Broker(Mock())
+    broker.heartbeat = Mock()
+
+    broker.add_incoming_message(NetworkMessage('heartbeat', nodes[0], nodes[1]))
+    broker.add_incoming_message(NetworkMessage('hello', nodes[2], nodes[1]))
+
+    # heartbeats are not passed to the node, but every message is a sign of life
+    assert broker.incoming_messages.get_batch(block=False) == [NetworkMessage('hello', nodes[2], nodes[1])]
+    assert [call.args for call in broker.heartbeat.receive.call_args_list] == [(nodes[0],), (nodes[2],)]
@@ -0,0 +1,365 @@
+import pickle
+import struct
+
+from amusementpark.messages import NetworkMessage
+from amusementpark.node_info import NodeInfo
+
+# codec identifiers, the first frame sent on every connection selects the codec used for the rest of it
+CODEC_PICKLE = 0
+CODEC_BINARY = 1
+
+BINARY_VERSION = 3
+
+# message types are encoded as their index in this list, new types must be appended to keep the tags stable
+MESSAGE_TYPES = [
+    None, # tag 0 means the type name follows as a string
+    'hello',
+    'hey',
+    'election_started',
+    'election_voted',
+    'election_finished',
+    'mutex_requested',
+    'mutex_granted',
+    'mutex_released',
+    'enter_request',
+    'leave_request',
+    'enter_response',
+    'leave_response',
+    'leader_removed',
+    'terminated',
+    'admission_requested',
+    'admission_answered',
+    'escrow_revoked',
+    'escrow_returned',
+    'heartbeat',
+    'mutex_renewed',
+]
+
+MESSAGE_TAGS = {message_type: tag for tag, message_type in enumerate(MESSAGE_TYPES) if message_type is not None}
+
+# payload fields that are encoded by position instead of by name, other fields are encoded with their names
+MESSAGE_FIELDS = {
+    'election_started': ('election',),
+    'election_voted': ('leader', 'election'),
+    'election_finished': ('leader', 'election'),
+    'enter_response': ('allowed',),
+    'leave_response': ('allowed',),
+    'admission_requested': ('batch', 'entering', 'leaving'),
+    'admission_answered': ('batch', 'entered', 'left'),
+    'escrow_returned': ('slots', 'admitted'),
+}
+
+# value tags
+VALUE_NONE = 0
+VALUE_FALSE = 1
+VALUE_TRUE = 2
+VALUE_INT = 3
+VALUE_FLOAT = 4
+VALUE_STR = 5
+VALUE_BYTES = 6
+VALUE_TUPLE = 7
+VALUE_LIST = 8
+VALUE_DICT = 9
+VALUE_NODE = 10 # node info encoded in full
+VALUE_NODE_DEFINE = 11 # node info encoded in full and added to the node table
+VALUE_NODE_REF = 12 # index into the node table
+
+# maximum number of node infos remembered per connection
+NODE_TABLE_SIZE = 4096
+
+FLOAT_STRUCT = struct.Struct('>d')
+
+class CodecError(Exception):
+    pass
+
+class PickleCodec:
+    codec_id = CODEC_PICKLE
+
+    def encode(self, message):
+        assert isinstance(message, NetworkMessage)
+        return pickle.dumps(message)
+
+    def decode(self, data):
+        try:
+            return pickle.loads(data)
+        except Exception as error:
+            raise CodecError('Malformed message: %s' % error)
+
+class BinaryCodec:
+    """
+    BinaryCodec encodes network messages using a fixed schema.
+
+    Message types are sent as integer tags and known payload fields by position. Node infos are sent in full
+    the first time and then only as an index into a table kept on both ends of the connection, so a codec
+    instance must be used for a single connection only. With node_table_size=0 the codec is stateless.
+
+    Nodes are only added to the table once the whole message was encoded, so a message which cannot be
+    encoded leaves the table as it was. Malformed data, including nodes which are not hashable and more
+    nodes than fit into the table, raises CodecError when decoded.
+    """
+
+    codec_id = CODEC_BINARY
+
+    def __init__(self, node_table_size=NODE_TABLE_SIZE):
+        self.node_table_size = node_table_size
+        self.encoded_nodes = {}
+        self.new_nodes = {} # nodes defined by the message being encoded
+        self.decoded_nodes = []
+
+    def encode(self, message):
+        assert isinstance(message, NetworkMessage)
+
+        self.new_nodes = {}
+        buffer = bytearray()
+        buffer.append(BINARY_VERSION)
+
+        tag = MESSAGE_TAGS.get(message.type, 0)
+        write_uint(buffer, tag)
+
+        if tag == 0:
+            self.write_value(buffer, message.type)
+
+        self.write_value(buffer, message.sender)
+        self.write_value(buffer, message.recipient)
+
+        fields = MESSAGE_FIELDS.get(message.type, ())
+
+        for field in fields:
+            self.write_value(buffer, message.payload.get(field))
+
+        extra_fields = [key for key in message.payload if key not in fields]
+        write_uint(buffer, len(extra_fields))
+
+        for key in extra_fields:
+            self.write_value(buffer, key)
+            self.write_value(buffer, message.payload[key])
+
+        self.encoded_nodes.update(self.new_nodes)
+        return bytes(buffer)
+
+    def decode(self, data):
+        try:
+            message, offset = self.read_message(data)
+        except (IndexError, ValueError, TypeError, RecursionError, struct.error) as error:
+            raise CodecError('Malformed message: %s' % error)
+
+        if offset != len(data):
+            raise CodecError('Unexpected data after message')
+
+        return message
+
+    def read_message(self, data):
+        if data[0] != BINARY_VERSION:
+            raise CodecError('Unsupported version %d' % data[0])
+
+        tag, offset = read_uint(data, 1)
+
+        if tag == 0:
+            message_type, offset = self.read_value(data, offset)
+        elif tag < len(MESSAGE_TYPES):
+            message_type = MESSAGE_TYPES[tag]
+        else:
+            raise CodecError('Unknown message tag %d' % tag)
+
+        sender, offset = self.read_value(data, offset)
+        recipient, offset = self.read_value(data, offset)
+
+        if not isinstance(sender, NodeInfo) or not isinstance(recipient, NodeInfo):
+            raise CodecError('Sender and recipient have to be nodes')
+
+        payload = {}
+
+        for field in MESSAGE_FIELDS.get(message_type, ()):
+            payload[field], offset = self.read_value(data, offset)
+
+        extra_count, offset = read_uint(data, offset)
+
+        for _ in range(extra_count):
+            key, offset = self.read_value(data, offset)
+            payload[key], offset = self.read_value(data, offset)
+
+        return NetworkMessage(message_type, sender, recipient, **payload), offset
+
+    def write_value(self, buffer, value):
+        # bool and NodeInfo have to be checked before int and tuple
+        if value is None:
+            buffer.append(VALUE_NONE)
+        elif value is True:
+            buffer.append(VALUE_TRUE)
+        elif value is False:
+            buffer.append(VALUE_FALSE)
+        elif isinstance(value, NodeInfo):
+            self.write_node(buffer, value)
+        elif isinstance(value, int):
+            buffer.append(VALUE_INT)
+            write_uint(buffer, value << 1 if value >= 0 else (-value << 1) - 1)
+        elif isinstance(value, float):
+            buffer.append(VALUE_FLOAT)
+            buffer += FLOAT_STRUCT.pack(value)
+        elif isinstance(value, str):
+            encoded = value.encode('utf-8')
+            buffer.append(VALUE_STR)
+            write_uint(buffer, len(encoded))
+            buffer += encoded
+        elif isinstance(value, bytes):
+            buffer.append(VALUE_BYTES)
+            write_uint(buffer, len(value))
+            buffer += value
+        elif isinstance(value, (tuple, list)):
+            buffer.append(VALUE_TUPLE if isinstance(value, tuple) else VALUE_LIST)
+            write_uint(buffer, len(value))
+
+            for item in value:
+                self.write_value(buffer, item)
+        elif isinstance(value, dict):
+            buffer.append(VALUE_DICT)
+            write_uint(buffer, len(value))
+
+            for key, item in value.items():
+                self.write_value(buffer, key)
+                self.write_value(buffer, item)
+        else:
+            raise CodecError('Cannot encode value of type %s' % type(value).__name__)
+
+    def write_node(self, buffer, node):
+        index = self.encoded_nodes.get(node, self.new_nodes.get(node))
+
+        if index is not None:
+            buffer.append(VALUE_NODE_REF)
+            write_uint(buffer, index)
+            return
+
+        table_size = len(self.encoded_nodes) + len(self.new_nodes)
+
+        if table_size < self.node_table_size:
+            self.new_nodes[node] = table_size
+            buffer.append(VALUE_NODE_DEFINE)
+        else:
+            buffer.append(VALUE_NODE)
+
+        for value in node:
+            self.write_value(buffer, value)
+
+    def read_value(self, data, offset):
+        tag = data[offset]
+        offset += 1
+
+        if tag == VALUE_NODE_REF:
+            index, offset = read_uint(data, offset)
+
+            if index >= len(self.decoded_nodes):
+                raise CodecError('Unknown node %d' % index)
+
+            return self.decoded_nodes[index], offset
+        elif tag == VALUE_NONE:
+            return None, offset
+        elif tag == VALUE_TRUE:
+            return True, offset
+        elif tag == VALUE_FALSE:
+            return False, offset
+        elif tag == VALUE_INT:
+            value, offset = read_uint(data, offset)
+            return (value >> 1) if not value & 1 else -((value + 1) >> 1), offset
+        elif tag == VALUE_STR:
+            size, offset = read_uint(data, offset)
+            return str(data[offset:offset + size], 'utf-8'), offset + size
+        elif tag in (VALUE_NODE, VALUE_NODE_DEFINE):
+            return self.read_node(data, offset, tag == VALUE_NODE_DEFINE)
+        elif tag in (VALUE_TUPLE, VALUE_LIST):
+            size, offset = read_uint(data, offset)
+            items = []
+
+            for _ in range(size):
+                item, offset = self.read_value(data, offset)
+                items.append(item)
+
+            return tuple(items) if tag == VALUE_TUPLE else items, offset
+        elif tag == VALUE_DICT:
+            size, offset = read_uint(data, offset)
+            items = {}
+
+            for _ in range(size):
+                key, offset = self.read_value(data, offset)
+                items[key], offset = self.read_value(data, offset)
+
+            return items, offset
+        elif tag == VALUE_FLOAT:
+            value, = FLOAT_STRUCT.unpack_from(data, offset)
+            return value, offset + FLOAT_STRUCT.size
+        elif tag == VALUE_BYTES:
+            size, offset = read_uint(data, offset)
+            return bytes(data[offset:offset + size]), offset + size
+        else:
+            raise CodecError('Unknown value tag %d' % tag)
+
+    def read_node(self, data, offset, define):
+        node_id, offset = self.read_value(data, offset)
+        address, offset = self.read_value(data, offset)
+        capacity, offset = self.read_value(data, offset)
+
+        # nodes are used as dictionary keys, so all their fields have to be hashable
+        if not isinstance(node_id, int) or not isinstance(capacity, int):
+            raise CodecError('Invalid node')
+
+        if address is not None and not (isinstance(address, tuple) and all(isinstance(item, (str, int)) for item in address)):
+            raise CodecError('Invalid node address')
+
+        node = NodeInfo(node_id, address, capacity)
+
+        if define:
+            if len(self.decoded_nodes) >= self.node_table_size:
+                raise CodecError('Node table is full')
+
+            self.decoded_nodes.append(node)
+
+        return node, offset
+
+CODECS = {
+    CODEC_PICKLE: PickleCodec,
+    CODEC_BINARY: BinaryCodec,
+}
+
+def create_codec(codec_id):
+    if codec_id not in CODECS:
+        raise CodecError('Unsupported codec %d' % codec_id)
+
+    return CODECS[codec_id]()
+
+def encode_preamble(codec_id):
+    return bytes([codec_id])
+
+def decode_preamble(data, allow_pickle=False):
+    # the preamble is the first frame on a connection and selects the codec, pickle can run arbitrary code
+    # when decoding, so it is only accepted from trusted peers
+    if len(data) != 1:
+        raise CodecError('Invalid preamble')
+
+    if data[0] == CODEC_PICKLE and not allow_pickle:
+        raise CodecError('Pickle codec is not allowed')
+
+    return create_codec(data[0])
+
+def write_uint(buffer, value):
+    # variable-length integer, 7 bits per byte with the highest bit set on all bytes but the last
+    while value >= 0x80:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+
+    buffer.append(value)
+
+def read_uint(data, offset):
+    result = 0
+    shift = 0
+
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7f) << shift
+
+        if byte < 0x80:
+            return result, offset
+
+        shift += 7
+
+        if shift > 63:
+            raise CodecError('Integer too long')
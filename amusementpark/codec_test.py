@@ -0,0 +1,125 @@
+import pytest
+from amusementpark.codec import BinaryCodec, PickleCodec, CodecError, CODEC_PICKLE, CODEC_BINARY, BINARY_VERSION, \
+    MESSAGE_TAGS, VALUE_NODE, encode_preamble, decode_preamble
+from amusementpark.messages import NetworkMessage
+from amusementpark.node_info import NodeInfo
+
+nodes = [
+    NodeInfo(100, ('localhost', 3001), 4),
+    NodeInfo(200, ('localhost', 3002), 8),
+    NodeInfo(300, ('localhost', 3003), 3),
+]
+
+messages = [
+    NetworkMessage('enter_request', nodes[0], nodes[1]),
+    NetworkMessage('enter_response', nodes[1], nodes[0], allowed=True),
+    NetworkMessage('election_voted', nodes[1], nodes[0], leader=None, election=(1, 100)),
+    NetworkMessage('election_finished', nodes[1], nodes[0], leader=nodes[2], election=(1, 100)),
+    NetworkMessage('test', nodes[0], nodes[1], number=-12345, ratio=0.5, name='gate', data=b'\x00\x01',
+        items=[1, (2, 3), {'key': nodes[2]}]),
+]
+
+@pytest.mark.parametrize('message', messages)
+def test_binary_round_trip(message):
+    encoder = BinaryCodec()
+    decoder = BinaryCodec()
+
+    # second round uses node table references
+    assert decoder.decode(encoder.encode(message)) == message
+    assert decoder.decode(encoder.encode(message)) == message
+
+def test_binary_node_table():
+    codec = BinaryCodec()
+    message = NetworkMessage('election_finished', nodes[0], nodes[1], leader=nodes[2], election=(1, 100))
+
+    first = codec.encode(message)
+    second = codec.encode(message)
+
+    assert len(second) < len(first)
+    assert len(second) < len(PickleCodec().encode(message)) / 10
+
+def test_binary_stateless():
+    codec = BinaryCodec(node_table_size=0)
+    message = messages[3]
+
+    assert codec.encode(message) == codec.encode(message)
+    assert not codec.encoded_nodes
+
+def test_binary_unsupported_value():
+    with pytest.raises(CodecError):
+        BinaryCodec().encode(NetworkMessage('test', nodes[0], nodes[1], value=object()))
+
+def test_binary_failed_encode_keeps_node_table():
+    encoder = BinaryCodec()
+    decoder = BinaryCodec()
+
+    # the recipient is added to the table before the payload fails, the receiver never sees the message
+    with pytest.raises(CodecError):
+        encoder.encode(NetworkMessage('test', nodes[0], nodes[2], value=object()))
+
+    assert decoder.decode(encoder.encode(messages[3])) == messages[3]
+
+version = bytes([BINARY_VERSION])
+
+@pytest.mark.parametrize('data', [
+    b'',
+    version,
+    version + b'\x01\x0c\x05',
+    version + b'\x01\x05\xff',
+    version + b'\x01\x05\x02\xff\xfe',
+    version + b'\xff' * 20,
+    BinaryCodec().encode(messages[0]) + b'\x00',
+    version + b'\x01\x0c\x00',
+    version + b'\x01\x02\x02\x00',
+])
+def test_binary_malformed_data(data):
+    with pytest.raises(CodecError):
+        BinaryCodec().decode(data)
+
+def encode_value(value):
+    buffer = bytearray()
+    BinaryCodec(node_table_size=0).write_value(buffer, value)
+    return bytes(buffer)
+
+def encode_node(node):
+    # the encoder refuses nodes which are not hashable, so they are encoded field by field
+    return bytes([VALUE_NODE]) + b''.join(encode_value(value) for value in node)
+
+@pytest.mark.parametrize('node', [
+    NodeInfo(100, ['localhost', 3001], 4),
+    NodeInfo(100, ('localhost', [3001]), 4),
+    NodeInfo([100], ('localhost', 3001), 4),
+    NodeInfo(100, ('localhost', 3001), {}),
+])
+def test_binary_unhashable_node(node):
+    header = version + bytes([MESSAGE_TAGS['hello']])
+
+    with pytest.raises(CodecError):
+        BinaryCodec().decode(header + encode_node(node) + encode_node(nodes[1]) + b'\x00')
+
+    with pytest.raises(CodecError):
+        BinaryCodec().decode(header + encode_node(nodes[0]) + encode_node(nodes[1]) + b'\x01' +
+            encode_value('leader') + encode_node(node))
+
+def test_binary_node_table_is_limited():
+    encoder = BinaryCodec(node_table_size=3)
+    decoder = BinaryCodec(node_table_size=2)
+
+    with pytest.raises(CodecError):
+        decoder.decode(encoder.encode(NetworkMessage('test', nodes[0], nodes[1], leader=nodes[2])))
+
+def test_pickle_round_trip():
+    codec = PickleCodec()
+
+    for message in messages:
+        assert codec.decode(codec.encode(message)) == message
+
+def test_preamble():
+    assert isinstance(decode_preamble(encode_preamble(CODEC_BINARY)), BinaryCodec)
+    assert isinstance(decode_preamble(encode_preamble(CODEC_PICKLE), allow_pickle=True), PickleCodec)
+
+    with pytest.raises(CodecError):
+        decode_preamble(encode_preamble(CODEC_PICKLE))
+
+    with pytest.raises(CodecError):
+        decode_preamble(encode_preamble(42))
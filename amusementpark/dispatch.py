@@ -0,0 +1,45 @@
+from collections import Counter
+
+def handles(*message_types):
+    # mark a node method as the handler for messages of the given types
+    def decorator(method):
+        method.handled_message_types = message_types
+        return method
+
+    return decorator
+
+class Dispatcher:
+    """
+    Dispatcher routes messages to the node methods marked with the handles decorator.
+
+    The table of handlers is built once for each class when the class is defined, so dispatching a message is
+    a single dictionary lookup. Handlers take the message as their only parameter and can be generators.
+    Messages without a handler are counted in unknown_messages.
+    """
+
+    handlers = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        # handlers of subclasses override the handlers of their base classes
+        cls.handlers = dict(cls.handlers)
+
+        for attribute in vars(cls).values():
+            for message_type in getattr(attribute, 'handled_message_types', ()):
+                cls.handlers[message_type] = attribute
+
+    def __init__(self):
+        self.unknown_messages = Counter() # number of received messages of each unknown type
+
+    def process_message(self, message):
+        handler = self.handlers.get(message.type)
+
+        if handler is None:
+            self.unknown_messages[message.type] += 1
+            return
+
+        messages = handler(self, message)
+
+        if messages is not None: # handler is a generator
+            yield from messages
@@ -0,0 +1,40 @@
+from amusementpark.dispatch import Dispatcher, handles
+from amusementpark.messages import LocalMessage
+
+class Node(Dispatcher):
+    @handles('ping')
+    def ping(self, message):
+        yield LocalMessage('pong')
+
+    @handles('note', 'remark')
+    def note(self, message):
+        self.note = message.type
+
+class DerivedNode(Node):
+    @handles('ping')
+    def ping_twice(self, message):
+        yield LocalMessage('pong')
+        yield LocalMessage('pong')
+
+def test_dispatch():
+    node = Node()
+
+    assert list(node.process_message(LocalMessage('ping'))) == [LocalMessage('pong')]
+
+    assert list(node.process_message(LocalMessage('remark'))) == []
+    assert node.note == 'remark'
+
+def test_handlers_are_resolved_per_class():
+    assert set(Node.handlers) == {'ping', 'note', 'remark'}
+    assert Node.handlers['ping'] is Node.ping
+    assert DerivedNode.handlers['ping'] is DerivedNode.ping_twice
+
+    assert list(DerivedNode().process_message(LocalMessage('ping'))) == [LocalMessage('pong'), LocalMessage('pong')]
+
+def test_unknown_messages_are_counted():
+    node = Node()
+
+    assert list(node.process_message(LocalMessage('unknown'))) == []
+    assert list(node.process_message(LocalMessage('unknown'))) == []
+
+    assert node.unknown_messages == {'unknown': 2}
@@ -1,93 +1,144 @@
+from collections import Counter, deque
+import itertools
+import time
+import logging
+
+from amusementpark.dispatch import Dispatcher, handles
 from amusementpark.messages import NetworkMessage
+from amusementpark.visitor_repository import StateWriter
+
+log = logging.getLogger('amusementpark.gate_node')
 
-class GateNode:
+class GateNode(Dispatcher):
     STATE_IDLE = 'idle' # no election is in progress
     STATE_INITIATED = 'initiated' # this node started the election
     STATE_ELECTING = 'electing' # waiting for child nodes to respond
     STATE_WAITING = 'waiting' # waiting for the leader to be announced
 
-    def __init__(self, info, neighbours, repository):
+    ADMISSION_MUTEX = 'mutex' # gates change the shared repository while holding the mutex
+    ADMISSION_SERVICE = 'service' # the leader keeps the state and decides about the requests of gates
+    ADMISSION_ESCROW = 'escrow' # like service, but gates admit visitors with free slots given by the leader
+    ADMISSION_TREE = 'tree' # like service, but batches are merged on the way to the leader along the election tree
+
+    FAILOVER_CANDIDATES = 4 # candidates for the leader remembered from an election
+    ESCROW_REPORT_SIZE = 16 # visitors admitted with escrow slots after which the leader is told without waiting for a tick
+
+    def __init__(self, info, neighbours, repository, admission=ADMISSION_MUTEX, lease_time=5, clock=time.monotonic,
+            failover=False, batch_timeout=1, writer=StateWriter):
+        super().__init__()
+
         self.info = info
         self.neighbours = neighbours
         self.repository = repository
+        self.admission = admission
+        self.lease_time = lease_time # seconds the mutex is granted for, unless the holder renews it
+        self.clock = clock
+        self.failover = failover # the next candidate takes over when the leader is removed
+        self.batch_timeout = batch_timeout # seconds after which an unanswered admission batch is sent again
+        self.writer = writer # creates the writer of the state kept by the leader
 
         # state attributes related to elections
         self.state = GateNode.STATE_IDLE
         self.parent = None # parent node during election
         self.leader = None # leader node
         self.answers = {} # answers from child nodes
+        self.election = None # epoch and initiator id of the election this node takes part in
+        self.epoch = 0 # highest epoch seen
+
+        # spanning tree built by the last election
+        self.tree_parent = None
+        self.tree_children = None # None when no tree is known
+        self.leader_route = None # tree neighbour on the path to the leader
+        self.subtree_candidates = {} # best candidates for the leader in the subtree of each child
+        self.candidates = [] # candidates which take over when the leader is removed, best first
 
         # state attributes related to mutual exclusion
         self.mutex_holder = None # node currently holding the mutex
-        self.mutex_queue = [] # nodes waiting for mutex to be released
+        self.mutex_queue = deque() # nodes waiting for mutex to be released
+        self.mutex_request_times = {} # time when the waiting nodes requested the mutex
+        self.mutex_deadline = None # time when the lease of the holder expires
+        self.mutex_grant_time = None
+
+        # mutex metrics
+        self.mutex_grant_count = 0
+        self.mutex_expired_count = 0
+        self.mutex_renewal_count = 0
+        self.mutex_total_wait_time = 0
+        self.mutex_max_wait_time = 0
+        self.mutex_total_hold_time = 0
+        self.mutex_max_hold_time = 0
+        self.mutex_max_queue_length = 0
 
         # state attributes related to enter/leave requests
         self.mutex_requested = False
+        self.mutex_request_time = None
         self.enter_queue = []
         self.leave_queue = []
+
+        # state attributes related to the admission service
+        self.admission_batch = None # entering and leaving nodes sent to the leader
+        self.batch_number = 0
+        self.batch_time = None # time when the batch was last sent
+        self.batch_answers = {} # last answer sent to each gate, sent again if the gate repeats its batch
+        self.park_state = None # state kept by the leader
+        self.state_writer = None
+
+        # state attributes related to escrow
+        self.escrow_slots = 0 # visitors this gate can admit without asking the leader
+        self.admitted = [] # visitors admitted with escrow slots, which the leader was not told about yet
+        self.unrecorded = [] # admitted visitors the leader could not add to the state, reported again until they fit
+        self.demand = 0 # enter requests since the last tick
+        self.recent_demand = 0 # enter requests during the tick before
+        self.escrow = Counter() # slots given to each gate, kept by the leader
+        self.revoking = {} # gates which were asked to return their slots, with the number of the revocation
+        self.revocation_number = 0
+        self.revocation_time = None # time when the revocations were last sent
+        self.escrow_return = None # last return of slots by this gate, sent again if the revocation is repeated
+        self.waiting_batches = [] # batches waiting for the slots to be returned
+        self.rejected = {} # visitors of each gate which did not fit, sent with the next answer to the gate
+
+        # escrow metrics
+        self.escrow_duplicate_count = 0
+        self.escrow_overflow_count = 0
+
+        # state attributes related to request aggregation
+        self.child_batches = [] # batches of child gates which are forwarded with the next batch
     
-    def process_message(self, message):
-        if message.type == 'say_hello':
-            yield from self.say_hello()
-        elif message.type == 'start_election':
-            yield from self.start_election()
-        elif message.type == 'remove_leader':
-            yield from self.remove_leader()
-        elif message.type == 'terminate':
-            yield from self.terminate()
-        elif message.type == 'hello':
-            yield from self.process_hello(message)
-        elif message.type == 'election_started':
-            yield from self.process_election_started(message)
-        elif message.type == 'election_voted':
-            yield from self.process_election_voted(message)
-        elif message.type == 'election_finished':
-            yield from self.process_election_finished(message)
-        elif message.type == 'mutex_requested':
-            yield from self.process_mutex_requested(message)
-        elif message.type == 'mutex_released':
-            yield from self.process_mutex_released(message)
-        elif message.type == 'enter_request':
-            yield from self.process_enter_request(message)
-        elif message.type == 'leave_request':
-            yield from self.process_leave_request(message)
-        elif message.type == 'mutex_granted':
-            yield from self.process_mutex_granted(message)
-        elif message.type == 'leader_removed':
-            yield from self.process_leader_removed(message)
-        elif message.type == 'terminated':
-            self.process_terminated(message)
-    
-    def say_hello(self):
+    @handles('say_hello')
+    def say_hello(self, message):
         for neighbour in self.neighbours:
             yield NetworkMessage('hello', self.info, neighbour)
 
-    def start_election(self):
-        if self.state == GateNode.STATE_IDLE:
-            self.state = GateNode.STATE_INITIATED
-            
-            self.parent = None
-            self.leader = None
-            self.answers = {}
+    @handles('start_election')
+    def start_election(self, message):
+        if self.state != GateNode.STATE_IDLE:
+            # the election in progress chooses a leader for this node as well
+            log.info('Node %s is already taking part in election %s', self, self.election)
+            return
 
-            for neighbour in self.neighbours:
-                yield NetworkMessage('election_started', self.info, neighbour)
-        else:
-            self.handle_error('Unexpected state')
+        yield from self.begin_election()
     
-    def remove_leader(self):
+    @handles('remove_leader')
+    def remove_leader(self, message):
         if self.state != GateNode.STATE_IDLE:
             self.handle_error('Unexpected state')
         
         if self.leader != self.info:
             self.handle_error('Not the leader')
         
-        self.leader = None
-        
-        for neighbour in self.neighbours:
-            yield NetworkMessage('leader_removed', self.info, neighbour)
+        self.release_park_state()
+
+        if self.failover and self.candidates and self.tree_children is not None:
+            # the next candidate takes over without an election, the tree is still the same
+            yield from self.change_leader(self.candidates[0], self.candidates[1:])
+        else:
+            self.leader = None
+            self.candidates = []
+
+            yield from self.broadcast('leader_removed')
     
-    def terminate(self):
+    @handles('terminate')
+    def terminate(self, message):
         if self.state == GateNode.STATE_IDLE:
             for neighbour in self.neighbours:
                 yield NetworkMessage('terminated', self.info, neighbour)
@@ -96,143 +147,720 @@ class GateNode:
         else:
             self.handle_error('Unexpected state')
     
+    @handles('hello')
     def process_hello(self, message):
         yield NetworkMessage('hey', self.info, message.sender)
     
+    @handles('election_started')
     def process_election_started(self, message):
-        if self.state == GateNode.STATE_IDLE:
-            self.state = GateNode.STATE_ELECTING
+        election = message.payload['election']
 
-            self.parent = message.sender
-            self.leader = None
-            self.answers = {}
+        if self.election is not None and election < self.election:
+            # the election was started before the one this node takes part in, so it is suppressed
+            return
+
+        if election != self.election:
+            # a later election replaces the one in progress
+            self.join_election(election, message.sender)
+            self.state = GateNode.STATE_ELECTING
 
             for child in self.get_children():
-                yield NetworkMessage('election_started', self.info, child)
+                yield NetworkMessage('election_started', self.info, child, election=election)
             
             if self.has_all_answers():
                 # in this case there are no children for this node, so it votes for itself as the leader
+                self.tree_children = []
                 self.state = GateNode.STATE_WAITING
-                yield NetworkMessage('election_voted', self.info, message.sender, leader=self.info)
+                yield NetworkMessage('election_voted', self.info, message.sender, leader=self.info, election=election,
+                    **self.get_candidate_payload([self.info]))
         
         elif self.state in (GateNode.STATE_ELECTING, GateNode.STATE_INITIATED):
-            yield NetworkMessage('election_voted', self.info, message.sender, leader=None)
+            yield NetworkMessage('election_voted', self.info, message.sender, leader=None, election=election)
 
         else:
             self.handle_error('Unexpected state')
     
+    @handles('election_voted')
     def process_election_voted(self, message):
         leader = message.payload['leader']
 
+        if message.payload['election'] != self.election: # vote in a suppressed election
+            return
+
         if self.state in (GateNode.STATE_ELECTING, GateNode.STATE_INITIATED):
             self.answers[message.sender] = leader
+            self.subtree_candidates[message.sender] = message.payload.get('candidates', [])
 
             if self.has_all_answers(): # all children have responded now
-                leader = self.get_best_answer() # select the leader
-
-                if self.state == GateNode.STATE_ELECTING: # this is an intermediate node
-                    self.state = GateNode.STATE_WAITING
-                    yield NetworkMessage('election_voted', self.info, self.parent, leader=leader)
-                else: # this is the node which started the election
-                    self.state = GateNode.STATE_IDLE
-                    self.leader = leader
-                    
-                    for neighbour in self.neighbours:
-                        yield NetworkMessage('election_finished', self.info, neighbour, leader=leader)
+                yield from self.count_votes()
         else:
             self.handle_error('Unexpected state')
 
+    def count_votes(self):
+        leader = self.get_best_answer() # select the leader
+        candidates = self.get_ranked_candidates(leader)
+        self.tree_children = self.get_tree_children()
+
+        if self.state == GateNode.STATE_ELECTING: # this is an intermediate node
+            self.state = GateNode.STATE_WAITING
+            yield NetworkMessage('election_voted', self.info, self.parent, leader=leader,
+                election=self.election, **self.get_candidate_payload(candidates))
+        else: # this is the node which started the election
+            self.state = GateNode.STATE_IDLE
+            self.leader = leader
+            self.candidates = candidates[1:]
+            self.tree_parent = None
+            self.leader_route = self.get_leader_route()
+            
+            yield from self.broadcast('election_finished', leader=leader, election=self.election,
+                **self.get_candidate_payload(self.candidates))
+
+            yield from self.resend_admission_batch()
+            yield from self.resend_mutex_request()
+
+    @handles('election_finished')
     def process_election_finished(self, message):
         leader = message.payload['leader']
 
-        if self.state == GateNode.STATE_WAITING:
+        if self.state == GateNode.STATE_WAITING and message.payload['election'] == self.election:
             self.state = GateNode.STATE_IDLE
             self.leader = leader
+            self.candidates = message.payload.get('candidates', [])
+            self.tree_parent = self.parent
+            self.leader_route = self.get_leader_route()
 
-            for neighbour in self.neighbours:
-                if neighbour != message.sender:
-                    yield NetworkMessage('election_finished', self.info, neighbour, leader=leader)
+            yield from self.broadcast('election_finished', message.sender, leader=leader, election=self.election,
+                **self.get_candidate_payload(self.candidates))
+
+            yield from self.resend_admission_batch()
+            yield from self.resend_mutex_request()
     
+    @handles('mutex_requested')
     def process_mutex_requested(self, message):
+        yield from self.reclaim_mutex()
+
+        if message.sender == self.mutex_holder or message.sender in self.mutex_request_times:
+            return # the node already holds the mutex or waits for it
+
+        self.mutex_queue.append(message.sender)
+        self.mutex_request_times[message.sender] = self.clock()
+        self.mutex_max_queue_length = max(self.mutex_max_queue_length, len(self.mutex_queue))
+
         if self.mutex_holder is None:
-            self.mutex_holder = message.sender
-            yield NetworkMessage('mutex_granted', self.info, self.mutex_holder)
-        else:
-            self.mutex_queue.append(message.sender)
+            yield from self.grant_mutex()
             
+    @handles('mutex_released')
     def process_mutex_released(self, message):
         if self.leader != self.info:
             self.handle_error('Not a leader')
 
-        if self.mutex_holder is None:
-            self.handle_error('No mutex holder')
-
         if self.mutex_holder != message.sender:
-            self.handle_error('Invalid sender')
-        
-        if self.mutex_queue: # some nodes are waiting in the queue
-            self.mutex_holder = self.mutex_queue.pop(0)
-            yield NetworkMessage('mutex_granted', self.info, self.mutex_holder)
-        else:
-            self.mutex_holder = None
+            # the lease expired and the mutex was given to another node
+            log.warning('Node %s: mutex released by %s which does not hold it' % (self, message.sender.id))
+            return
+
+        self.release_mutex()
+        yield from self.grant_mutex()
+
+    @handles('mutex_renewed')
+    def process_mutex_renewed(self, message):
+        yield from self.reclaim_mutex()
+
+        if message.sender != self.mutex_holder:
+            # the lease expired before the renewal arrived, so the gate waits for the mutex again
+            log.warning('Node %s: mutex renewed by %s which does not hold it' % (self, message.sender.id))
+            yield from self.process_mutex_requested(message)
+            return
+
+        self.mutex_deadline = self.clock() + self.lease_time
+        self.mutex_renewal_count += 1
+
+        yield NetworkMessage('mutex_granted', self.info, message.sender, lease=self.lease_time)
+
+    @handles('tick')
+    def process_tick(self, message):
+        yield from self.reclaim_mutex()
+
+        # the request or the grant may have been lost, the leader ignores the request if it was not
+        if self.mutex_requested and self.clock() - self.mutex_request_time >= self.lease_time:
+            yield from self.send_mutex_request()
+
+        # the batch or its answer may have been lost, the leader answers a repeated batch without applying it
+        if self.admission_batch is not None and self.leader is not None and \
+                self.clock() - self.batch_time >= self.batch_timeout:
+            yield from self.send_admission_request()
+
+        # the leader sizes the escrow slots by the demand during the last two ticks
+        self.recent_demand = self.demand
+        self.demand = 0
+
+        # the revocation or the return may have been lost, the gate returns the same slots again
+        if self.revoking and self.clock() - self.revocation_time >= self.batch_timeout:
+            yield from self.send_revocations()
+
+        # the visitors admitted with escrow slots are reported at least once per tick
+        if self.admitted or self.unrecorded:
+            yield from self.request_admission()
+
+    def grant_mutex(self):
+        if self.mutex_holder is not None or not self.mutex_queue:
+            return
+
+        now = self.clock()
+        self.mutex_holder = self.mutex_queue.popleft()
+        self.mutex_deadline = now + self.lease_time
+        self.mutex_grant_time = now
+
+        wait_time = now - self.mutex_request_times.pop(self.mutex_holder)
+        self.mutex_grant_count += 1
+        self.mutex_total_wait_time += wait_time
+        self.mutex_max_wait_time = max(self.mutex_max_wait_time, wait_time)
+
+        yield NetworkMessage('mutex_granted', self.info, self.mutex_holder, lease=self.lease_time)
+
+    def release_mutex(self):
+        hold_time = self.clock() - self.mutex_grant_time
+        self.mutex_total_hold_time += hold_time
+        self.mutex_max_hold_time = max(self.mutex_max_hold_time, hold_time)
+
+        self.mutex_holder = None
+        self.mutex_deadline = None
+
+    def reclaim_mutex(self):
+        # the holder did not release the mutex in time, it may have failed or its message was lost
+        if self.mutex_holder is not None and self.clock() >= self.mutex_deadline:
+            log.warning('Node %s: lease of %s expired' % (self, self.mutex_holder.id))
+
+            self.mutex_expired_count += 1
+            self.release_mutex()
+            yield from self.grant_mutex()
+
+    def get_mutex_stats(self):
+        grant_count = self.mutex_grant_count
+        release_count = grant_count - (self.mutex_holder is not None)
+
+        return {
+            'grants': grant_count,
+            'expired': self.mutex_expired_count,
+            'renewals': self.mutex_renewal_count,
+            'queue_length': len(self.mutex_queue),
+            'max_queue_length': self.mutex_max_queue_length,
+            'mean_grant_latency': self.mutex_total_wait_time / grant_count if grant_count else 0,
+            'max_grant_latency': self.mutex_max_wait_time,
+            'mean_hold_time': self.mutex_total_hold_time / release_count if release_count else 0,
+            'max_hold_time': self.mutex_max_hold_time,
+        }
     
+    @handles('enter_request')
     def process_enter_request(self, message):
-        if not self.mutex_requested:
-            yield NetworkMessage('mutex_requested', self.info, self.leader)
-            self.mutex_requested = True
-        
+        if self.admission == GateNode.ADMISSION_ESCROW:
+            if self.is_admitted(message.sender.id):
+                # the visitor was admitted by this gate and did not leave since
+                yield NetworkMessage('enter_response', self.info, message.sender, allowed=False)
+                return
+
+            self.demand += 1
+
+            if self.escrow_slots > 0:
+                # the slot was reserved by the leader, which is told about the visitor with a later batch
+                self.escrow_slots -= 1
+                self.admitted.append(message.sender.id)
+
+                yield NetworkMessage('enter_response', self.info, message.sender, allowed=True)
+
+                if self.is_report_due():
+                    yield from self.request_admission()
+
+                return
+
         self.enter_queue.append(message.sender)
+        yield from self.request_admission()
     
+    @handles('leave_request')
     def process_leave_request(self, message):
-        if not self.mutex_requested:
-            yield NetworkMessage('mutex_requested', self.info, self.leader)
-            self.mutex_requested = True
-        
+        if message.sender.id in self.unrecorded:
+            # the visitor is not in the state, so only this gate has to forget about it
+            self.unrecorded.remove(message.sender.id)
+            yield NetworkMessage('leave_response', self.info, message.sender, allowed=True)
+            return
+
         self.leave_queue.append(message.sender)
+        yield from self.request_admission()
+
+    def is_admitted(self, visitor):
+        # visitors admitted by this gate which are not known to be in the state yet
+        admitted = self.admitted + self.unrecorded
+
+        if self.admission_batch is not None:
+            admitted += self.admission_batch[2] + self.admission_batch[3]
+
+        return visitor in admitted
+
+    def is_report_due(self):
+        # the leader needs the report when the gate has no slots left or when many visitors are waiting for it
+        return bool(self.admitted) and \
+            (self.escrow_slots == 0 or len(self.admitted) >= GateNode.ESCROW_REPORT_SIZE)
+
+    def request_admission(self):
+        if self.admission in (GateNode.ADMISSION_SERVICE, GateNode.ADMISSION_ESCROW, GateNode.ADMISSION_TREE):
+            if self.admission_batch is None:
+                yield from self.send_admission_batch()
+        elif not self.mutex_requested:
+            self.mutex_requested = True
+            yield from self.send_mutex_request()
+
+    def send_mutex_request(self):
+        # without a leader the request is sent when the next leader is known
+        self.mutex_request_time = self.clock()
+
+        if self.leader is not None:
+            yield NetworkMessage('mutex_requested', self.info, self.leader)
+
+    def resend_mutex_request(self):
+        # the new leader does not know about the request sent to the previous one
+        if self.mutex_requested:
+            yield from self.send_mutex_request()
     
+    @handles('mutex_granted')
     def process_mutex_granted(self, message):
         if not self.mutex_requested:
-            self.handle_error('Mutex not requested')
+            # the request was sent again after the lease expired and both requests were granted
+            log.warning('Node %s: mutex granted but not requested' % self)
+            yield NetworkMessage('mutex_released', self.info, message.sender)
+            return
+
+        # the lease started when the grant was sent, so only half of it is used to allow for the delay, a grant
+        # without a lease is not reclaimed
+        lease = message.payload.get('lease')
+        deadline = self.clock() + lease / 2 if lease is not None else None
         
         state = self.repository.read_state()
-        
-        for entering_node in self.enter_queue:
-            try:
-                state.enter(entering_node.id)
-                yield NetworkMessage('enter_response', self.info, entering_node, allowed=True)
-            except AssertionError: # if node cannot enter
-                yield NetworkMessage('enter_response', self.info, entering_node, allowed=False)
-        
-        for leaving_node in self.leave_queue:
-            try:
-                state.leave(leaving_node.id)
-                yield NetworkMessage('leave_response', self.info, leaving_node, allowed=True)
-            except AssertionError: # if node cannot leave
-                yield NetworkMessage('leave_response', self.info, leaving_node, allowed=False)
+        entered = [change_state(state.enter, entering_node.id) for entering_node in self.enter_queue]
+        left = [change_state(state.leave, leaving_node.id) for leaving_node in self.leave_queue]
+
+        if deadline is not None and self.clock() >= deadline:
+            # the leader may have given the mutex to another gate, which could be writing the state already, so
+            # nothing is written until the leader renews the lease and grants the mutex again
+            log.warning('Node %s: lease expired before the state was written' % self)
+            yield NetworkMessage('mutex_renewed', self.info, message.sender)
+            return
         
         self.repository.write_state(state)
+
+        for entering_node, allowed in zip(self.enter_queue, entered):
+            yield NetworkMessage('enter_response', self.info, entering_node, allowed=allowed)
+
+        for leaving_node, allowed in zip(self.leave_queue, left):
+            yield NetworkMessage('leave_response', self.info, leaving_node, allowed=allowed)
         
         self.mutex_requested = False
         self.enter_queue = []
         self.leave_queue = []
         
         yield NetworkMessage('mutex_released', self.info, self.leader)
+
+    def send_admission_batch(self):
+        # the nodes which requested admission while a batch was in progress are sent together
+        self.admission_batch = (self.enter_queue, self.leave_queue, self.admitted, self.unrecorded,
+            self.demand + self.recent_demand, self.child_batches)
+        self.enter_queue = []
+        self.leave_queue = []
+        self.admitted = []
+        self.unrecorded = []
+        self.child_batches = []
+
+        yield from self.resend_admission_batch()
+
+    def resend_admission_batch(self):
+        if self.admission_batch is None or self.leader is None:
+            return
+
+        # answers to the previous number are ignored, so a batch resent to a new leader is answered once
+        self.batch_number += 1
+        yield from self.send_admission_request()
+
+    def send_admission_request(self):
+        self.batch_time = self.clock()
+        entering_nodes, leaving_nodes, admitted, unrecorded, demand, child_batches = self.admission_batch
+        escrow = {'admitted': admitted, 'demand': demand} if self.admission == GateNode.ADMISSION_ESCROW else {}
+
+        if unrecorded:
+            escrow['unrecorded'] = unrecorded
+
+        # the visitors of this gate come first, followed by the visitors of the child batches
+        entering = [node.id for node in entering_nodes]
+        leaving = [node.id for node in leaving_nodes]
+
+        for _, _, child_entering, child_leaving in child_batches:
+            entering += child_entering
+            leaving += child_leaving
+
+        yield NetworkMessage('admission_requested', self.info, self.get_admission_recipient(),
+            batch=self.batch_number, entering=entering, leaving=leaving, **escrow)
+
+    def get_admission_recipient(self):
+        if self.admission == GateNode.ADMISSION_TREE and self.leader_route is not None:
+            return self.leader_route
+
+        return self.leader
+
+    @handles('admission_requested')
+    def process_admission_requested(self, message):
+        answer = self.batch_answers.get(message.sender)
+
+        if answer is not None and message.payload['batch'] <= answer.payload['batch']:
+            # the gate did not get the answer, which is sent again instead of applying the batch twice
+            if message.payload['batch'] == answer.payload['batch']:
+                yield answer
+
+            return
+
+        if self.is_batch_pending(message.sender, message.payload['batch']):
+            return # the batch is answered once its turn comes
+
+        if self.leader != self.info and self.admission == GateNode.ADMISSION_TREE:
+            # the batch is merged with the batches of the other gates in this subtree
+            self.child_batches.append((message.sender, message.payload['batch'],
+                message.payload['entering'], message.payload['leaving']))
+
+            yield from self.request_admission()
+            return
+
+        if self.leader != self.info:
+            # the batch was sent to this node before it lost the leadership, the gate sends it to the next leader
+            log.warning('Node %s: admission requested by %s but not a leader' % (self, message.sender.id))
+            return
+
+        self.get_park_state()
+
+        if self.admission == GateNode.ADMISSION_ESCROW:
+            self.add_admitted(message.sender, message.payload['admitted'], message.payload.get('unrecorded', []))
+
+            if len(message.payload['entering']) > self.get_free_slots() and \
+                    (self.revoking or any(self.escrow.values())):
+                # the park is full unless the gates return their unused slots
+                self.waiting_batches.append(message)
+                yield from self.revoke_escrow()
+                return
+
+        yield from self.answer_admission_batch(message)
+
+    def answer_admission_batch(self, message):
+        state = self.park_state
+        reserved = sum(self.escrow.values())
+
+        with self.state_writer.lock:
+            entered = [
+                state.count + reserved < state.capacity and change_state(state.enter, visitor)
+                for visitor in message.payload['entering']
+            ]
+            left = [change_state(state.leave, visitor) for visitor in message.payload['leaving']]
+
+        self.state_writer.write_state(state)
+        escrow = {}
+
+        if self.admission == GateNode.ADMISSION_ESCROW:
+            # the slots of the gate are topped up to its recent demand, but with at most half of the free slots
+            slots = 0 if self.revoking else \
+                max(min(message.payload['demand'] - self.escrow[message.sender], self.get_free_slots() // 2), 0)
+            self.escrow[message.sender] += slots
+            escrow['slots'] = slots
+
+            if message.sender in self.rejected:
+                escrow['rejected'] = self.rejected.pop(message.sender)
+
+        answer = NetworkMessage('admission_answered', self.info, message.sender,
+            batch=message.payload['batch'], entered=entered, left=left, **escrow)
+        self.batch_answers[message.sender] = answer
+
+        yield answer
+
+    def is_batch_pending(self, gate, batch):
+        # batches which were received but not answered yet, because they wait for the leader or for escrow
+        child_batches = self.child_batches + (self.admission_batch[5] if self.admission_batch is not None else [])
+
+        return any(child == gate and child_batch == batch for child, child_batch, _, _ in child_batches) or \
+            any(waiting.sender == gate and waiting.payload['batch'] == batch for waiting in self.waiting_batches)
+
+    def add_admitted(self, gate, visitors, unrecorded=()):
+        # visitors admitted by the gate take the slots reserved for it, slots given by a previous leader are not known
+        # and the visitors take free slots instead, the visitors which do not fit are returned to the gate
+        rejected = []
+
+        with self.state_writer.lock:
+            for visitor in visitors:
+                reserved = self.escrow[gate] > 0
+
+                if reserved:
+                    self.escrow[gate] -= 1
+
+                if not self.record_admitted(visitor, reserved):
+                    rejected.append(visitor)
+
+            rejected += [visitor for visitor in unrecorded if not self.record_admitted(visitor, False)]
+
+        if rejected:
+            self.rejected.setdefault(gate, []).extend(rejected)
+
+        if visitors or unrecorded:
+            self.state_writer.write_state(self.park_state)
+
+    def record_admitted(self, visitor, reserved):
+        # returns whether the visitor is in the state
+        if visitor in self.park_state:
+            self.escrow_duplicate_count += 1
+            return True
+
+        if (reserved or self.get_free_slots() > 0) and change_state(self.park_state.enter, visitor):
+            return True
+
+        self.escrow_overflow_count += 1
+        return False
+
+    def get_free_slots(self):
+        return self.park_state.capacity - self.park_state.count - sum(self.escrow.values())
+
+    def get_escrow_stats(self):
+        return {
+            'reserved': sum(self.escrow.values()),
+            'duplicates': self.escrow_duplicate_count,
+            'overflows': self.escrow_overflow_count,
+            'unrecorded': len(self.unrecorded),
+        }
+
+    def revoke_escrow(self):
+        for gate, slots in self.escrow.items():
+            if slots > 0 and gate not in self.revoking:
+                self.revocation_number += 1
+                self.revoking[gate] = self.revocation_number
+                self.revocation_time = self.clock()
+
+                yield NetworkMessage('escrow_revoked', self.info, gate, revocation=self.revocation_number)
+
+    def send_revocations(self):
+        self.revocation_time = self.clock()
+
+        for gate, revocation in self.revoking.items():
+            yield NetworkMessage('escrow_revoked', self.info, gate, revocation=revocation)
+
+    @handles('escrow_revoked')
+    def process_escrow_revoked(self, message):
+        answer = self.escrow_return
+
+        if answer is None or answer.recipient != message.sender or \
+                answer.payload['revocation'] != message.payload['revocation']:
+            answer = NetworkMessage('escrow_returned', self.info, message.sender,
+                slots=self.escrow_slots, admitted=self.admitted, revocation=message.payload['revocation'])
+
+            self.escrow_return = answer
+            self.escrow_slots = 0
+            self.admitted = []
+
+        yield answer
+
+    @handles('escrow_returned')
+    def process_escrow_returned(self, message):
+        if self.leader != self.info:
+            # the slots were revoked by this node before it lost the leadership, the next leader does not know them
+            log.warning('Node %s: escrow returned by %s but not a leader' % (self, message.sender.id))
+            return
+
+        if self.revoking.get(message.sender) != message.payload['revocation']:
+            return # the return was sent again after it was received
+
+        self.get_park_state()
+        self.add_admitted(message.sender, message.payload['admitted'])
+        self.escrow[message.sender] = max(self.escrow[message.sender] - message.payload['slots'], 0)
+        del self.revoking[message.sender]
+
+        if not self.revoking:
+            batches = self.waiting_batches
+            self.waiting_batches = []
+
+            for batch in batches:
+                yield from self.answer_admission_batch(batch)
+
+    @handles('admission_answered')
+    def process_admission_answered(self, message):
+        if self.admission_batch is None or message.payload['batch'] != self.batch_number:
+            return # answer to a batch which was sent again
+
+        entering_nodes, leaving_nodes, _, _, _, child_batches = self.admission_batch
+        self.admission_batch = None
+        self.escrow_slots += message.payload.get('slots', 0)
+        rejected = list(message.payload.get('rejected', []))
+
+        entered = iter(message.payload['entered'])
+        left = iter(message.payload['left'])
+
+        for entering_node, allowed in zip(entering_nodes, entered):
+            yield NetworkMessage('enter_response', self.info, entering_node, allowed=allowed)
+
+        for leaving_node, allowed in zip(leaving_nodes, left):
+            if not allowed and leaving_node.id in rejected:
+                # the visitor left before the leader could add it to the state
+                rejected.remove(leaving_node.id)
+                allowed = True
+
+            yield NetworkMessage('leave_response', self.info, leaving_node, allowed=allowed)
+
+        for visitor in rejected:
+            leaving_node = next((node for node in self.leave_queue if node.id == visitor), None)
+
+            if leaving_node is None:
+                self.unrecorded.append(visitor)
+            else:
+                self.leave_queue.remove(leaving_node)
+                yield NetworkMessage('leave_response', self.info, leaving_node, allowed=True)
+
+        for child, child_batch, child_entering, child_leaving in child_batches:
+            answer = NetworkMessage('admission_answered', self.info, child, batch=child_batch,
+                entered=list(itertools.islice(entered, len(child_entering))),
+                left=list(itertools.islice(left, len(child_leaving))))
+            self.batch_answers[child] = answer
+
+            yield answer
+
+        # the unrecorded visitors are reported again with the next tick, when the leader may have free slots
+        if self.enter_queue or self.leave_queue or self.child_batches or self.is_report_due():
+            yield from self.send_admission_batch()
+
+    def get_park_state(self):
+        # the leader reads the state once and writes it in the background after every batch
+        if self.park_state is None:
+            self.park_state = self.repository.read_state()
+
+            if self.park_state is None:
+                self.handle_error('No park state')
+
+            if self.state_writer is None:
+                self.state_writer = self.writer(self.repository)
+                self.state_writer.run()
+
+        return self.park_state
+
+    def release_park_state(self):
+        # the next leader reads the state from the repository, so all changes have to be written first
+        if self.park_state is not None:
+            self.state_writer.flush()
+            self.park_state = None
+
+        # the slots given by this leader are not known to the next one
+        self.escrow_slots = 0
+
+        # the previous leader may have dropped the last return, so its visitors are reported to the next leader,
+        # which counts them as duplicates if they are in the state already
+        if self.escrow_return is not None:
+            self.unrecorded += self.escrow_return.payload['admitted']
+            self.escrow_return = None
+        self.escrow = Counter()
+        self.revoking = {}
+        self.waiting_batches = []
+        self.rejected = {}
+
+        # child gates send their batches again to the next leader, with new numbers
+        self.child_batches = []
+        self.batch_answers = {}
+
+        if self.admission_batch is not None:
+            self.admission_batch = self.admission_batch[:5] + ([],)
     
+    @handles('leader_removed')
     def process_leader_removed(self, message):
-        if self.leader is None: # leader was already removed by a previous message
+        successor = message.payload.get('successor')
+
+        if self.leader is None or self.leader == successor: # leader was already removed by a previous message
             return
         
-        self.leader = None
+        self.release_park_state()
 
-        for neighbour in self.neighbours:
-            if neighbour != message.sender:
-                yield NetworkMessage('leader_removed', self.info, neighbour)
+        if successor is not None and self.tree_children is not None:
+            yield from self.change_leader(successor, message.payload['candidates'], message.sender)
+        else:
+            # without the tree the successor may not be reachable, so a new election is needed
+            self.leader = None
+            self.candidates = []
+
+            yield from self.broadcast('leader_removed', message.sender)
+
+    def change_leader(self, successor, candidates, sender=None):
+        self.leader = successor
+        self.candidates = candidates
+        self.leader_route = self.get_leader_route()
+
+        yield from self.broadcast('leader_removed', sender, successor=successor, candidates=candidates)
+
+        yield from self.resend_admission_batch()
+        yield from self.resend_mutex_request()
     
+    @handles('terminated')
     def process_terminated(self, message):
         if self.state != GateNode.STATE_IDLE:
             self.handle_error('Unexpected state')
         
-        self.neighbours.remove(message.sender)
+        self.remove_neighbour(message.sender)
+
+    @handles('peer_failed')
+    def process_peer_failed(self, message):
+        peer = message.payload['peer']
+
+        if peer not in self.neighbours: # the peer terminated in the meantime
+            return
+
+        log.warning('Node %s lost neighbour %d', self, peer.id)
+        self.remove_neighbour(peer)
+
+        if peer == self.leader:
+            self.leader = None
+            self.release_park_state()
+
+        if self.leader is None or self.state != GateNode.STATE_IDLE:
+            # a new leader is needed, or the election in progress may wait for the failed peer
+            yield from self.begin_election()
+
+    @handles('peer_recovered')
+    def process_peer_recovered(self, message):
+        peer = message.payload['peer']
+
+        if peer in self.neighbours:
+            return
+
+        log.warning('Node %s regained neighbour %d', self, peer.id)
+        self.neighbours.append(peer)
+
+        # both sides may have elected their own leader, a new election joins them under a single one
+        self.release_park_state()
+        yield from self.begin_election()
+
+    def remove_neighbour(self, neighbour):
+        self.neighbours.remove(neighbour)
+
+        if neighbour == self.tree_parent or neighbour in (self.tree_children or []):
+            # the tree is broken, so the next election has to build a new one
+            self.tree_parent = None
+            self.tree_children = None
+            self.leader_route = None
+            self.subtree_candidates = {}
+            self.candidates = []
+
+    def begin_election(self):
+        self.join_election((self.epoch + 1, self.info.id), None)
+        self.state = GateNode.STATE_INITIATED
+
+        for neighbour in self.neighbours:
+            yield NetworkMessage('election_started', self.info, neighbour, election=self.election)
+
+        if self.has_all_answers(): # a node without neighbours is its own leader
+            yield from self.count_votes()
+
+    def join_election(self, election, parent):
+        self.election = election
+        self.epoch = max(self.epoch, election[0])
+
+        self.parent = parent
+        self.leader = None
+        self.answers = {}
+        self.subtree_candidates = {}
 
     def get_children(self):
         if self.state == GateNode.STATE_INITIATED:
@@ -242,6 +870,38 @@ class GateNode:
         else:
             self.handle_error('Unexpected state')
     
+    def broadcast(self, message_type, sender=None, **payload):
+        # announcements follow the tree of the last election, so every node receives them exactly once
+        neighbours = self.get_tree_neighbours()
+
+        if neighbours is None or (sender is not None and sender not in neighbours):
+            # without a tree, or when the sender did not have one, the announcement is flooded
+            neighbours = self.neighbours
+
+        for neighbour in neighbours:
+            if neighbour != sender:
+                yield NetworkMessage(message_type, self.info, neighbour, **payload)
+
+    def get_tree_neighbours(self):
+        if self.tree_children is None:
+            return None
+
+        return ([self.tree_parent] if self.tree_parent is not None else []) + self.tree_children
+
+    def get_tree_children(self):
+        # children which answered None were already reached through another node, so they are not in the tree
+        return [child for child in self.get_children() if self.answers[child] is not None]
+
+    def get_leader_route(self):
+        if self.leader == self.info:
+            return None
+
+        for child in self.tree_children or []:
+            if self.answers.get(child) == self.leader or self.leader in self.subtree_candidates.get(child, ()):
+                return child
+
+        return self.tree_parent
+    
     def has_all_answers(self):
         return all(child in self.answers for child in self.get_children())
     
@@ -255,8 +915,34 @@ class GateNode:
         # select node with the highest capacity
         return max(child_answers + [self.info], key=lambda node: node.capacity)
     
+    def get_ranked_candidates(self, leader):
+        if not self.failover:
+            return [leader]
+
+        # the best candidates of the whole network are also among the best candidates of their subtree
+        candidates = [
+            candidate
+            for child in self.get_children()
+            for candidate in self.subtree_candidates.get(child, [])
+        ]
+        candidates = [candidate for candidate in candidates + [self.info] if candidate != leader]
+        candidates.sort(key=lambda node: node.capacity, reverse=True)
+
+        return [leader] + candidates[:GateNode.FAILOVER_CANDIDATES - 1]
+
+    def get_candidate_payload(self, candidates):
+        return {'candidates': candidates} if self.failover else {}
+
     def handle_error(self, message):
         raise Exception('Node %s: %s' % (self, message))
     
     def __str__(self):
-        return '%d/%s' % (self.info.id, self.state)
\ No newline at end of file
+        return '%d/%s' % (self.info.id, self.state)
+
+def change_state(change, visitor):
+    # returns whether the visitor could enter or leave
+    try:
+        change(visitor)
+        return True
+    except AssertionError:
+        return False
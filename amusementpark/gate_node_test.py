@@ -1,7 +1,11 @@
+from collections import deque
 import pytest
 from amusementpark.gate_node import GateNode
 from amusementpark.messages import NetworkMessage, LocalMessage
 from amusementpark.node_info import NodeInfo
+from amusementpark.bitmap_repository import BitmapRepository
+from amusementpark.journal_repository import JournalRepository
+from amusementpark.sqlite_repository import SQLiteRepository
 from amusementpark.visitor_repository import Repository, State
 
 nodes = [
@@ -13,6 +17,8 @@ nodes = [
     NodeInfo(900, 9, 9),
 ]
 
+election = (1, nodes[5].id) # election started by another node
+
 @pytest.fixture
 def visitor_repository(tmpdir):
     filename = tmpdir.join('repository.json')
@@ -31,15 +37,17 @@ def test_start_election(visitor_repository):
     node = GateNode(nodes[0], [nodes[1], nodes[2]], visitor_repository)
 
     assert list(node.process_message(LocalMessage('start_election'))) == \
-        [NetworkMessage('election_started', nodes[0], nodes[1]), NetworkMessage('election_started', nodes[0], nodes[2])]
+        [NetworkMessage('election_started', nodes[0], nodes[1], election=(1, nodes[0].id)),
+            NetworkMessage('election_started', nodes[0], nodes[2], election=(1, nodes[0].id))]
     
     assert node.state == GateNode.STATE_INITIATED
+    assert node.election == (1, nodes[0].id)
 
 def test_first_election_message(visitor_repository):
     node = GateNode(nodes[0], [nodes[1], nodes[2], nodes[3]], visitor_repository)
 
-    assert list(node.process_message(NetworkMessage('election_started', nodes[1], nodes[0]))) == \
-        [NetworkMessage('election_started', nodes[0], nodes[2]), NetworkMessage('election_started', nodes[0], nodes[3])]
+    assert list(node.process_message(NetworkMessage('election_started', nodes[1], nodes[0], election=election))) == \
+        [NetworkMessage('election_started', nodes[0], nodes[2], election=election), NetworkMessage('election_started', nodes[0], nodes[3], election=election)]
     
     assert node.state == GateNode.STATE_ELECTING
     assert node.parent == nodes[1]
@@ -47,10 +55,11 @@ def test_first_election_message(visitor_repository):
 def test_another_election_message(visitor_repository):
     node = GateNode(nodes[0], [nodes[1], nodes[2], nodes[3]], visitor_repository)
     node.state = GateNode.STATE_ELECTING
+    node.election = election
     node.parent = nodes[1]
 
-    assert list(node.process_message(NetworkMessage('election_started', nodes[2], nodes[0]))) == \
-        [NetworkMessage('election_voted', nodes[0], nodes[2], leader=None)]
+    assert list(node.process_message(NetworkMessage('election_started', nodes[2], nodes[0], election=election))) == \
+        [NetworkMessage('election_voted', nodes[0], nodes[2], leader=None, election=election)]
     
     assert node.state == GateNode.STATE_ELECTING
     assert node.parent == nodes[1]
@@ -58,8 +67,8 @@ def test_another_election_message(visitor_repository):
 def test_election_start_without_children(visitor_repository):
     node = GateNode(nodes[0], [nodes[1]], visitor_repository)
 
-    assert list(node.process_message(NetworkMessage('election_started', nodes[1], nodes[0]))) == \
-        [NetworkMessage('election_voted', nodes[0], nodes[1], leader=nodes[0])]
+    assert list(node.process_message(NetworkMessage('election_started', nodes[1], nodes[0], election=election))) == \
+        [NetworkMessage('election_voted', nodes[0], nodes[1], leader=nodes[0], election=election)]
     
     assert node.state == GateNode.STATE_WAITING
     assert node.parent == nodes[1]
@@ -67,8 +76,9 @@ def test_election_start_without_children(visitor_repository):
 def test_first_ack(visitor_repository):
     node = GateNode(nodes[0], [nodes[1], nodes[2], nodes[3]], visitor_repository)
     node.state = GateNode.STATE_INITIATED
+    node.election = election
     
-    assert list(node.process_message(NetworkMessage('election_voted', nodes[1], nodes[0], leader=nodes[5]))) == []
+    assert list(node.process_message(NetworkMessage('election_voted', nodes[1], nodes[0], leader=nodes[5], election=election))) == []
     
     assert node.state == GateNode.STATE_INITIATED
     assert node.answers == {nodes[1]: nodes[5]}
@@ -76,11 +86,12 @@ def test_first_ack(visitor_repository):
 def test_last_ack_intermediate_node(visitor_repository):
     node = GateNode(nodes[0], [nodes[1], nodes[2], nodes[3]], visitor_repository)
     node.state = GateNode.STATE_ELECTING
+    node.election = election
     node.parent = nodes[1]
     node.answers = {nodes[2]: nodes[5]}
     
-    assert list(node.process_message(NetworkMessage('election_voted', nodes[3], nodes[0], leader=nodes[4]))) == \
-        [NetworkMessage('election_voted', nodes[0], nodes[1], leader=nodes[5])]
+    assert list(node.process_message(NetworkMessage('election_voted', nodes[3], nodes[0], leader=nodes[4], election=election))) == \
+        [NetworkMessage('election_voted', nodes[0], nodes[1], leader=nodes[5], election=election)]
     
     assert node.state == GateNode.STATE_WAITING
     assert node.answers == {nodes[2]: nodes[5], nodes[3]: nodes[4]}
@@ -88,10 +99,11 @@ def test_last_ack_intermediate_node(visitor_repository):
 def test_last_ack_starting_node(visitor_repository):
     node = GateNode(nodes[0], [nodes[1], nodes[2]], visitor_repository)
     node.state = GateNode.STATE_INITIATED
+    node.election = election
     node.answers = {nodes[1]: nodes[4]}
     
-    assert list(node.process_message(NetworkMessage('election_voted', nodes[2], nodes[0], leader=nodes[5]))) == \
-        [NetworkMessage('election_finished', nodes[0], nodes[1], leader=nodes[5]), NetworkMessage('election_finished', nodes[0], nodes[2], leader=nodes[5])]
+    assert list(node.process_message(NetworkMessage('election_voted', nodes[2], nodes[0], leader=nodes[5], election=election))) == \
+        [NetworkMessage('election_finished', nodes[0], nodes[1], leader=nodes[5], election=election), NetworkMessage('election_finished', nodes[0], nodes[2], leader=nodes[5], election=election)]
     
     assert node.state == GateNode.STATE_IDLE
     assert node.leader == nodes[5]
@@ -99,41 +111,166 @@ def test_last_ack_starting_node(visitor_repository):
 def test_finishing_election(visitor_repository):
     node = GateNode(nodes[0], [nodes[1], nodes[2], nodes[3]], visitor_repository)
     node.state = GateNode.STATE_WAITING
+    node.election = election
 
-    assert list(node.process_message(NetworkMessage('election_finished', nodes[1], nodes[0], leader=nodes[5]))) == \
-        [NetworkMessage('election_finished', nodes[0], nodes[2], leader=nodes[5]), NetworkMessage('election_finished', nodes[0], nodes[3], leader=nodes[5])]
+    assert list(node.process_message(NetworkMessage('election_finished', nodes[1], nodes[0], leader=nodes[5], election=election))) == \
+        [NetworkMessage('election_finished', nodes[0], nodes[2], leader=nodes[5], election=election), NetworkMessage('election_finished', nodes[0], nodes[3], leader=nodes[5], election=election)]
     
     assert node.state == GateNode.STATE_IDLE
     assert node.leader == nodes[5]
 
 def test_request_mutex(visitor_repository):
-    node = GateNode(nodes[0], [], visitor_repository)
+    node = GateNode(nodes[0], [], visitor_repository, lease_time=5)
     node.leader = nodes[0]
 
     assert list(node.process_message(NetworkMessage('mutex_requested', nodes[1], nodes[0]))) == \
-        [NetworkMessage('mutex_granted', nodes[0], nodes[1])]
+        [NetworkMessage('mutex_granted', nodes[0], nodes[1], lease=5)]
     assert node.mutex_holder == nodes[1]
     assert not node.mutex_queue
 
     assert list(node.process_message(NetworkMessage('mutex_requested', nodes[2], nodes[0]))) == []
-    assert node.mutex_queue == [nodes[2]]
+    assert list(node.mutex_queue) == [nodes[2]]
 
     assert list(node.process_message(NetworkMessage('mutex_requested', nodes[3], nodes[0]))) == []
-    assert node.mutex_queue == [nodes[2], nodes[3]]
+    assert list(node.mutex_queue) == [nodes[2], nodes[3]]
+
+    # a node which is already waiting is not added again
+    assert list(node.process_message(NetworkMessage('mutex_requested', nodes[2], nodes[0]))) == []
+    assert list(node.mutex_queue) == [nodes[2], nodes[3]]
 
     assert list(node.process_message(NetworkMessage('mutex_released', nodes[1], nodes[0]))) == \
-        [NetworkMessage('mutex_granted', nodes[0], nodes[2])]
+        [NetworkMessage('mutex_granted', nodes[0], nodes[2], lease=5)]
     assert node.mutex_holder == nodes[2]
-    assert node.mutex_queue == [nodes[3]]
+    assert list(node.mutex_queue) == [nodes[3]]
 
     assert list(node.process_message(NetworkMessage('mutex_released', nodes[2], nodes[0]))) == \
-        [NetworkMessage('mutex_granted', nodes[0], nodes[3])]
+        [NetworkMessage('mutex_granted', nodes[0], nodes[3], lease=5)]
     assert node.mutex_holder == nodes[3]
-    assert node.mutex_queue == []
+    assert list(node.mutex_queue) == []
 
     assert list(node.process_message(NetworkMessage('mutex_released', nodes[3], nodes[0]))) == []
     assert node.mutex_holder is None
-    assert node.mutex_queue == []
+    assert list(node.mutex_queue) == []
+
+def test_mutex_lease(visitor_repository):
+    now = [0]
+    node = GateNode(nodes[0], [], visitor_repository, lease_time=5, clock=lambda: now[0])
+    node.leader = nodes[0]
+
+    list(node.process_message(NetworkMessage('mutex_requested', nodes[1], nodes[0])))
+    now[0] = 1
+    list(node.process_message(NetworkMessage('mutex_requested', nodes[2], nodes[0])))
+
+    now[0] = 4
+    assert list(node.process_message(LocalMessage('tick'))) == []
+
+    # the holder did not release the mutex in time, so it is given to the next node
+    now[0] = 5
+    assert list(node.process_message(LocalMessage('tick'))) == \
+        [NetworkMessage('mutex_granted', nodes[0], nodes[2], lease=5)]
+
+    # the release of the previous holder is ignored
+    assert list(node.process_message(NetworkMessage('mutex_released', nodes[1], nodes[0]))) == []
+    assert node.mutex_holder == nodes[2]
+
+    now[0] = 10
+    list(node.process_message(NetworkMessage('mutex_released', nodes[2], nodes[0])))
+
+    stats = node.get_mutex_stats()
+    assert stats['grants'] == 2
+    assert stats['expired'] == 1
+    assert stats['max_queue_length'] == 1
+    assert stats['max_grant_latency'] == 4
+    assert stats['mean_hold_time'] == 5
+
+def test_mutex_renewal(visitor_repository):
+    now = [0]
+    node = GateNode(nodes[0], [], visitor_repository, lease_time=5, clock=lambda: now[0])
+    node.leader = nodes[0]
+
+    list(node.process_message(NetworkMessage('mutex_requested', nodes[1], nodes[0])))
+    list(node.process_message(NetworkMessage('mutex_requested', nodes[2], nodes[0])))
+
+    # the holder renews the lease before it expires and is granted the mutex again
+    now[0] = 4
+    assert list(node.process_message(NetworkMessage('mutex_renewed', nodes[1], nodes[0]))) == \
+        [NetworkMessage('mutex_granted', nodes[0], nodes[1], lease=5)]
+
+    now[0] = 8
+    assert list(node.process_message(LocalMessage('tick'))) == []
+
+    # the renewal arrives after the lease expired, so the gate waits behind the others
+    now[0] = 9
+    assert list(node.process_message(NetworkMessage('mutex_renewed', nodes[1], nodes[0]))) == \
+        [NetworkMessage('mutex_granted', nodes[0], nodes[2], lease=5)]
+    assert list(node.mutex_queue) == [nodes[1]]
+
+    stats = node.get_mutex_stats()
+    assert stats['renewals'] == 1
+    assert stats['expired'] == 1
+
+def test_mutex_request_is_repeated(visitor_repository):
+    now = [0]
+    node = GateNode(nodes[0], [], visitor_repository, lease_time=5, clock=lambda: now[0])
+    node.leader = nodes[5]
+
+    list(node.process_message(NetworkMessage('enter_request', nodes[1], nodes[0])))
+
+    now[0] = 5
+    assert list(node.process_message(LocalMessage('tick'))) == [NetworkMessage('mutex_requested', nodes[0], nodes[5])]
+
+def test_mutex_request_waits_for_leader(visitor_repository):
+    node = GateNode(nodes[0], [nodes[1]], visitor_repository)
+    node.state = GateNode.STATE_WAITING
+    node.election = election
+
+    # the request is sent once the election chose a leader
+    assert list(node.process_message(NetworkMessage('enter_request', nodes[2], nodes[0]))) == []
+    assert list(node.process_message(LocalMessage('tick'))) == []
+
+    assert list(node.process_message(NetworkMessage('election_finished', nodes[1], nodes[0], leader=nodes[5],
+        election=election))) == [NetworkMessage('mutex_requested', nodes[0], nodes[5])]
+
+def test_mutex_lease_expires_before_write(visitor_repository):
+    visitor_repository.write_state(State(capacity=1, visitors=[]))
+    now = [0]
+    node = GateNode(nodes[0], [], visitor_repository, clock=lambda: now[0])
+    node.leader = nodes[5]
+
+    list(node.process_message(NetworkMessage('enter_request', nodes[1], nodes[0])))
+
+    # the state is read so slowly that the leader may have given the mutex to another gate
+    read_state = visitor_repository.read_state
+
+    def read_state_slowly():
+        now[0] = 3
+        return read_state()
+
+    visitor_repository.read_state = read_state_slowly
+
+    assert list(node.process_message(NetworkMessage('mutex_granted', nodes[5], nodes[0], lease=5))) == \
+        [NetworkMessage('mutex_renewed', nodes[0], nodes[5])]
+    assert visitor_repository.read_state() == State(capacity=1, visitors=[])
+    assert node.enter_queue == [nodes[1]]
+
+    # the leader renewed the lease, so the state is read again and written this time
+    visitor_repository.read_state = read_state
+
+    assert list(node.process_message(NetworkMessage('mutex_granted', nodes[5], nodes[0], lease=5))) == \
+        [NetworkMessage('enter_response', nodes[0], nodes[1], allowed=True),
+            NetworkMessage('mutex_released', nodes[0], nodes[5])]
+    assert visitor_repository.read_state() == State(capacity=1, visitors=[nodes[1].id])
+
+def test_mutex_granted_without_lease(visitor_repository):
+    visitor_repository.write_state(State(capacity=1, visitors=[]))
+    node = GateNode(nodes[0], [], visitor_repository)
+    node.leader = nodes[5]
+
+    list(node.process_message(NetworkMessage('enter_request', nodes[1], nodes[0])))
+
+    assert list(node.process_message(NetworkMessage('mutex_granted', nodes[5], nodes[0]))) == \
+        [NetworkMessage('enter_response', nodes[0], nodes[1], allowed=True),
+            NetworkMessage('mutex_released', nodes[0], nodes[5])]
 
 def test_enter_request(visitor_repository):
     visitor_repository.write_state(State(capacity=1, visitors=[]))
@@ -148,7 +285,7 @@ def test_enter_request(visitor_repository):
     assert list(node.process_message(NetworkMessage('enter_request', nodes[2], nodes[0]))) == []
     assert node.enter_queue == [nodes[1], nodes[2]]
 
-    assert list(node.process_message(NetworkMessage('mutex_granted', nodes[5], nodes[0]))) == \
+    assert list(node.process_message(NetworkMessage('mutex_granted', nodes[5], nodes[0], lease=5))) == \
         [NetworkMessage('enter_response', nodes[0], nodes[1], allowed=True),
             NetworkMessage('enter_response', nodes[0], nodes[2], allowed=False),
             NetworkMessage('mutex_released', nodes[0], nodes[5])]
@@ -171,7 +308,7 @@ def test_leave_request(visitor_repository):
     assert list(node.process_message(NetworkMessage('leave_request', nodes[2], nodes[0]))) == []
     assert node.leave_queue == [nodes[1], nodes[2]]
 
-    assert list(node.process_message(NetworkMessage('mutex_granted', nodes[5], nodes[0]))) == \
+    assert list(node.process_message(NetworkMessage('mutex_granted', nodes[5], nodes[0], lease=5))) == \
         [NetworkMessage('leave_response', nodes[0], nodes[1], allowed=True),
             NetworkMessage('leave_response', nodes[0], nodes[2], allowed=False),
             NetworkMessage('mutex_released', nodes[0], nodes[5])]
@@ -210,4 +347,497 @@ def test_leader_removed():
 
     assert list(node.process_message(NetworkMessage('leader_removed', nodes[1], nodes[0]))) == \
         [NetworkMessage('leader_removed', nodes[0], nodes[2])]
-    assert node.leader is None
\ No newline at end of file
+    assert node.leader is None
+
+def test_admission_service_gate(visitor_repository):
+    node = GateNode(nodes[0], [], visitor_repository, admission=GateNode.ADMISSION_SERVICE)
+    node.leader = nodes[5]
+
+    assert list(node.process_message(NetworkMessage('enter_request', nodes[1], nodes[0]))) == \
+        [NetworkMessage('admission_requested', nodes[0], nodes[5], batch=1, entering=[nodes[1].id], leaving=[])]
+
+    # requests are queued until the leader answers the previous batch
+    assert list(node.process_message(NetworkMessage('enter_request', nodes[2], nodes[0]))) == []
+    assert list(node.process_message(NetworkMessage('leave_request', nodes[3], nodes[0]))) == []
+
+    assert list(node.process_message(NetworkMessage('admission_answered', nodes[5], nodes[0], batch=1, entered=[True], left=[]))) == \
+        [NetworkMessage('enter_response', nodes[0], nodes[1], allowed=True),
+            NetworkMessage('admission_requested', nodes[0], nodes[5], batch=2, entering=[nodes[2].id], leaving=[nodes[3].id])]
+
+    assert list(node.process_message(NetworkMessage('admission_answered', nodes[5], nodes[0], batch=2, entered=[False], left=[True]))) == \
+        [NetworkMessage('enter_response', nodes[0], nodes[2], allowed=False),
+            NetworkMessage('leave_response', nodes[0], nodes[3], allowed=True)]
+    assert node.admission_batch is None
+
+def test_admission_service_leader(visitor_repository):
+    visitor_repository.write_state(State(capacity=2, visitors=[nodes[3].id]))
+
+    node = GateNode(nodes[5], [], visitor_repository, admission=GateNode.ADMISSION_SERVICE)
+    node.leader = nodes[5]
+
+    assert list(node.process_message(NetworkMessage('admission_requested', nodes[0], nodes[5], batch=1, entering=[nodes[1].id, nodes[2].id], leaving=[nodes[3].id, nodes[4].id]))) == \
+        [NetworkMessage('admission_answered', nodes[5], nodes[0], batch=1, entered=[True, False], left=[True, False])]
+
+    node.state_writer.flush()
+    assert Repository(visitor_repository.filename).read_state() == State(capacity=2, visitors=[nodes[1].id])
+
+@pytest.mark.parametrize('create_repository', [
+    lambda dirname: Repository(dirname.join('repository.json')),
+    lambda dirname: JournalRepository(str(dirname.join('journal'))),
+    lambda dirname: SQLiteRepository(dirname.join('repository.db')),
+    lambda dirname: BitmapRepository(dirname.join('repository.bitmap'), id_limit=4096),
+])
+def test_admission_service_repositories(tmpdir, create_repository):
+    create_repository(tmpdir).write_state(State(capacity=3, visitors=[nodes[0].id]))
+
+    node = GateNode(nodes[5], [], create_repository(tmpdir), admission=GateNode.ADMISSION_SERVICE)
+    node.leader = nodes[5]
+
+    # the leader keeps the state of the repository and writes it after every batch
+    for batch, (entering, leaving, entered, left) in enumerate([
+        ([nodes[1].id], [], [True], []),
+        ([nodes[2].id, nodes[3].id], [nodes[0].id], [True, False], [True]),
+        ([nodes[3].id], [nodes[4].id], [True], [False]),
+    ], 1):
+        assert list(node.process_message(NetworkMessage('admission_requested', nodes[1], nodes[5], batch=batch, entering=entering, leaving=leaving))) == \
+            [NetworkMessage('admission_answered', nodes[5], nodes[1], batch=batch, entered=entered, left=left)]
+        assert node.state_writer.flush(timeout=5)
+
+    assert node.state_writer.write_count >= 1
+    assert sorted(create_repository(tmpdir).read_state().visitors) == sorted([nodes[1].id, nodes[2].id, nodes[3].id])
+
+def test_admission_batch_to_former_leader(visitor_repository):
+    node = GateNode(nodes[5], [], visitor_repository, admission=GateNode.ADMISSION_SERVICE)
+    node.leader = nodes[4]
+
+    assert list(node.process_message(NetworkMessage('admission_requested', nodes[1], nodes[5], batch=1, entering=[nodes[2].id], leaving=[]))) == []
+    assert node.park_state is None
+
+def test_lost_admission_batch_is_resent(visitor_repository):
+    now = [0]
+    node = GateNode(nodes[0], [], visitor_repository, admission=GateNode.ADMISSION_SERVICE, clock=lambda: now[0],
+        batch_timeout=1)
+    node.leader = nodes[5]
+
+    list(node.process_message(NetworkMessage('enter_request', nodes[1], nodes[0])))
+    assert list(node.process_message(LocalMessage('tick'))) == []
+
+    # the same batch is sent again, so that the leader can recognize it
+    now[0] = 1
+    assert list(node.process_message(LocalMessage('tick'))) == \
+        [NetworkMessage('admission_requested', nodes[0], nodes[5], batch=1, entering=[nodes[1].id], leaving=[])]
+
+def test_repeated_admission_batch_is_applied_once(visitor_repository):
+    visitor_repository.write_state(State(capacity=2, visitors=[]))
+
+    node = GateNode(nodes[5], [], visitor_repository, admission=GateNode.ADMISSION_SERVICE)
+    node.leader = nodes[5]
+
+    request = NetworkMessage('admission_requested', nodes[0], nodes[5], batch=1, entering=[nodes[1].id], leaving=[])
+    answer = NetworkMessage('admission_answered', nodes[5], nodes[0], batch=1, entered=[True], left=[])
+
+    assert list(node.process_message(request)) == [answer]
+    assert list(node.process_message(request)) == [answer]
+
+    # a batch which was already answered arrives late
+    list(node.process_message(NetworkMessage('admission_requested', nodes[0], nodes[5], batch=2, entering=[], leaving=[])))
+    assert list(node.process_message(request)) == []
+
+    node.state_writer.flush()
+    assert Repository(visitor_repository.filename).read_state() == State(capacity=2, visitors=[nodes[1].id])
+
+def test_repeated_child_batch_is_merged_once(visitor_repository):
+    node = GateNode(nodes[0], [nodes[1]], visitor_repository, admission=GateNode.ADMISSION_TREE)
+    node.leader = nodes[5]
+    node.leader_route = nodes[5]
+
+    request = NetworkMessage('admission_requested', nodes[1], nodes[0], batch=1, entering=[nodes[2].id], leaving=[])
+
+    assert list(node.process_message(request)) == \
+        [NetworkMessage('admission_requested', nodes[0], nodes[5], batch=1, entering=[nodes[2].id], leaving=[])]
+    assert list(node.process_message(request)) == []
+
+    answer = NetworkMessage('admission_answered', nodes[0], nodes[1], batch=1, entered=[True], left=[])
+
+    assert list(node.process_message(NetworkMessage('admission_answered', nodes[5], nodes[0], batch=1, entered=[True], left=[]))) == \
+        [answer]
+    assert list(node.process_message(request)) == [answer]
+
+def test_admission_batch_is_resent_to_new_leader(visitor_repository):
+    node = GateNode(nodes[0], [nodes[1]], visitor_repository, admission=GateNode.ADMISSION_SERVICE)
+    node.leader = nodes[5]
+
+    list(node.process_message(NetworkMessage('enter_request', nodes[2], nodes[0])))
+    list(node.process_message(NetworkMessage('leader_removed', nodes[1], nodes[0])))
+
+    node.state = GateNode.STATE_WAITING
+    node.election = election
+
+    assert list(node.process_message(NetworkMessage('election_finished', nodes[1], nodes[0], leader=nodes[4], election=election))) == \
+        [NetworkMessage('admission_requested', nodes[0], nodes[4], batch=2, entering=[nodes[2].id], leaving=[])]
+
+    # the answer of the previous leader is ignored
+    assert list(node.process_message(NetworkMessage('admission_answered', nodes[5], nodes[0], batch=1, entered=[True], left=[]))) == []
+
+def test_escrow_gate(visitor_repository):
+    node = GateNode(nodes[0], [], visitor_repository, admission=GateNode.ADMISSION_ESCROW)
+    node.leader = nodes[5]
+
+    assert list(node.process_message(NetworkMessage('enter_request', nodes[1], nodes[0]))) == \
+        [NetworkMessage('admission_requested', nodes[0], nodes[5], batch=1, entering=[nodes[1].id], leaving=[], admitted=[], demand=1)]
+
+    assert list(node.process_message(NetworkMessage('admission_answered', nodes[5], nodes[0], batch=1, entered=[True], left=[], slots=3))) == \
+        [NetworkMessage('enter_response', nodes[0], nodes[1], allowed=True)]
+    assert node.escrow_slots == 3
+
+    # the visitor is admitted by the gate, the leader is told about it with the next tick, which also tells the
+    # leader about the demand of the gate during the last two ticks
+    assert list(node.process_message(NetworkMessage('enter_request', nodes[2], nodes[0]))) == \
+        [NetworkMessage('enter_response', nodes[0], nodes[2], allowed=True)]
+    assert list(node.process_message(NetworkMessage('enter_request', nodes[2], nodes[0]))) == \
+        [NetworkMessage('enter_response', nodes[0], nodes[2], allowed=False)]
+
+    assert list(node.process_message(LocalMessage('tick'))) == \
+        [NetworkMessage('admission_requested', nodes[0], nodes[5], batch=2, entering=[], leaving=[], admitted=[nodes[2].id], demand=2)]
+
+    assert list(node.process_message(NetworkMessage('enter_request', nodes[3], nodes[0]))) == \
+        [NetworkMessage('enter_response', nodes[0], nodes[3], allowed=True)]
+    assert node.escrow_slots == 1
+
+    assert list(node.process_message(NetworkMessage('escrow_revoked', nodes[5], nodes[0], revocation=1))) == \
+        [NetworkMessage('escrow_returned', nodes[0], nodes[5], slots=1, admitted=[nodes[3].id], revocation=1)]
+    assert node.admitted == []
+
+    # the return was lost, so the same slots and visitors are returned again
+    assert list(node.process_message(NetworkMessage('escrow_revoked', nodes[5], nodes[0], revocation=1))) == \
+        [NetworkMessage('escrow_returned', nodes[0], nodes[5], slots=1, admitted=[nodes[3].id], revocation=1)]
+
+    assert list(node.process_message(NetworkMessage('enter_request', nodes[4], nodes[0]))) == []
+    assert list(node.process_message(NetworkMessage('admission_answered', nodes[5], nodes[0], batch=2, entered=[], left=[], slots=0))) == \
+        [NetworkMessage('admission_requested', nodes[0], nodes[5], batch=3, entering=[nodes[4].id], leaving=[], admitted=[], demand=4)]
+
+def test_escrow_report_without_slots(visitor_repository):
+    node = GateNode(nodes[0], [], visitor_repository, admission=GateNode.ADMISSION_ESCROW)
+    node.leader = nodes[5]
+    node.escrow_slots = GateNode.ESCROW_REPORT_SIZE + 1
+    visitors = [NodeInfo(1000 + i, None, 1) for i in range(GateNode.ESCROW_REPORT_SIZE + 1)]
+
+    for visitor in visitors[:-2]:
+        assert list(node.process_message(NetworkMessage('enter_request', visitor, nodes[0])))[1:] == []
+
+    # the report is not held back any longer once enough visitors are waiting for it
+    [batch] = list(node.process_message(NetworkMessage('enter_request', visitors[-2], nodes[0])))[1:]
+    assert batch.payload['admitted'] == [visitor.id for visitor in visitors[:-1]]
+
+    assert list(node.process_message(NetworkMessage('admission_answered', nodes[5], nodes[0], batch=1, entered=[], left=[], slots=0))) == []
+    assert node.escrow_slots == 1
+
+    # the gate has no slots left, so the leader is told at once
+    assert list(node.process_message(NetworkMessage('enter_request', visitors[-1], nodes[0]))) == \
+        [NetworkMessage('enter_response', nodes[0], visitors[-1], allowed=True),
+            NetworkMessage('admission_requested', nodes[0], nodes[5], batch=2, entering=[], leaving=[], admitted=[visitors[-1].id], demand=len(visitors))]
+
+def test_escrow_rejected_visitors(visitor_repository):
+    node = GateNode(nodes[0], [], visitor_repository, admission=GateNode.ADMISSION_ESCROW)
+    node.leader = nodes[5]
+    node.admitted = [nodes[1].id, nodes[2].id, nodes[3].id]
+
+    # the slots were given by a previous leader, the next one has room for the first visitor only
+    assert list(node.process_message(NetworkMessage('leave_request', nodes[3], nodes[0]))) == \
+        [NetworkMessage('admission_requested', nodes[0], nodes[5], batch=1, entering=[], leaving=[nodes[3].id], admitted=[nodes[1].id, nodes[2].id, nodes[3].id], demand=0)]
+    assert list(node.process_message(NetworkMessage('admission_answered', nodes[5], nodes[0], batch=1, entered=[], left=[False], slots=0, rejected=[nodes[2].id, nodes[3].id]))) == \
+        [NetworkMessage('leave_response', nodes[0], nodes[3], allowed=True)]
+
+    assert node.unrecorded == [nodes[2].id]
+    assert node.get_escrow_stats()['unrecorded'] == 1
+
+    assert list(node.process_message(NetworkMessage('enter_request', nodes[2], nodes[0]))) == \
+        [NetworkMessage('enter_response', nodes[0], nodes[2], allowed=False)]
+    assert list(node.process_message(LocalMessage('tick'))) == \
+        [NetworkMessage('admission_requested', nodes[0], nodes[5], batch=2, entering=[], leaving=[], admitted=[], unrecorded=[nodes[2].id], demand=0)]
+    assert list(node.process_message(NetworkMessage('admission_answered', nodes[5], nodes[0], batch=2, entered=[], left=[], slots=0, rejected=[nodes[2].id]))) == []
+
+    # the leader never had the visitor, so the gate lets it leave by itself
+    assert list(node.process_message(NetworkMessage('leave_request', nodes[2], nodes[0]))) == \
+        [NetworkMessage('leave_response', nodes[0], nodes[2], allowed=True)]
+    assert node.unrecorded == []
+
+def test_escrow_leader(visitor_repository):
+    visitor_repository.write_state(State(capacity=4, visitors=[]))
+
+    node = GateNode(nodes[5], [], visitor_repository, admission=GateNode.ADMISSION_ESCROW)
+    node.leader = nodes[5]
+
+    assert list(node.process_message(NetworkMessage('admission_requested', nodes[0], nodes[5], batch=1, entering=[nodes[1].id], leaving=[], admitted=[], demand=4))) == \
+        [NetworkMessage('admission_answered', nodes[5], nodes[0], batch=1, entered=[True], left=[], slots=1)]
+
+    # only two slots are free, so the slot of the other gate is needed before the batch can be answered
+    assert list(node.process_message(NetworkMessage('admission_requested', nodes[1], nodes[5], batch=1, entering=[nodes[2].id, nodes[3].id, nodes[4].id], leaving=[], admitted=[], demand=3))) == \
+        [NetworkMessage('escrow_revoked', nodes[5], nodes[0], revocation=1)]
+
+    assert list(node.process_message(NetworkMessage('escrow_returned', nodes[0], nodes[5], slots=0, admitted=[nodes[0].id], revocation=1))) == \
+        [NetworkMessage('admission_answered', nodes[5], nodes[1], batch=1, entered=[True, True, False], left=[], slots=0)]
+
+    assert node.park_state.visitors == [nodes[1].id, nodes[0].id, nodes[2].id, nodes[3].id]
+    assert not node.escrow[nodes[0]]
+
+def test_escrow_revocation_is_resent(visitor_repository):
+    visitor_repository.write_state(State(capacity=2, visitors=[]))
+
+    now = [0]
+    node = GateNode(nodes[5], [], visitor_repository, admission=GateNode.ADMISSION_ESCROW, clock=lambda: now[0])
+    node.leader = nodes[5]
+    node.get_park_state()
+    node.escrow[nodes[0]] = 1
+
+    assert list(node.process_message(NetworkMessage('admission_requested', nodes[1], nodes[5], batch=1, entering=[nodes[2].id, nodes[3].id], leaving=[], admitted=[], demand=2))) == \
+        [NetworkMessage('escrow_revoked', nodes[5], nodes[0], revocation=1)]
+
+    # the revocation or its return was lost
+    assert list(node.process_message(LocalMessage('tick'))) == []
+    now[0] = 1
+    assert list(node.process_message(LocalMessage('tick'))) == \
+        [NetworkMessage('escrow_revoked', nodes[5], nodes[0], revocation=1)]
+
+    assert list(node.process_message(NetworkMessage('escrow_returned', nodes[0], nodes[5], slots=1, admitted=[], revocation=1))) == \
+        [NetworkMessage('admission_answered', nodes[5], nodes[1], batch=1, entered=[True, True], left=[], slots=0)]
+    assert list(node.process_message(NetworkMessage('escrow_returned', nodes[0], nodes[5], slots=1, admitted=[], revocation=1))) == []
+    assert node.revoking == {}
+
+def test_escrow_returned_to_former_leader(visitor_repository):
+    node = GateNode(nodes[5], [], visitor_repository, admission=GateNode.ADMISSION_ESCROW)
+    node.leader = nodes[4]
+
+    assert list(node.process_message(NetworkMessage('escrow_returned', nodes[0], nodes[5], slots=1, admitted=[], revocation=1))) == []
+
+def test_escrow_return_is_reported_to_next_leader(visitor_repository):
+    node = GateNode(nodes[0], [], visitor_repository, admission=GateNode.ADMISSION_ESCROW)
+    node.leader = nodes[5]
+    node.escrow_slots = 1
+    node.admitted = [nodes[1].id]
+
+    assert list(node.process_message(NetworkMessage('escrow_revoked', nodes[5], nodes[0], revocation=1))) == \
+        [NetworkMessage('escrow_returned', nodes[0], nodes[5], slots=1, admitted=[nodes[1].id], revocation=1)]
+
+    # the leader may have lost the leadership before it received the return
+    node.leader = nodes[4]
+    node.release_park_state()
+
+    assert list(node.process_message(LocalMessage('tick'))) == \
+        [NetworkMessage('admission_requested', nodes[0], nodes[4], batch=1, entering=[], leaving=[], admitted=[], unrecorded=[nodes[1].id], demand=0)]
+
+def test_escrow_slots_are_topped_up(visitor_repository):
+    visitor_repository.write_state(State(capacity=10, visitors=[]))
+
+    node = GateNode(nodes[5], [], visitor_repository, admission=GateNode.ADMISSION_ESCROW)
+    node.leader = nodes[5]
+
+    assert list(node.process_message(NetworkMessage('admission_requested', nodes[0], nodes[5], batch=1, entering=[], leaving=[], admitted=[], demand=3))) == \
+        [NetworkMessage('admission_answered', nodes[5], nodes[0], batch=1, entered=[], left=[], slots=3)]
+
+    # the gate still has the slots for its demand
+    assert list(node.process_message(NetworkMessage('admission_requested', nodes[0], nodes[5], batch=2, entering=[], leaving=[], admitted=[], demand=3))) == \
+        [NetworkMessage('admission_answered', nodes[5], nodes[0], batch=2, entered=[], left=[], slots=0)]
+
+    assert list(node.process_message(NetworkMessage('admission_requested', nodes[0], nodes[5], batch=3, entering=[], leaving=[], admitted=[nodes[1].id, nodes[2].id], demand=3))) == \
+        [NetworkMessage('admission_answered', nodes[5], nodes[0], batch=3, entered=[], left=[], slots=2)]
+    assert node.escrow[nodes[0]] == 3
+
+def test_escrow_leader_overflow(visitor_repository):
+    visitor_repository.write_state(State(capacity=3, visitors=[nodes[1].id]))
+
+    node = GateNode(nodes[5], [], visitor_repository, admission=GateNode.ADMISSION_ESCROW)
+    node.leader = nodes[5]
+    node.get_park_state()
+    node.escrow[nodes[1]] = 1
+
+    # the visitors were admitted with slots of a previous leader, only one of them fits besides the reserved slot
+    assert list(node.process_message(NetworkMessage('admission_requested', nodes[0], nodes[5], batch=1, entering=[], leaving=[], admitted=[nodes[1].id, nodes[2].id, nodes[3].id], demand=0))) == \
+        [NetworkMessage('admission_answered', nodes[5], nodes[0], batch=1, entered=[], left=[], slots=0, rejected=[nodes[3].id])]
+
+    assert node.park_state.visitors == [nodes[1].id, nodes[2].id]
+    assert node.get_escrow_stats() == {'reserved': 1, 'duplicates': 1, 'overflows': 1, 'unrecorded': 0}
+
+    node.escrow[nodes[1]] = 0
+
+    assert list(node.process_message(NetworkMessage('admission_requested', nodes[0], nodes[5], batch=2, entering=[], leaving=[], admitted=[], unrecorded=[nodes[3].id], demand=0))) == \
+        [NetworkMessage('admission_answered', nodes[5], nodes[0], batch=2, entered=[], left=[], slots=0)]
+    assert node.park_state.visitors == [nodes[1].id, nodes[2].id, nodes[3].id]
+
+def test_election_tree(visitor_repository):
+    node = GateNode(nodes[0], [nodes[1], nodes[2], nodes[3]], visitor_repository)
+    node.state = GateNode.STATE_INITIATED
+    node.election = election
+    node.answers = {nodes[1]: nodes[4], nodes[2]: None}
+
+    list(node.process_message(NetworkMessage('election_voted', nodes[3], nodes[0], leader=nodes[5], election=election)))
+
+    # the second node was reached through another node, so it is not a child in the tree
+    assert node.tree_children == [nodes[1], nodes[3]]
+    assert node.tree_parent is None
+    assert node.leader_route == nodes[3]
+
+def test_tree_aggregation(visitor_repository):
+    node = GateNode(nodes[0], [nodes[1], nodes[2], nodes[4]], visitor_repository, admission=GateNode.ADMISSION_TREE)
+    node.leader = nodes[5]
+    node.leader_route = nodes[1]
+
+    assert list(node.process_message(NetworkMessage('admission_requested', nodes[2], nodes[0], batch=7, entering=[11], leaving=[]))) == \
+        [NetworkMessage('admission_requested', nodes[0], nodes[1], batch=1, entering=[11], leaving=[])]
+
+    # requests of this gate and of the child gates are merged while the batch is in progress
+    assert list(node.process_message(NetworkMessage('enter_request', nodes[3], nodes[0]))) == []
+    assert list(node.process_message(NetworkMessage('admission_requested', nodes[4], nodes[0], batch=3, entering=[], leaving=[12]))) == []
+
+    assert list(node.process_message(NetworkMessage('admission_answered', nodes[1], nodes[0], batch=1, entered=[True], left=[]))) == \
+        [NetworkMessage('admission_answered', nodes[0], nodes[2], batch=7, entered=[True], left=[]),
+            NetworkMessage('admission_requested', nodes[0], nodes[1], batch=2, entering=[nodes[3].id], leaving=[12])]
+
+    assert list(node.process_message(NetworkMessage('admission_answered', nodes[1], nodes[0], batch=2, entered=[False], left=[True]))) == \
+        [NetworkMessage('enter_response', nodes[0], nodes[3], allowed=False),
+            NetworkMessage('admission_answered', nodes[0], nodes[4], batch=3, entered=[], left=[True])]
+
+def test_tree_broadcast(visitor_repository):
+    node = GateNode(nodes[0], [nodes[1], nodes[2], nodes[3], nodes[4]], visitor_repository)
+    node.state = GateNode.STATE_WAITING
+    node.election = election
+    node.parent = nodes[1]
+    node.tree_children = [nodes[3]]
+
+    assert list(node.process_message(NetworkMessage('election_finished', nodes[1], nodes[0], leader=nodes[5], election=election))) == \
+        [NetworkMessage('election_finished', nodes[0], nodes[3], leader=nodes[5], election=election)]
+
+    assert list(node.process_message(NetworkMessage('leader_removed', nodes[3], nodes[0]))) == \
+        [NetworkMessage('leader_removed', nodes[0], nodes[1])]
+
+def test_broadcast_from_outside_of_tree_is_flooded(visitor_repository):
+    node = GateNode(nodes[0], [nodes[1], nodes[2], nodes[3]], visitor_repository)
+    node.leader = nodes[5]
+    node.tree_parent = nodes[1]
+    node.tree_children = []
+
+    assert list(node.process_message(NetworkMessage('leader_removed', nodes[2], nodes[0]))) == \
+        [NetworkMessage('leader_removed', nodes[0], nodes[1]), NetworkMessage('leader_removed', nodes[0], nodes[3])]
+
+def test_failover_candidates(visitor_repository):
+    node = GateNode(nodes[0], [nodes[1], nodes[2], nodes[3]], visitor_repository, failover=True)
+    node.state = GateNode.STATE_ELECTING
+    node.election = election
+    node.parent = nodes[1]
+    node.answers = {nodes[2]: nodes[5]}
+    node.subtree_candidates = {nodes[2]: [nodes[5], nodes[2]]}
+
+    # the vote carries the best candidates of the subtree, starting with the leader
+    assert list(node.process_message(NetworkMessage('election_voted', nodes[3], nodes[0], leader=nodes[4], election=election, candidates=[nodes[4], nodes[3]]))) == \
+        [NetworkMessage('election_voted', nodes[0], nodes[1], leader=nodes[5], election=election, candidates=[nodes[5], nodes[2], nodes[4], nodes[0]])]
+
+    assert list(node.process_message(NetworkMessage('election_finished', nodes[1], nodes[0], leader=nodes[5], election=election, candidates=[nodes[2], nodes[4]]))) == \
+        [NetworkMessage('election_finished', nodes[0], nodes[2], leader=nodes[5], election=election, candidates=[nodes[2], nodes[4]]),
+            NetworkMessage('election_finished', nodes[0], nodes[3], leader=nodes[5], election=election, candidates=[nodes[2], nodes[4]])]
+    assert node.candidates == [nodes[2], nodes[4]]
+    assert node.leader_route == nodes[2]
+
+def test_failover(visitor_repository):
+    node = GateNode(nodes[0], [nodes[1], nodes[2], nodes[3]], visitor_repository, failover=True)
+    node.leader = nodes[0]
+    node.candidates = [nodes[2], nodes[4]]
+    node.tree_children = [nodes[1], nodes[2]]
+    node.subtree_candidates = {nodes[1]: [nodes[4]], nodes[2]: [nodes[2]]}
+
+    # the next candidate becomes the leader without an election
+    assert list(node.process_message(LocalMessage('remove_leader'))) == \
+        [NetworkMessage('leader_removed', nodes[0], nodes[1], successor=nodes[2], candidates=[nodes[4]]),
+            NetworkMessage('leader_removed', nodes[0], nodes[2], successor=nodes[2], candidates=[nodes[4]])]
+    assert node.leader == nodes[2]
+    assert node.leader_route == nodes[2]
+
+    # the announcement is received only once along the tree, so a repeated one is ignored
+    assert list(node.process_message(NetworkMessage('leader_removed', nodes[1], nodes[0], successor=nodes[2], candidates=[nodes[4]]))) == []
+
+def test_failover_without_tree(visitor_repository):
+    node = GateNode(nodes[0], [nodes[1], nodes[2]], visitor_repository, failover=True)
+    node.leader = nodes[5]
+    node.candidates = [nodes[2]]
+
+    # a gate whose tree was broken cannot reach the successor, so the leader is removed everywhere
+    assert list(node.process_message(NetworkMessage('leader_removed', nodes[1], nodes[0], successor=nodes[2], candidates=[]))) == \
+        [NetworkMessage('leader_removed', nodes[0], nodes[2])]
+    assert node.leader is None
+    assert node.candidates == []
+
+def test_start_election_during_election(visitor_repository):
+    node = GateNode(nodes[0], [nodes[1]], visitor_repository)
+    node.state = GateNode.STATE_ELECTING
+    node.election = election
+
+    assert list(node.process_message(LocalMessage('start_election'))) == []
+    assert node.election == election
+
+def test_later_election_is_preferred(visitor_repository):
+    node = GateNode(nodes[0], [nodes[1], nodes[2], nodes[3]], visitor_repository)
+    earlier_election = (1, nodes[1].id)
+
+    list(node.process_message(NetworkMessage('election_started', nodes[1], nodes[0], election=earlier_election)))
+
+    # the election of the node with the higher id replaces the one in progress
+    assert list(node.process_message(NetworkMessage('election_started', nodes[2], nodes[0], election=election))) == \
+        [NetworkMessage('election_started', nodes[0], nodes[1], election=election),
+            NetworkMessage('election_started', nodes[0], nodes[3], election=election)]
+    assert node.parent == nodes[2]
+
+    # messages of the earlier election are ignored
+    assert list(node.process_message(NetworkMessage('election_started', nodes[3], nodes[0], election=earlier_election))) == []
+    assert list(node.process_message(NetworkMessage('election_voted', nodes[1], nodes[0], leader=nodes[1], election=earlier_election))) == []
+    assert node.answers == {}
+
+def test_concurrent_elections(visitor_repository):
+    neighbours = {0: [1, 3], 1: [0, 2, 4], 2: [1, 3], 3: [0, 2, 5], 4: [1], 5: [3]}
+    gates = {i: GateNode(nodes[i], [nodes[j] for j in neighbours[i]], visitor_repository) for i in neighbours}
+    messages = deque()
+
+    for i in (0, 2, 4, 5):
+        messages.extend(gates[i].process_message(LocalMessage('start_election')))
+
+    while messages:
+        message = messages.popleft()
+        messages.extend(gates[nodes.index(message.recipient)].process_message(message))
+
+    # the election of the node with the highest id wins and chooses the node with the highest capacity
+    assert all(gate.state == GateNode.STATE_IDLE for gate in gates.values())
+    assert all(gate.leader == nodes[5] for gate in gates.values())
+    assert all(gate.election == (1, nodes[5].id) for gate in gates.values())
+
+def test_peer_failed(visitor_repository):
+    node = GateNode(nodes[0], [nodes[1], nodes[2], nodes[3]], visitor_repository)
+    node.leader = nodes[5]
+    node.tree_parent = nodes[1]
+    node.tree_children = [nodes[3]]
+
+    # a failed neighbour breaks the tree like a terminated one
+    assert list(node.process_message(LocalMessage('peer_failed', peer=nodes[3]))) == []
+    assert node.neighbours == [nodes[1], nodes[2]]
+    assert node.tree_children is None
+
+    # a failed leader is replaced by a new election
+    node.leader = nodes[2]
+
+    assert list(node.process_message(LocalMessage('peer_failed', peer=nodes[2]))) == \
+        [NetworkMessage('election_started', nodes[0], nodes[1], election=(1, nodes[0].id))]
+    assert node.state == GateNode.STATE_INITIATED
+
+    # the failure was already handled
+    assert list(node.process_message(LocalMessage('peer_failed', peer=nodes[2]))) == []
+
+def test_peer_recovered(visitor_repository):
+    node = GateNode(nodes[0], [nodes[1]], visitor_repository)
+    node.leader = nodes[0]
+
+    # the peer was removed when it failed, after the partition healed a new election joins both sides
+    assert list(node.process_message(LocalMessage('peer_recovered', peer=nodes[2]))) == [
+        NetworkMessage('election_started', nodes[0], nodes[1], election=(1, nodes[0].id)),
+        NetworkMessage('election_started', nodes[0], nodes[2], election=(1, nodes[0].id)),
+    ]
+    assert node.neighbours == [nodes[1], nodes[2]]
+    assert node.leader is None
+
+    assert list(node.process_message(LocalMessage('peer_recovered', peer=nodes[2]))) == []
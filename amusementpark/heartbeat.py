@@ -0,0 +1,203 @@
+from collections import deque
+from threading import Thread, Lock
+import math
+import time
+import logging
+
+from amusementpark.messages import NetworkMessage, LocalMessage
+
+log = logging.getLogger('amusementpark.heartbeat')
+
+class Timer:
+    def __init__(self, callback, rounds):
+        self.callback = callback
+        self.rounds = rounds # turns of the wheel left before the timer expires
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class TimingWheel:
+    """
+    TimingWheel runs callbacks after a delay using a single thread for all timers.
+
+    Timers are kept in slots of tick seconds, so scheduling and cancelling a timer takes constant time and the
+    wheel only has to look at the timers of one slot on every tick. Timers further away than one turn of the
+    wheel stay in their slot for more turns.
+    """
+
+    def __init__(self, tick=0.01, size=512, clock=time.monotonic):
+        self.tick = tick
+        self.size = size
+        self.clock = clock
+
+        self.lock = Lock()
+        self.slots = [[] for _ in range(size)]
+        self.current_tick = 0 # ticks processed since the wheel was created
+        self.start_time = clock()
+
+    def run(self):
+        thread = Thread(target=self.process_ticks, daemon=True)
+        thread.start()
+        return thread
+
+    def process_ticks(self):
+        while True:
+            time.sleep(self.tick)
+            self.advance()
+
+    def schedule(self, delay, callback):
+        ticks = max(1, math.ceil(delay / self.tick))
+
+        with self.lock:
+            timer = Timer(callback, (ticks - 1) // self.size)
+            self.slots[(self.current_tick + ticks) % self.size].append(timer)
+
+        return timer
+
+    def advance(self):
+        # run the timers of all ticks which passed since the last call
+        target_tick = int((self.clock() - self.start_time) / self.tick)
+
+        while self.current_tick < target_tick:
+            with self.lock:
+                self.current_tick += 1
+                slot = self.slots[self.current_tick % self.size]
+                expired = [timer for timer in slot if timer.rounds == 0]
+                slot[:] = [timer for timer in slot if timer.rounds > 0 and not timer.cancelled]
+
+                for timer in slot:
+                    timer.rounds -= 1
+
+            for timer in expired:
+                if not timer.cancelled:
+                    self.run_timer(timer)
+
+    def run_timer(self, timer):
+        try:
+            timer.callback()
+        except Exception:
+            log.exception('Timer callback failed')
+
+class FailureDetector:
+    """
+    FailureDetector is a phi accrual failure detector for a single peer.
+
+    It keeps the intervals between the last heartbeats of the peer and computes phi, the suspicion that the
+    peer failed, from how unlikely it is that the next heartbeat is still missing. The timeout adapts to the
+    usual delays of the peer, and the peer is suspected when phi exceeds the threshold.
+    """
+
+    def __init__(self, threshold=8, window_size=100, min_std_deviation=0.1, first_interval=1, clock=time.monotonic):
+        self.threshold = threshold
+        self.min_std_deviation = min_std_deviation
+        self.clock = clock
+
+        # the first interval is estimated, so a peer which was never heard from can be suspected too
+        self.intervals = deque([first_interval], maxlen=window_size)
+        self.last_time = clock()
+
+    def heartbeat(self):
+        now = self.clock()
+        self.intervals.append(now - self.last_time)
+        self.last_time = now
+
+    def phi(self):
+        mean = sum(self.intervals) / len(self.intervals)
+        variance = sum((interval - mean) ** 2 for interval in self.intervals) / len(self.intervals)
+        std_deviation = max(math.sqrt(variance), self.min_std_deviation)
+
+        # logistic approximation of the cumulative normal distribution
+        y = (self.clock() - self.last_time - mean) / std_deviation
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+
+        if y > 0:
+            return -math.log10(e / (1 + e))
+        else:
+            return -math.log10(1 - 1 / (1 + e))
+
+    def is_suspected(self):
+        return self.phi() > self.threshold
+
+class Heartbeat:
+    """
+    Heartbeat sends heartbeat messages to the peers of a node and passes a local peer_failed message to the
+    node when a peer is suspected by its failure detector.
+
+    Every message received from a peer counts as a heartbeat, messages from other senders such as visitors
+    are ignored. The broker drops the heartbeat messages, so the node does not see them. Peers are read from
+    the list on every beat, so it can be the list of neighbours of the node, and a failed peer is reported
+    only once.
+
+    Heartbeats are still sent to failed peers, even after the node removed them from the list. When a
+    failed peer is heard from again, for example after a network partition healed, a local peer_recovered
+    message is passed to the node and the peer is watched again.
+    """
+
+    def __init__(self, broker, info, peers, wheel, interval=0.5, threshold=8, min_std_deviation=None,
+            clock=time.monotonic):
+        self.broker = broker
+        self.info = info
+        self.peers = peers
+        self.wheel = wheel
+        self.interval = interval # seconds between heartbeats
+        self.threshold = threshold
+        self.min_std_deviation = min_std_deviation if min_std_deviation is not None else interval / 4
+        self.clock = clock
+
+        self.lock = Lock()
+        self.detectors = {}
+        self.failed_peers = set()
+
+    def run(self):
+        self.broker.heartbeat = self
+        self.wheel.schedule(self.interval, self.beat)
+
+    def beat(self):
+        with self.lock:
+            failed_peers = [peer for peer in self.failed_peers if peer not in self.peers]
+
+        for peer in list(self.peers) + failed_peers:
+            self.broker.add_outgoing_message(NetworkMessage('heartbeat', self.info, peer))
+
+        for peer in self.get_suspected_peers():
+            log.warning('Node %s suspects %s failed', self.info.id, peer.id)
+            self.broker.add_incoming_message(LocalMessage('peer_failed', peer=peer))
+
+        self.wheel.schedule(self.interval, self.beat)
+
+    def receive(self, sender):
+        with self.lock:
+            recovered = sender in self.failed_peers
+
+            if not recovered and sender not in self.peers:
+                return # visitors and other nodes which are not watched
+
+            if recovered:
+                # the intervals measured before the failure do not describe the peer any more
+                self.failed_peers.discard(sender)
+                del self.detectors[sender]
+
+            self.get_detector(sender).heartbeat()
+
+        if recovered:
+            log.warning('Node %s heard from %s again', self.info.id, sender.id)
+            self.broker.add_incoming_message(LocalMessage('peer_recovered', peer=sender))
+
+    def get_suspected_peers(self):
+        with self.lock:
+            suspected_peers = [
+                peer
+                for peer in list(self.peers)
+                if peer not in self.failed_peers and self.get_detector(peer).is_suspected()
+            ]
+            self.failed_peers.update(suspected_peers)
+
+        return suspected_peers
+
+    def get_detector(self, peer):
+        if peer not in self.detectors:
+            self.detectors[peer] = FailureDetector(self.threshold, min_std_deviation=self.min_std_deviation,
+                first_interval=self.interval, clock=self.clock)
+
+        return self.detectors[peer]
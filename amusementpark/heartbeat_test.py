@@ -0,0 +1,97 @@
+from unittest.mock import Mock
+from amusementpark.heartbeat import TimingWheel, FailureDetector, Heartbeat
+from amusementpark.messages import NetworkMessage, LocalMessage
+from amusementpark.node_info import NodeInfo
+
+nodes = [
+    NodeInfo(100, 1, 4),
+    NodeInfo(200, 2, 8),
+    NodeInfo(300, 3, 3),
+]
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+def test_timing_wheel():
+    clock = Clock()
+    wheel = TimingWheel(tick=0.01, size=8, clock=clock)
+    fired = []
+
+    wheel.schedule(0.03, lambda: fired.append('short'))
+    wheel.schedule(0.2, lambda: fired.append('long')) # more than one turn of the wheel
+    wheel.schedule(0.05, lambda: fired.append('cancelled')).cancel()
+
+    clock.now = 0.1
+    wheel.advance()
+    assert fired == ['short']
+
+    clock.now = 0.21
+    wheel.advance()
+    assert fired == ['short', 'long']
+
+def test_failure_detector():
+    clock = Clock()
+    detector = FailureDetector(threshold=8, first_interval=1, clock=clock)
+
+    for _ in range(10):
+        clock.now += 1
+        detector.heartbeat()
+
+    clock.now += 1
+    assert not detector.is_suspected()
+
+    # the longer the heartbeat is missing, the higher the suspicion
+    clock.now += 0.5
+    phi = detector.phi()
+    clock.now += 0.5
+    assert detector.phi() > phi
+    assert detector.is_suspected()
+
+def test_heartbeat():
+    clock = Clock()
+    broker = Mock()
+    peers = [nodes[1], nodes[2]]
+    heartbeat = Heartbeat(broker, nodes[0], peers, Mock(), interval=1, clock=clock)
+
+    for _ in range(10):
+        clock.now += 1
+        heartbeat.receive(nodes[1])
+        heartbeat.beat()
+
+    assert broker.add_outgoing_message.call_count == 20
+    broker.add_outgoing_message.assert_called_with(NetworkMessage('heartbeat', nodes[0], nodes[2]))
+
+    # only the silent peer is reported, and only once
+    broker.add_incoming_message.assert_called_once_with(LocalMessage('peer_failed', peer=nodes[2]))
+
+def test_heartbeat_ignores_other_senders():
+    heartbeat = Heartbeat(Mock(), nodes[0], [nodes[1]], Mock(), interval=1, clock=Clock())
+
+    heartbeat.receive(NodeInfo(2000, None, 1))
+    heartbeat.receive(nodes[1])
+
+    assert list(heartbeat.detectors) == [nodes[1]]
+
+def test_heartbeat_recovery():
+    clock = Clock()
+    broker = Mock()
+    peers = [nodes[1]]
+    heartbeat = Heartbeat(broker, nodes[0], peers, Mock(), interval=1, clock=clock)
+    heartbeat.receive(nodes[1])
+
+    clock.now += 10
+    heartbeat.beat()
+    broker.add_incoming_message.assert_called_once_with(LocalMessage('peer_failed', peer=nodes[1]))
+
+    # the node removed the failed peer, which still gets heartbeats so that it can see this node again
+    peers.remove(nodes[1])
+    heartbeat.beat()
+    broker.add_outgoing_message.assert_called_with(NetworkMessage('heartbeat', nodes[0], nodes[1]))
+
+    heartbeat.receive(nodes[1])
+    broker.add_incoming_message.assert_called_with(LocalMessage('peer_recovered', peer=nodes[1]))
+    assert not heartbeat.get_suspected_peers()
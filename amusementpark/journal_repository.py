@@ -0,0 +1,208 @@
+import os
+import json
+
+from amusementpark.visitor_repository import State
+
+SNAPSHOT_FILENAME = 'snapshot.json'
+JOURNAL_FILENAME = 'journal.%d'
+
+ENTER = '+'
+LEAVE = '-'
+
+class JournalState(State):
+    """
+    JournalState is a park state which remembers the changes made to it since it was last written.
+    """
+
+    def __init__(self, capacity, visitors):
+        super().__init__(capacity, visitors)
+        self.changes = []
+
+    def enter(self, visitor):
+        super().enter(visitor)
+        self.changes.append((ENTER, visitor))
+
+    def leave(self, visitor):
+        super().leave(visitor)
+        self.changes.append((LEAVE, visitor))
+
+    def apply(self, change):
+        operation, visitor = change
+
+        if operation == ENTER:
+            self.visitor_set[visitor] = None
+        else:
+            self.visitor_set.pop(visitor, None)
+
+    def rollback(self):
+        # undo the changes which were not written, newest first
+        for operation, visitor in reversed(self.changes):
+            self.apply((LEAVE if operation == ENTER else ENTER, visitor))
+
+        self.changes = []
+
+class JournalRepository:
+    """
+    JournalRepository keeps the park state in a directory as a snapshot and a journal of the visitors who
+    entered and left since the snapshot was taken.
+
+    Writing a state appends only its changes to the journal and syncs the journal once, so the cost of a
+    write depends on the number of changes and not on the number of visitors. The state is kept in memory
+    and reading it only replays the journal entries written since the last read. Once the journal has
+    compact_limit entries it is folded into a new snapshot, which replaces the old one atomically.
+    """
+
+    def __init__(self, dirname, compact_limit=10000):
+        self.dirname = dirname
+        self.compact_limit = compact_limit
+
+        self.state = None
+        self.generation = None # generation of the snapshot the journal belongs to
+        self.offset = 0 # position in the journal up to which it was replayed
+        self.journal_size = 0 # number of entries in the journal
+
+    def read_state(self):
+        if self.state is not None:
+            # the unwritten changes are undone before the changes of other writers are replayed on top
+            self.state.rollback()
+
+            if self.update_state():
+                return self.state
+
+        return self.load_state()
+
+    def write_state(self, state):
+        if state is not self.state:
+            # the state does not come from this repository, so it is written in full
+            self.write_snapshot(state)
+            return
+
+        if not state.changes:
+            return
+
+        data = ''.join('%s%s\n' % (operation, json.dumps(visitor)) for operation, visitor in state.changes)
+
+        with open(self.get_journal_path(self.generation), 'a') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+            self.offset = file.tell()
+
+        self.journal_size += len(state.changes)
+        state.changes = []
+
+        if self.journal_size >= self.compact_limit:
+            self.write_snapshot(state)
+
+    def delete_state(self):
+        os.remove(self.get_snapshot_path())
+
+        if self.generation is not None:
+            try:
+                os.remove(self.get_journal_path(self.generation))
+            except FileNotFoundError:
+                pass
+
+        self.state = None
+        self.generation = None
+
+    def load_state(self):
+        try:
+            with open(self.get_snapshot_path()) as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            self.state = None
+            return None
+
+        self.state = JournalState(data['capacity'], data['visitors'])
+        self.generation = data['generation']
+        self.offset = 0
+        self.journal_size = 0
+
+        # the journal is created with the snapshot, but a crash can happen in between
+        open(self.get_journal_path(self.generation), 'a').close()
+
+        self.update_state()
+        return self.state
+
+    def update_state(self):
+        # replay the journal entries written since the last read, possibly by another repository instance
+        try:
+            with open(self.get_journal_path(self.generation), 'rb+') as file:
+                if os.fstat(file.fileno()).st_size < self.offset:
+                    return False # the state was deleted and written again
+
+                file.seek(self.offset)
+                data = file.read()
+
+                # a crash during a write can leave an incomplete entry at the end, which is dropped
+                size = data.rfind(b'\n') + 1
+
+                if size < len(data):
+                    file.truncate(self.offset + size)
+        except FileNotFoundError:
+            return False # the journal was compacted into a new snapshot
+
+        for line in data[:size].decode('utf-8').splitlines():
+            self.state.apply((line[0], json.loads(line[1:])))
+            self.journal_size += 1
+
+        self.offset += size
+        return True
+
+    def write_snapshot(self, state):
+        os.makedirs(self.dirname, exist_ok=True)
+
+        previous_generation = self.read_generation()
+        generation = previous_generation + 1 if previous_generation is not None else 0
+
+        path = self.get_snapshot_path()
+        temporary_path = path + '.tmp'
+
+        with open(temporary_path, 'w') as file:
+            data = {'generation': generation, 'capacity': state.capacity, 'visitors': state.visitors}
+            json.dump(data, file)
+            file.flush()
+            os.fsync(file.fileno())
+
+        # the journal of the new snapshot exists before the snapshot does
+        open(self.get_journal_path(generation), 'w').close()
+
+        os.replace(temporary_path, path)
+        sync_directory(self.dirname)
+
+        if previous_generation is not None:
+            try:
+                os.remove(self.get_journal_path(previous_generation))
+            except FileNotFoundError:
+                pass
+
+        if state is not self.state:
+            state = JournalState(state.capacity, state.visitors)
+
+        self.state = state
+        self.generation = generation
+        self.offset = 0
+        self.journal_size = 0
+
+    def read_generation(self):
+        try:
+            with open(self.get_snapshot_path()) as file:
+                return json.load(file)['generation']
+        except FileNotFoundError:
+            return None
+
+    def get_snapshot_path(self):
+        return os.path.join(self.dirname, SNAPSHOT_FILENAME)
+
+    def get_journal_path(self, generation):
+        return os.path.join(self.dirname, JOURNAL_FILENAME % generation)
+
+def sync_directory(dirname):
+    # make the rename of a file in the directory durable
+    fd = os.open(dirname, os.O_RDONLY)
+
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,91 @@
+import pytest
+from amusementpark.journal_repository import JournalRepository, JOURNAL_FILENAME
+from amusementpark.visitor_repository import State
+
+def test_read_write_delete(tmpdir):
+    repository = JournalRepository(str(tmpdir))
+
+    assert repository.read_state() is None
+
+    repository.write_state(State(capacity=10, visitors=[1, 2, 3]))
+    assert repository.read_state() == State(capacity=10, visitors=[1, 2, 3])
+
+    repository.delete_state()
+    assert repository.read_state() is None
+
+def test_write_appends_changes(tmpdir):
+    repository = JournalRepository(str(tmpdir))
+    repository.write_state(State(capacity=10, visitors=[1, 2]))
+
+    state = repository.read_state()
+    state.enter(3)
+    state.leave(1)
+    repository.write_state(state)
+
+    assert tmpdir.join(JOURNAL_FILENAME % 0).read() == '+3\n-1\n'
+
+    # a new repository replays the journal on top of the snapshot
+    assert JournalRepository(str(tmpdir)).read_state() == State(capacity=10, visitors=[2, 3])
+
+def test_read_changes_of_other_repository(tmpdir):
+    repository = JournalRepository(str(tmpdir))
+    other_repository = JournalRepository(str(tmpdir))
+    repository.write_state(State(capacity=10, visitors=[]))
+
+    assert other_repository.read_state() == State(capacity=10, visitors=[])
+
+    state = repository.read_state()
+    state.enter(1)
+    repository.write_state(state)
+
+    assert other_repository.read_state() == State(capacity=10, visitors=[1])
+
+def test_unwritten_changes_are_discarded(tmpdir):
+    repository = JournalRepository(str(tmpdir))
+    repository.write_state(State(capacity=10, visitors=[1]))
+
+    state = repository.read_state()
+    state.enter(2)
+    state.leave(1)
+
+    assert repository.read_state() == State(capacity=10, visitors=[1])
+
+def test_unwritten_changes_are_discarded_before_other_changes(tmpdir):
+    repository = JournalRepository(str(tmpdir))
+    other_repository = JournalRepository(str(tmpdir))
+    repository.write_state(State(capacity=10, visitors=[]))
+
+    state = repository.read_state()
+    state.enter(5)
+
+    other_state = other_repository.read_state()
+    other_state.enter(5)
+    other_repository.write_state(other_state)
+
+    assert repository.read_state() == State(capacity=10, visitors=[5])
+
+def test_compact(tmpdir):
+    repository = JournalRepository(str(tmpdir), compact_limit=3)
+    repository.write_state(State(capacity=10, visitors=[]))
+
+    for visitor in range(4):
+        state = repository.read_state()
+        state.enter(visitor)
+        repository.write_state(state)
+
+    assert not tmpdir.join(JOURNAL_FILENAME % 0).exists()
+    assert tmpdir.join(JOURNAL_FILENAME % 1).read() == '+3\n'
+
+    other_repository = JournalRepository(str(tmpdir))
+    assert other_repository.read_state() == State(capacity=10, visitors=[0, 1, 2, 3])
+
+def test_incomplete_entry_is_dropped(tmpdir):
+    repository = JournalRepository(str(tmpdir))
+    repository.write_state(State(capacity=10, visitors=[]))
+    tmpdir.join(JOURNAL_FILENAME % 0).write('+1\n+2')
+
+    state = JournalRepository(str(tmpdir)).read_state()
+    assert state == State(capacity=10, visitors=[1])
+
+    with pytest.raises(AssertionError):
+        state.leave(2)
@@ -0,0 +1,154 @@
+import time
+from collections import deque
+from queue import Empty
+from threading import Condition, Lock
+
+class Lane:
+    """
+    Lane holds the messages of one priority in a message queue, together with their wait time statistics.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = deque() # pairs of the time the message was added and the message
+        self.skipped = 0 # number of times a higher priority lane was served while this lane had messages
+
+        self.message_count = 0
+        self.total_wait_time = 0
+        self.max_wait_time = 0
+
+    def take(self, now):
+        added, message = self.items.popleft()
+
+        wait_time = now - added
+        self.message_count += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+
+        return message
+
+    def get_stats(self):
+        return {
+            'depth': len(self.items),
+            'messages': self.message_count,
+            'mean_wait_time': self.total_wait_time / self.message_count if self.message_count else 0,
+            'max_wait_time': self.max_wait_time,
+        }
+
+class MessageQueue:
+    """
+    MessageQueue is a FIFO queue of messages which can hand out all waiting messages at once, so the lock is
+    taken once for a batch of messages instead of once for every message.
+
+    The queue can have several lanes ordered by priority, with classify returning the lane index for a
+    message. Messages are taken from the highest priority lane first, but a lane which was passed over
+    starvation_limit times is served next. Messages in the same lane keep their order.
+
+    The queue records how long messages waited in it and how large the batches taken from it were.
+    """
+
+    def __init__(self, lanes=('default',), classify=None, starvation_limit=16):
+        self.lanes = [Lane(name) for name in lanes]
+        self.classify = classify
+        self.starvation_limit = starvation_limit
+
+        self.size = 0
+        self.condition = Condition(Lock())
+        self.unfinished_count = 0
+
+        self.batch_count = 0
+        self.message_count = 0
+        self.max_batch_size = 0
+
+    def get_lane(self, message):
+        return self.lanes[self.classify(message)] if self.classify is not None else self.lanes[0]
+
+    def put(self, message):
+        with self.condition:
+            self.get_lane(message).items.append((time.monotonic(), message))
+            self.size += 1
+            self.unfinished_count += 1
+            self.condition.notify()
+
+    def put_many(self, messages):
+        if not messages:
+            return
+
+        now = time.monotonic()
+
+        with self.condition:
+            for message in messages:
+                self.get_lane(message).items.append((now, message))
+
+            self.size += len(messages)
+            self.unfinished_count += len(messages)
+            self.condition.notify()
+
+    def get(self, block=True, timeout=None):
+        return self.get_batch(1, block, timeout)[0]
+
+    def get_batch(self, max_count=None, block=True, timeout=None):
+        # wait until at least one message is available, then take up to max_count messages
+        with self.condition:
+            if not self.size:
+                if not block:
+                    raise Empty
+
+                if not self.condition.wait_for(lambda: self.size, timeout):
+                    raise Empty
+
+            count = self.size if max_count is None else min(max_count, self.size)
+            now = time.monotonic()
+
+            if len(self.lanes) == 1:
+                batch = [self.lanes[0].take(now) for _ in range(count)]
+            else:
+                batch = [self.select_lane().take(now) for _ in range(count)]
+
+            self.size -= count
+            self.batch_count += 1
+            self.message_count += count
+            self.max_batch_size = max(self.max_batch_size, count)
+
+            return batch
+
+    def select_lane(self):
+        # the highest priority lane is served first, unless a lower lane was passed over too many times
+        candidates = [lane for lane in self.lanes if lane.items]
+
+        for lane in reversed(candidates[1:]):
+            if lane.skipped >= self.starvation_limit:
+                lane.skipped = 0
+                return lane
+
+        for lane in candidates[1:]:
+            lane.skipped += 1
+
+        candidates[0].skipped = 0
+        return candidates[0]
+
+    def task_done(self, count=1):
+        with self.condition:
+            self.unfinished_count -= count
+
+    def qsize(self):
+        return self.size
+
+    def get_stats(self):
+        with self.condition:
+            total_wait_time = sum(lane.total_wait_time for lane in self.lanes)
+
+            stats = {
+                'depth': self.size,
+                'batches': self.batch_count,
+                'messages': self.message_count,
+                'mean_batch_size': self.message_count / self.batch_count if self.batch_count else 0,
+                'max_batch_size': self.max_batch_size,
+                'mean_wait_time': total_wait_time / self.message_count if self.message_count else 0,
+                'max_wait_time': max(lane.max_wait_time for lane in self.lanes),
+            }
+
+            if len(self.lanes) > 1:
+                stats['lanes'] = {lane.name: lane.get_stats() for lane in self.lanes}
+
+            return stats
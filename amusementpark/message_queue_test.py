@@ -0,0 +1,57 @@
+import pytest
+from queue import Empty
+from amusementpark.message_queue import MessageQueue
+
+def test_get():
+    queue = MessageQueue()
+    queue.put(1)
+    queue.put(2)
+
+    assert queue.get() == 1
+    assert queue.get(block=False) == 2
+
+    with pytest.raises(Empty):
+        queue.get(block=False)
+
+    with pytest.raises(Empty):
+        queue.get(timeout=0.01)
+
+def test_get_batch():
+    queue = MessageQueue()
+    queue.put_many([1, 2, 3])
+    queue.put(4)
+
+    assert queue.get_batch(3) == [1, 2, 3]
+    assert queue.get_batch() == [4]
+
+def test_stats():
+    queue = MessageQueue()
+    queue.put_many([1, 2, 3])
+    queue.get_batch(2)
+    queue.get_batch(2)
+
+    stats = queue.get_stats()
+
+    assert stats['depth'] == 0
+    assert stats['batches'] == 2
+    assert stats['messages'] == 3
+    assert stats['mean_batch_size'] == 1.5
+    assert stats['max_batch_size'] == 2
+    assert stats['max_wait_time'] >= stats['mean_wait_time'] >= 0
+
+def test_lanes():
+    queue = MessageQueue(lanes=('high', 'low'), classify=lambda message: 0 if message < 10 else 1)
+    queue.put_many([10, 11, 1, 12, 2])
+
+    assert queue.get_batch() == [1, 2, 10, 11, 12]
+
+    stats = queue.get_stats()
+    assert stats['lanes']['high']['messages'] == 2
+    assert stats['lanes']['low']['messages'] == 3
+
+def test_lanes_starvation():
+    queue = MessageQueue(lanes=('high', 'low'), classify=lambda message: 0 if message < 10 else 1,
+        starvation_limit=2)
+    queue.put_many([10, 11, 1, 2, 3, 4, 5, 6])
+
+    assert queue.get_batch() == [1, 2, 10, 3, 4, 11, 5, 6]
@@ -1,103 +1,520 @@
+import os
 import socket
-from threading import Thread
-import pickle
+import struct
+import time
+import itertools
+from collections import deque, OrderedDict
+from threading import Thread, Condition, Lock
 import logging
 
-from amusementpark.messages import NetworkMessage
-from amusementpark.node_info import NodeInfo
+from amusementpark.codec import CODEC_BINARY, BinaryCodec, CodecError, create_codec, encode_preamble, decode_preamble
 
 log = logging.getLogger('amusementpark.network')
 
 class Network:
-    def __init__(self, port, broker):
+    def __init__(self, port, broker, codec_id=CODEC_BINARY, connect_timeout=5, message_lifetime=30,
+            max_connections=256, idle_timeout=60, allow_pickle=False):
         self.port = port
         self.broker = broker
-        self.connections = {}
+        self.codec_id = codec_id # codec used for outgoing connections
+        self.allow_pickle = allow_pickle # accept connections using the pickle codec, only for trusted networks
+        self.connect_timeout = connect_timeout # seconds to wait for a connection to a node
+        self.message_lifetime = message_lifetime # seconds after which an unsent message is dropped
+        self.max_connections = max_connections # number of outgoing connections kept open
+        self.idle_timeout = idle_timeout # seconds after which an unused outgoing connection is closed
 
-    def run(self):
-        Thread(target=self.start_server).start()
-        Thread(target=self.send_messages).start()
+        self.lock = Lock()
+        self.peers = {} # outgoing message queue for each recipient
+        self.channels = {} # connections opened by nodes without a peer, used once a message is sent to the node
+        self.connections = OrderedDict() # peers with an open connection, least recently used first
+        self.reconnect_count = 0
+        self.eviction_count = 0
+
+    def run(self, daemon=False):
+        # without a port the network only connects to other nodes and receives replies on those connections
+        if self.port is not None:
+            Thread(target=self.start_server, daemon=daemon).start()
+
+        Thread(target=self.send_messages, daemon=daemon).start()
     
     def start_server(self):
         server = socket.socket()
         server.bind(('0.0.0.0', self.port))
         server.listen()
 
-        log.debug('Network %d start server' % self.port)
+        log.debug('Network %s start server' % self.port)
 
         while True:
             connection, address = server.accept()
             connection.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1) # send all data immediately
 
             _, port = address
-            log.debug('Network %d receive connection from %d' % (self.port, port))
+            log.debug('Network %s receive connection from %d' % (self.port, port))
             
-            thread = Thread(target=self.receive_messages, args=(connection, address))
+            thread = Thread(target=self.receive_messages, args=(connection, address), daemon=True)
             thread.start()
     
     def receive_messages(self, connection, address):
+        _, port = address
+        codec = None
+        senders = set() # nodes which can be answered through this connection
+
+        try:
+            for data in FrameReader(connection):
+                # the first frame on a connection selects the codec
+                if codec is None:
+                    codec = decode_preamble(data, self.allow_pickle)
+                    continue
+
+                message = codec.decode(data)
+
+                log.debug('Network %s received message from %d: %s' % (self.port, port, message))
+
+                if message.sender not in senders:
+                    senders.add(message.sender)
+                    self.add_channel(message.sender, connection)
+
+                self.broker.add_incoming_message(message)
+        except CodecError as error:
+            log.warning('Network %s refuse connection from %d: %s' % (self.port, port, error))
+        except OSError as error:
+            log.debug('Network %s connection from %d failed: %s' % (self.port, port, error))
+        finally:
+            log.debug('Network %s connection from %d closed' % (self.port, port))
+            self.remove_channels(senders, connection)
+            connection.close()
+
+    def send_messages(self):
+        # messages are only sorted into per-recipient queues here, each queue is sent from its own thread
         while True:
-            data = receive_data(connection)
-            message = parse_message(data)
+            messages = self.broker.get_outgoing_messages()
+            self.add_outgoing_messages(messages)
+            self.broker.finish_outgoing_message(len(messages))
 
-            _, port = address
-            log.debug('Network %d received message from %d: %s' % (self.port, port, message))
+    def add_outgoing_message(self, message):
+        self.add_outgoing_messages([message])
+
+    def add_outgoing_messages(self, messages):
+        # the lock makes sure no message is added to a peer which is being removed
+        with self.lock:
+            for message in messages:
+                self.get_peer(message.recipient).add_message(message)
+
+    def get_peer(self, node):
+        if node not in self.peers:
+            peer = self.create_peer(node)
+            channel = self.channels.pop(node, None)
+
+            if channel is not None:
+                peer.add_channel(channel)
+
+            peer.run()
+
+            self.peers[node] = peer
+
+        return self.peers[node]
+
+    def create_peer(self, node):
+        return Peer(self, node)
+
+    def add_channel(self, node, connection):
+        # messages to the node can be sent through a connection opened by the node, the peer and its thread are
+        # only created when a message is sent to the node
+        with self.lock:
+            if node in self.peers:
+                self.peers[node].add_channel(connection)
+            else:
+                self.channels[node] = connection
+
+    def remove_channels(self, nodes, connection):
+        with self.lock:
+            for node in nodes:
+                if self.channels.get(node) is connection:
+                    del self.channels[node]
+
+    def remove_peer(self, peer):
+        # called by an idle peer, which is only removed if no message was added in the meantime
+        with self.lock:
+            with peer.condition:
+                if peer.messages:
+                    return False
+
+                del self.peers[peer.node]
+                return True
+
+    def add_connection(self, peer):
+        with self.lock:
+            if peer.connect_count > 0:
+                self.reconnect_count += 1
+
+            self.connections[peer] = True
+
+            if len(self.connections) > self.max_connections:
+                self.evict_connection(peer)
+
+    def evict_connection(self, new_peer):
+        # close the least recently used connection which has no queued messages
+        for peer in self.connections:
+            if peer is not new_peer and not peer.messages:
+                peer.evict()
+                self.eviction_count += 1
+                return
+
+        log.warning('Network %s has more than %d connections' % (self.port, self.max_connections))
+
+    def remove_connection(self, peer):
+        with self.lock:
+            self.connections.pop(peer, None)
 
-            self.broker.add_incoming_message(message)
+    def use_connection(self, peer):
+        with self.lock:
+            if peer in self.connections:
+                self.connections.move_to_end(peer)
+
+    def get_stats(self):
+        return {
+            node.id: {
+                'queued': peer.get_queue_depth(),
+                'sent': peer.sent_count,
+                'dropped': peer.dropped_count,
+                'writes': peer.write_count,
+            }
+            for node, peer in list(self.peers.items())
+        }
+
+    def get_connection_stats(self):
+        return {
+            'open_connections': len(self.connections),
+            'reconnects': self.reconnect_count,
+            'evictions': self.eviction_count,
+        }
+
+class Peer:
+    """
+    Peer holds the outgoing messages for a single node and sends them from its own thread, so that a slow or
+    unreachable node does not delay messages to other nodes. Messages which cannot be sent within the
+    message lifetime of the network are dropped.
+
+    After a failed send the peer reconnects with exponential backoff. A peer which stays idle for the idle
+    timeout of the network closes its connection and stops.
+    """
+
+    RETRY_DELAY = 0.1 # seconds to wait after the first failed connection attempt
+    MAX_RETRY_DELAY = 5 # maximum seconds to wait between connection attempts
+    MAX_BATCH_SIZE = 512 # maximum number of queued messages written at once
+
+    def __init__(self, network, node):
+        self.network = network
+        self.node = node
+        self.connection = None
+        self.codec = None
+
+        self.messages = deque() # pairs of deadline and message
+        self.condition = Condition()
+
+        self.channel = None # connection opened by the node, used instead of connecting to it
+        self.evicted = False # set when the network wants to close the connection
+        self.failure_count = 0 # number of failed sends since the last successful one
+        self.connect_count = 0
+
+        self.sent_count = 0
+        self.dropped_count = 0
+        self.write_count = 0 # number of writes to the socket
+
+    def run(self):
+        Thread(target=self.send_messages, daemon=True).start()
+
+    def add_message(self, message):
+        with self.condition:
+            self.messages.append((time.monotonic() + self.network.message_lifetime, message))
+            self.condition.notify()
+
+    def get_queue_depth(self):
+        return len(self.messages)
+
+    def add_channel(self, connection):
+        # the channel is used the next time this peer needs a connection
+        with self.condition:
+            self.channel = connection
+
+    def evict(self):
+        with self.condition:
+            self.evicted = True
+            self.condition.notify()
 
     def send_messages(self):
         while True:
-            message = self.broker.get_outgoing_message()
-            
-            connection = self.get_connection(message.recipient)
-            data = serialize_message(message)
-            send_data(connection, data)
+            with self.condition:
+                timed_out = False
 
-            _, port = message.recipient.address
-            log.debug('Network %d send message to %d: %s' % (self.port, port, message))
-            
-            self.broker.finish_outgoing_message()
-    
-    def get_connection(self, node):
-        if node not in self.connections:
-            connection = socket.create_connection(node.address, timeout=10)
-            connection.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1) # send all data immediately
+                if not self.messages and not self.evicted:
+                    timed_out = not self.condition.wait(timeout=self.network.idle_timeout)
 
-            self.connections[node] = connection
+                has_messages = bool(self.messages)
+                evicted = self.evicted
+                self.evicted = False
+
+            if not has_messages:
+                if evicted:
+                    self.disconnect()
+                elif timed_out and self.network.remove_peer(self):
+                    self.disconnect()
+                    return
+
+                continue
+
+            messages = self.take_batch()
+
+            if not messages:
+                continue
+
+            try:
+                if self.connection is None:
+                    self.connect()
+
+                buffers, failed_count = self.encode_batch(messages)
+                self.write_count += send_buffers(self.connection, buffers)
+            except OSError as error:
+                # keep the messages and try again with a new connection until they expire
+                log.warning('Network %s cannot send to %d: %s' % (self.network.port, self.node.id, error))
+                self.disconnect()
+                self.failure_count += 1
+                time.sleep(self.get_retry_delay())
+                continue
+
+            self.failure_count = 0
+            self.network.use_connection(self)
+            self.finish_batch(messages, failed_count)
+
+            if failed_count:
+                # the codec state cannot be trusted after a failure, the next message starts a new connection
+                self.disconnect()
+
+    def get_retry_delay(self):
+        return min(Peer.RETRY_DELAY * 2 ** (self.failure_count - 1), Peer.MAX_RETRY_DELAY)
+
+    def take_batch(self):
+        # all messages which are already queued are sent together, except the ones which expired
+        now = time.monotonic()
+
+        with self.condition:
+            # messages have the same lifetime, so the expired ones are at the front of the queue
+            while self.messages and self.messages[0][0] < now:
+                self.drop_message('expired')
+
+            return [message for _, message in itertools.islice(self.messages, Peer.MAX_BATCH_SIZE)]
+
+    def encode_batch(self, messages):
+        buffers = []
+        failed_count = 0
+
+        for message in messages:
+            try:
+                data = self.codec.encode(message)
+            except CodecError as error:
+                log.warning('Network %s cannot encode message to %d: %s' % (self.network.port, self.node.id, error))
+                failed_count += 1
+                continue
+
+            buffers.append(len(data).to_bytes(INT_BYTE_LENGTH, byteorder='big'))
+            buffers.append(data)
+
+        return buffers, failed_count
+
+    def finish_batch(self, messages, failed_count):
+        with self.condition:
+            for _ in messages:
+                self.messages.popleft()
+
+        self.sent_count += len(messages) - failed_count
+        self.dropped_count += failed_count
+
+        for message in messages:
+            log.debug('Network %s send message to %d: %s' % (self.network.port, self.node.id, message))
+
+    def drop_message(self, reason):
+        with self.condition:
+            _, message = self.messages.popleft()
+
+        self.dropped_count += 1
+
+        log.warning('Network %s drop message to %d (%s): %s' % (self.network.port, self.node.id, reason, message))
+
+    def connect(self):
+        with self.condition:
+            channel = self.channel
+            self.channel = None
+
+        if channel is not None:
+            # answer on the connection opened by the node
+            connection = channel
+            set_send_timeout(connection, self.network.connect_timeout)
+
+            log.debug('Network %s reply to %d on its connection' % (self.network.port, self.node.id))
+        elif self.node.address is not None:
+            connection = socket.create_connection(self.node.address, timeout=self.network.connect_timeout)
+            connection.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1) # send all data immediately
+
+            # the timeout only applies to sending, as the connection is also read by another thread
+            connection.settimeout(None)
+            set_send_timeout(connection, self.network.connect_timeout)
+
+            # the node can answer on this connection as well
+            thread = Thread(target=self.network.receive_messages, args=(connection, self.node.address), daemon=True)
+            thread.start()
+
+            log.debug('Network %s connect to %d' % (self.network.port, self.node.id))
+        else:
+            raise ConnectionError('Node does not accept connections')
+
+        # tell the other side which codec will be used on this connection
+        send_data(connection, encode_preamble(self.network.codec_id))
+
+        self.connection = connection
+        self.codec = create_codec(self.network.codec_id)
+
+        self.network.add_connection(self)
+        self.connect_count += 1
+
+    def disconnect(self):
+        if self.connection is not None:
+            # close does not wake the thread reading from the connection, shutdown does and sends FIN
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+            self.connection.close()
+            self.connection = None
+            self.codec = None
+
+            self.network.remove_connection(self)
+
+# stateless codec for encoding single messages outside of a connection
+message_codec = BinaryCodec(node_table_size=0)
 
-            _, port = node.address
-            log.debug('Network %d connect to %d' % (self.port, port))
-        
-        return self.connections[node]
-    
 def parse_message(data):
-    return pickle.loads(data)
+    return message_codec.decode(data)
 
 def serialize_message(message):
-    assert isinstance(message, NetworkMessage)
-    return pickle.dumps(message)
+    return message_codec.encode(message)
 
 INT_BYTE_LENGTH = 4
+MAX_FRAME_SIZE = 16 * 1024 * 1024 # larger frames are refused, so that a peer cannot exhaust the memory
+
+def set_send_timeout(connection, timeout):
+    # limit how long a send can block without affecting receiving from the same connection
+    seconds = int(timeout)
+    microseconds = int((timeout - seconds) * 1e6)
+
+    try:
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, struct.pack('ll', seconds, microseconds))
+    except (AttributeError, OSError): # not supported on every platform
+        pass
 
 def send_data(connection, data_buffer):
     # first send the size of the data as a 4-byte integer, then send the data
     size_buffer = len(data_buffer).to_bytes(INT_BYTE_LENGTH, byteorder='big')
     connection.sendall(size_buffer + data_buffer)
 
-def receive_data(connection):
-    # first read four bytes from the socket
-    size_buffer = bytes()
+# maximum number of buffers in a single vectored write
+try:
+    MAX_WRITE_BUFFERS = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    MAX_WRITE_BUFFERS = 1024
 
-    while len(size_buffer) < INT_BYTE_LENGTH:
-        size_buffer += connection.recv(INT_BYTE_LENGTH - len(size_buffer))
-    
-    # then decode it into an integer specifying the size of the data in bytes
-    size = int.from_bytes(size_buffer, byteorder='big')
+def send_buffers(connection, buffers):
+    # write all buffers using as few system calls as possible, returns the number of calls
+    if not hasattr(connection, 'sendmsg'): # vectored writes are not available on every platform
+        connection.sendall(b''.join(buffers))
+        return 1
 
-    # read the specified amount of bytes
-    data_buffer = bytes()
-    
-    while len(data_buffer) < size:
-        data_buffer += connection.recv(size - len(data_buffer))
-    
-    return data_buffer
+    buffers = [memoryview(buffer) for buffer in buffers]
+    start = 0
+    write_count = 0
+
+    while start < len(buffers):
+        sent = connection.sendmsg(buffers[start:start + MAX_WRITE_BUFFERS])
+        write_count += 1
+
+        # skip the buffers which were sent completely and cut the one which was sent partially
+        while start < len(buffers) and sent >= len(buffers[start]):
+            sent -= len(buffers[start])
+            start += 1
+
+        if sent > 0:
+            buffers[start] = buffers[start][sent:]
+
+    return write_count
+
+class FrameReader:
+    """
+    FrameReader reads size-prefixed frames from a socket into a reusable buffer.
+
+    Iterating over the reader yields each frame as a memoryview into the buffer, which is only valid until
+    the next frame is requested. All complete frames delivered by a single read are yielded before reading
+    from the socket again. Iteration stops when the other side closes the connection, and CodecError is
+    raised for a frame larger than max_frame_size.
+    """
+
+    def __init__(self, connection, buffer_size=65536, max_frame_size=MAX_FRAME_SIZE):
+        self.connection = connection
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # start of the data which was not yet handed out
+        self.end = 0 # end of the data received so far
+
+    def __iter__(self):
+        while True:
+            frame = self.next_frame()
+
+            if frame is not None:
+                yield frame
+            elif not self.fill():
+                return
+
+    def next_frame(self):
+        available = self.end - self.start
+
+        if available < INT_BYTE_LENGTH:
+            return None
+
+        size = int.from_bytes(self.view[self.start:self.start + INT_BYTE_LENGTH], byteorder='big')
+
+        if size > self.max_frame_size:
+            raise CodecError('Frame of %d bytes is too large' % size)
+
+        if available < INT_BYTE_LENGTH + size:
+            return None
+
+        frame_start = self.start + INT_BYTE_LENGTH
+        self.start = frame_start + size
+        return self.view[frame_start:self.start]
+
+    def fill(self):
+        remaining = self.end - self.start
+
+        # move the incomplete frame to the beginning of the buffer
+        if self.start > 0:
+            self.buffer[:remaining] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = remaining
+
+        # grow the buffer if the incomplete frame does not fit into it
+        if remaining >= INT_BYTE_LENGTH:
+            required = INT_BYTE_LENGTH + int.from_bytes(self.view[:INT_BYTE_LENGTH], byteorder='big')
+
+            if required > len(self.buffer):
+                buffer = bytearray(required)
+                buffer[:remaining] = self.view[:remaining]
+                self.buffer = buffer
+                self.view = memoryview(buffer)
+
+        received = self.connection.recv_into(self.view[self.end:])
+
+        if received == 0: # the connection was closed
+            return False
+
+        self.end += received
+        return True
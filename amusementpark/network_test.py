@@ -1,6 +1,14 @@
-from amusementpark.network import serialize_message, parse_message
+import socket
+import pytest
+from threading import Thread
+from unittest.mock import Mock
+from amusementpark.broker import Broker
+from amusementpark.codec import CodecError, decode_preamble
+from amusementpark.network import Network, Peer, serialize_message, parse_message, send_data, send_buffers, \
+    FrameReader, INT_BYTE_LENGTH, MAX_WRITE_BUFFERS
 from amusementpark.messages import NetworkMessage
 from amusementpark.node_info import NodeInfo
+from helpers import get_free_port, wait_until
 
 def test_serialize():
     sender = NodeInfo(100, ('localhost', 3001), 4)
@@ -9,3 +17,214 @@ def test_serialize():
     message = NetworkMessage('test', sender, recipient, leader=leader)
 
     assert parse_message(serialize_message(message)) == message
+
+def test_frame_reader():
+    sender, receiver = socket.socketpair()
+    frames = [b'first', b'', b'x' * 100, b'last']
+
+    # all frames arrive in a single read
+    sender.sendall(b''.join(len(frame).to_bytes(INT_BYTE_LENGTH, byteorder='big') + frame for frame in frames))
+    sender.close()
+
+    assert [bytes(frame) for frame in FrameReader(receiver, buffer_size=16)] == frames
+
+def test_frame_reader_split_frames():
+    sender, receiver = socket.socketpair()
+    reader = iter(FrameReader(receiver, buffer_size=8))
+
+    send_data(sender, b'hello world')
+    assert bytes(next(reader)) == b'hello world'
+
+    data = len(b'abc').to_bytes(INT_BYTE_LENGTH, byteorder='big') + b'abc'
+    sender.sendall(data[:2])
+    sender.sendall(data[2:])
+    assert bytes(next(reader)) == b'abc'
+
+    sender.close()
+    assert list(reader) == []
+
+def test_frame_reader_refuses_large_frame():
+    sender, receiver = socket.socketpair()
+    sender.sendall((1024).to_bytes(INT_BYTE_LENGTH, byteorder='big'))
+
+    with pytest.raises(CodecError):
+        next(iter(FrameReader(receiver, max_frame_size=1000)))
+
+def test_unreachable_peer_does_not_block_others():
+    sender_port = get_free_port()
+    receiver_port = get_free_port()
+    unreachable_port = get_free_port() # nobody listens on this port
+
+    # brokers are not started, so messages stay in their queues
+    sender_broker = Broker(Mock())
+    receiver_broker = Broker(Mock())
+
+    Network(receiver_port, receiver_broker).run(daemon=True)
+    sender_network = Network(sender_port, sender_broker, message_lifetime=0.2)
+    sender_network.run(daemon=True)
+
+    sender = NodeInfo(100, ('localhost', sender_port), 4)
+    receiver = NodeInfo(200, ('localhost', receiver_port), 8)
+    unreachable = NodeInfo(300, ('localhost', unreachable_port), 3)
+
+    sender_broker.outgoing_messages.put(NetworkMessage('hello', sender, unreachable))
+    sender_broker.outgoing_messages.put(NetworkMessage('hello', sender, receiver))
+
+    assert receiver_broker.incoming_messages.get(timeout=5) == NetworkMessage('hello', sender, receiver)
+
+    wait_until(lambda: sender_network.get_stats()[300]['dropped'] == 1)
+
+    assert sender_network.get_stats() == {
+        200: {'queued': 0, 'sent': 1, 'dropped': 0, 'writes': 1},
+        300: {'queued': 0, 'sent': 0, 'dropped': 1, 'writes': 0},
+    }
+
+def test_send_buffers():
+    sender, receiver = socket.socketpair()
+    buffers = [str(i).encode() for i in range(MAX_WRITE_BUFFERS * 2 + 1)]
+    data = b''.join(buffers)
+
+    received = bytearray()
+    thread = Thread(target=lambda: received.extend(receiver.recv(len(data), socket.MSG_WAITALL)))
+    thread.start()
+
+    assert send_buffers(sender, buffers) >= 3
+    thread.join()
+
+    assert received == data
+
+def test_queued_messages_are_sent_together():
+    sender_port = get_free_port()
+    receiver_port = get_free_port()
+
+    receiver_broker = Broker(Mock())
+    Network(receiver_port, receiver_broker).run(daemon=True)
+
+    sender = NodeInfo(100, ('localhost', sender_port), 4)
+    receiver = NodeInfo(200, ('localhost', receiver_port), 8)
+    messages = [NetworkMessage('enter_response', sender, receiver, allowed=True) for _ in range(100)]
+
+    peer = Peer(Network(sender_port, Broker(Mock())), receiver)
+    peer.run()
+
+    # the first message waits until the receiver accepts connections
+    peer.add_message(messages[0])
+    assert receiver_broker.incoming_messages.get(timeout=5) == messages[0]
+    wait_until(lambda: peer.get_queue_depth() == 0)
+    write_count = peer.write_count
+
+    with peer.condition: # the messages are queued before the peer can take any of them
+        for message in messages:
+            peer.add_message(message)
+
+    assert [receiver_broker.incoming_messages.get(timeout=5) for _ in messages] == messages
+    wait_until(lambda: peer.get_queue_depth() == 0)
+    assert peer.write_count == write_count + 1
+
+def create_receivers(count, network_class=Network):
+    receivers = []
+
+    for i in range(count):
+        port = get_free_port()
+        broker = Broker(Mock())
+        network_class(port, broker).run(daemon=True)
+        receivers.append((NodeInfo(200 + i, ('localhost', port), 8), broker))
+
+    return receivers
+
+def test_idle_connection_is_closed():
+    [(receiver, receiver_broker)] = create_receivers(1)
+    sender = NodeInfo(100, ('localhost', get_free_port()), 4)
+
+    network = Network(sender.address[1], Broker(Mock()), idle_timeout=0.1)
+    network.add_outgoing_message(NetworkMessage('hello', sender, receiver))
+
+    assert receiver_broker.incoming_messages.get(timeout=5) == NetworkMessage('hello', sender, receiver)
+
+    wait_until(lambda: not network.peers)
+    assert network.get_connection_stats() == {'open_connections': 0, 'reconnects': 0, 'evictions': 0}
+
+def test_closed_connection_is_shut_down():
+    server = socket.socket()
+    server.bind(('localhost', 0))
+    server.listen()
+    receiver = NodeInfo(200, server.getsockname(), 8)
+    sender = NodeInfo(100, ('localhost', get_free_port()), 4)
+
+    network = Network(sender.address[1], Broker(Mock()), idle_timeout=0.1)
+    network.add_outgoing_message(NetworkMessage('hello', sender, receiver))
+
+    # the thread reading replies from the connection must not keep it open
+    connection, _ = server.accept()
+    connection.settimeout(5)
+    preamble, data = [bytes(frame) for frame in FrameReader(connection)]
+    assert decode_preamble(preamble).decode(data) == NetworkMessage('hello', sender, receiver)
+
+def test_least_recently_used_connection_is_evicted():
+    receivers = create_receivers(3)
+    sender = NodeInfo(100, ('localhost', get_free_port()), 4)
+
+    network = Network(sender.address[1], Broker(Mock()), max_connections=2)
+
+    for receiver, receiver_broker in receivers:
+        network.add_outgoing_message(NetworkMessage('hello', sender, receiver))
+        assert receiver_broker.incoming_messages.get(timeout=5) == NetworkMessage('hello', sender, receiver)
+
+    wait_until(lambda: len(network.connections) == 2)
+    assert network.peers[receivers[0][0]].connection is None
+    assert network.get_connection_stats()['evictions'] == 1
+
+def test_broken_connection_is_reconnected():
+    [(receiver, receiver_broker)] = create_receivers(1)
+    sender = NodeInfo(100, ('localhost', get_free_port()), 4)
+
+    network = Network(sender.address[1], Broker(Mock()))
+    network.add_outgoing_message(NetworkMessage('hello', sender, receiver, number=1))
+    assert receiver_broker.incoming_messages.get(timeout=5) == NetworkMessage('hello', sender, receiver, number=1)
+
+    network.peers[receiver].connection.shutdown(socket.SHUT_RDWR)
+
+    network.add_outgoing_message(NetworkMessage('hello', sender, receiver, number=2))
+    assert receiver_broker.incoming_messages.get(timeout=5) == NetworkMessage('hello', sender, receiver, number=2)
+
+    assert network.get_connection_stats() == {'open_connections': 1, 'reconnects': 1, 'evictions': 0}
+
+def test_reply_on_incoming_connection():
+    [(gate, gate_broker)] = create_receivers(1)
+    visitor = NodeInfo(2000, None, 1)
+
+    # the visitor has no server, so the gate has to answer on the connection opened by the visitor
+    visitor_broker = Broker(Mock())
+    Network(None, visitor_broker).run(daemon=True)
+
+    visitor_broker.outgoing_messages.put(NetworkMessage('enter_request', visitor, gate))
+    assert gate_broker.incoming_messages.get(timeout=5) == NetworkMessage('enter_request', visitor, gate)
+
+    gate_broker.outgoing_messages.put(NetworkMessage('enter_response', gate, visitor, allowed=True))
+    assert visitor_broker.incoming_messages.get(timeout=5) == \
+        NetworkMessage('enter_response', gate, visitor, allowed=True)
+
+def test_incoming_connection_starts_no_peer():
+    port = get_free_port()
+    gate_broker = Broker(Mock())
+    gate_network = Network(port, gate_broker)
+    gate_network.run(daemon=True)
+
+    gate = NodeInfo(200, ('localhost', port), 8)
+    visitor = NodeInfo(2000, None, 1)
+    visitor_broker = Broker(Mock())
+    Network(None, visitor_broker).run(daemon=True)
+
+    visitor_broker.outgoing_messages.put(NetworkMessage('enter_request', visitor, gate))
+    assert gate_broker.incoming_messages.get(timeout=5) == NetworkMessage('enter_request', visitor, gate)
+
+    # the connection is only remembered until the gate answers the visitor
+    assert gate_network.peers == {}
+    assert list(gate_network.channels) == [visitor]
+
+    gate_broker.outgoing_messages.put(NetworkMessage('enter_response', gate, visitor, allowed=True))
+    assert visitor_broker.incoming_messages.get(timeout=5) == \
+        NetworkMessage('enter_response', gate, visitor, allowed=True)
+
+    assert list(gate_network.peers) == [visitor]
+    assert gate_network.channels == {}
@@ -0,0 +1,300 @@
+from collections import Counter, defaultdict
+import heapq
+import itertools
+import math
+import random
+
+from amusementpark.broker import TICK_MESSAGE
+from amusementpark.gate_node import GateNode
+from amusementpark.messages import NetworkMessage
+from amusementpark.node_info import NodeInfo
+from amusementpark.visitor_repository import State, SyncStateWriter
+
+# responses matched with the requests of visitors to measure the admission latency
+REQUEST_TYPES = {'enter_response': 'enter_request', 'leave_response': 'leave_request'}
+
+class Link:
+    """
+    Link describes how messages travel between two nodes. Every message takes latency seconds plus a random
+    jitter of up to jitter seconds and is lost with the probability loss. Messages on a link keep their order
+    like on a TCP connection, unless reorder is set and the jitter lets them overtake each other.
+    """
+
+    def __init__(self, latency=0.001, jitter=0, loss=0, reorder=False):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+
+class MemoryRepository:
+    """
+    MemoryRepository keeps the park state in memory, so that simulated gates do not touch the disk.
+    """
+
+    def __init__(self, state=None):
+        self.state = None
+
+        if state is not None:
+            self.write_state(state)
+
+    def read_state(self):
+        if self.state is None:
+            return None
+
+        return State(self.state.capacity, self.state.visitors)
+
+    def write_state(self, state):
+        self.state = State(state.capacity, state.visitors)
+
+    def delete_state(self):
+        self.state = None
+
+class Simulator:
+    """
+    Simulator runs nodes in a single thread on a simulated clock.
+
+    Messages yielded by the nodes are put into a priority queue ordered by the time they arrive, which depends
+    on the link between the sender and the recipient. A node processes one message at a time and is busy for
+    processing_time seconds with every message, so messages wait for busy nodes. All random choices come from
+    a generator seeded with seed, so a simulation is repeated exactly with the same seed.
+
+    Messages to recipients which are not simulated nodes are only counted. Requests of visitors are added with
+    a workload, which is an iterator of (time, message) pairs ordered by time, so that millions of visitors
+    are simulated without a node for each of them. The time between a request and its response is recorded
+    for each gate.
+    """
+
+    def __init__(self, seed=0, link=None, processing_time=0, tick_interval=None):
+        self.random = random.Random(seed)
+        self.default_link = link if link is not None else Link()
+        self.processing_time = processing_time
+        self.tick_interval = tick_interval # seconds between ticks passed to every node
+
+        self.now = 0
+        self.nodes = {}
+        self.links = {}
+        self.events = [] # (time, sequence, node id, message)
+        self.sequence = itertools.count() # keeps the order of events with the same time
+        self.pending = 0 # events other than ticks
+        self.stopped = set() # nodes which will not process any more messages
+        self.busy_until = {} # time when each node finishes processing its last message
+        self.last_arrival = {} # arrival time of the last message on each link
+        self.workload = iter(())
+        self.next_request = None
+
+        # metrics
+        self.sent = Counter() # messages of each type
+        self.dropped = Counter() # lost messages of each type
+        self.received = Counter() # messages received by each node
+        self.processed_count = 0
+        self.request_times = {} # (visitor id, request type) of requests waiting for a response
+        self.latencies = defaultdict(list) # (request type, gate id) to the latencies of the requests
+
+    def clock(self):
+        # passed to the nodes instead of the real clock
+        return self.now
+
+    def add_node(self, node):
+        self.nodes[node.info.id] = node
+
+        if self.tick_interval is not None:
+            self.push(self.tick_interval * self.random.random(), node.info.id, TICK_MESSAGE)
+
+    def create_gates(self, topology, repository, admission=GateNode.ADMISSION_SERVICE, first_id=100, **options):
+        # creates a gate for every node of the topology, with a random capacity
+        # the leader writes the state at once instead of from a thread, which would not follow the simulated clock
+        options.setdefault('writer', SyncStateWriter)
+        infos = {name: NodeInfo(first_id + i, None, self.random.randint(1, 1000)) for i, name in enumerate(topology)}
+        gates = []
+
+        for name, info in infos.items():
+            neighbours = [infos[neighbour] for neighbour in sorted(topology[name])]
+            gate = GateNode(info, neighbours, repository, admission, clock=self.clock, **options)
+            self.add_node(gate)
+            gates.append(gate)
+
+        return gates
+
+    def set_link(self, a, b, link):
+        # the link is used in both directions
+        self.links[a.id, b.id] = link
+        self.links[b.id, a.id] = link
+
+    def get_link(self, sender, recipient):
+        return self.links.get((sender.id, recipient.id), self.default_link)
+
+    def add_workload(self, workload):
+        self.workload = iter(workload)
+        self.next_request = next(self.workload, None)
+
+    def schedule(self, node, message, delay=0):
+        # passes a local message to the node after the delay
+        self.push(self.now + delay, node.id, message)
+
+    def send(self, message, time=None):
+        time = self.now if time is None else time
+        self.sent[message.type] += 1
+
+        if message.recipient is None:
+            self.dropped[message.type] += 1
+            return
+
+        if message.type in REQUEST_TYPES.values():
+            self.request_times[message.sender.id, message.type] = time
+
+        link = self.get_link(message.sender, message.recipient)
+
+        if link.loss and self.random.random() < link.loss:
+            self.dropped[message.type] += 1
+            return
+
+        arrival_time = time + link.latency
+
+        if link.jitter:
+            arrival_time += self.random.uniform(0, link.jitter)
+
+        if not link.reorder:
+            key = message.sender.id, message.recipient.id
+            arrival_time = max(arrival_time, self.last_arrival.get(key, 0))
+            self.last_arrival[key] = arrival_time
+
+        self.push(arrival_time, message.recipient.id, message)
+
+    def push(self, time, node_id, message):
+        if message is not TICK_MESSAGE:
+            self.pending += 1
+
+        heapq.heappush(self.events, (time, next(self.sequence), node_id, message))
+
+    def run(self, until=None):
+        # runs until only ticks are left, or until the given time
+        while True:
+            if self.next_request is not None and (not self.events or self.next_request[0] <= self.events[0][0]):
+                if until is not None and self.next_request[0] > until:
+                    break
+
+                time, message = self.next_request
+                self.next_request = next(self.workload, None)
+                self.send(message, time)
+                continue
+
+            if not self.events or (until is None and self.pending == 0 and self.next_request is None):
+                break
+
+            if until is not None and self.events[0][0] > until:
+                break
+
+            time, _, node_id, message = heapq.heappop(self.events)
+
+            if message is not TICK_MESSAGE:
+                self.pending -= 1
+
+            self.now = max(self.now, time)
+            self.deliver(node_id, message)
+
+        if until is not None:
+            self.now = max(self.now, until)
+
+    def deliver(self, node_id, message):
+        node = self.nodes.get(node_id)
+
+        if node is not None and self.processing_time:
+            # the message waits until the node finished the previous one
+            busy_until = self.busy_until.get(node_id, 0)
+
+            if busy_until > self.now:
+                self.push(busy_until, node_id, message)
+                return
+
+            self.busy_until[node_id] = self.now + self.processing_time
+
+        if message is TICK_MESSAGE:
+            if node_id not in self.stopped:
+                self.push(self.now + self.tick_interval, node_id, TICK_MESSAGE)
+        else:
+            self.received[node_id] += 1
+
+        if message.type in REQUEST_TYPES:
+            request_time = self.request_times.pop((node_id, REQUEST_TYPES[message.type]), None)
+
+            if request_time is not None:
+                self.latencies[REQUEST_TYPES[message.type], message.sender.id].append(self.now - request_time)
+
+        if node is None or node_id in self.stopped:
+            return
+
+        self.processed_count += 1
+        send_time = self.now + self.processing_time
+
+        for outgoing_message in node.process_message(message):
+            if outgoing_message is None: # the node will not send any more messages
+                self.stopped.add(node_id)
+                break
+
+            self.send(outgoing_message, send_time)
+
+    def get_latencies(self, request_type=None, gate=None):
+        return [
+            latency
+            for (latency_request_type, gate_id), latencies in self.latencies.items()
+            if request_type in (None, latency_request_type) and (gate is None or gate.id == gate_id)
+            for latency in latencies
+        ]
+
+    def get_stats(self):
+        enter_latencies = self.get_latencies('enter_request')
+
+        return {
+            'time': self.now,
+            'processed': self.processed_count,
+            'sent': sum(self.sent.values()),
+            'dropped': sum(self.dropped.values()),
+            'enter_latency_p50': percentile(enter_latencies, 50),
+            'enter_latency_p99': percentile(enter_latencies, 99),
+        }
+
+def percentile(values, p):
+    # nearest-rank percentile, None without values
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[max(math.ceil(len(values) * p / 100) - 1, 0)]
+
+def create_visitor_workload(gates, visitor_count, rate, stay, start=0, rng=random, first_id=1000000):
+    # visitors arrive at random gates rate times a second and leave through a random gate after stay seconds
+    # on average, the requests are ordered by time and visitors who were not let in ask to leave as well
+    leaving = [] # (time, visitor id) of visitors who will leave
+    time = start
+
+    for visitor_id in range(first_id, first_id + visitor_count):
+        time += rng.expovariate(rate)
+
+        while leaving and leaving[0][0] <= time:
+            leave_time, leaving_id = heapq.heappop(leaving)
+            yield leave_time, NetworkMessage('leave_request', NodeInfo(leaving_id, None, 1), rng.choice(gates).info)
+
+        yield time, NetworkMessage('enter_request', NodeInfo(visitor_id, None, 1), rng.choice(gates).info)
+        heapq.heappush(leaving, (time + rng.expovariate(1 / stay), visitor_id))
+
+    while leaving:
+        leave_time, leaving_id = heapq.heappop(leaving)
+        yield leave_time, NetworkMessage('leave_request', NodeInfo(leaving_id, None, 1), rng.choice(gates).info)
+
+def create_topology(gate_count, degree, rng=random):
+    # a random tree connects all gates, the other edges are added between random gates
+    edges = {(rng.randrange(i), i) for i in range(1, gate_count)}
+
+    while len(edges) < gate_count * degree // 2:
+        a, b = rng.sample(range(gate_count), 2)
+
+        if (b, a) not in edges:
+            edges.add((a, b))
+
+    neighbours = {i: set() for i in range(gate_count)}
+
+    for a, b in edges:
+        neighbours[a].add(b)
+        neighbours[b].add(a)
+
+    return neighbours
@@ -0,0 +1,139 @@
+import random
+import threading
+from amusementpark.gate_node import GateNode
+from amusementpark.messages import NetworkMessage, LocalMessage
+from amusementpark.node_info import NodeInfo
+from amusementpark.simulator import Simulator, Link, MemoryRepository, create_topology, create_visitor_workload, \
+    percentile
+from amusementpark.visitor_repository import State
+
+visitors = [NodeInfo(2000 + i, None, 1) for i in range(3)]
+
+def run_election(seed, admission=GateNode.ADMISSION_SERVICE):
+    simulator = Simulator(seed=seed, link=Link(latency=0.01, jitter=0.005))
+    repository = MemoryRepository(State(capacity=2, visitors=[]))
+    gates = simulator.create_gates(create_topology(20, 3, random.Random(seed)), repository, admission)
+
+    simulator.schedule(gates[0].info, LocalMessage('start_election'))
+    simulator.run()
+
+    return simulator, gates
+
+def test_election():
+    simulator, gates = run_election(seed=1)
+
+    leader = max(gates, key=lambda gate: gate.info.capacity).info
+    assert all(gate.state == GateNode.STATE_IDLE and gate.leader == leader for gate in gates)
+    assert simulator.sent['election_started'] == simulator.sent['election_voted']
+
+def test_same_seed_same_simulation():
+    first, _ = run_election(seed=1)
+    second, _ = run_election(seed=1)
+    other, _ = run_election(seed=2)
+
+    assert (first.now, first.sent) == (second.now, second.sent)
+    assert first.now != other.now
+
+def test_admission_latency():
+    simulator, gates = run_election(seed=1)
+    start = simulator.now
+
+    simulator.add_workload([
+        (start + i, NetworkMessage('enter_request', visitor, gates[i].info))
+        for i, visitor in enumerate(visitors)
+    ])
+    simulator.run()
+
+    # the third visitor does not fit into the park, but it gets an answer as well
+    assert simulator.sent['enter_response'] == 3
+    assert len(simulator.get_latencies('enter_request')) == 3
+    assert simulator.get_latencies('enter_request', gates[0].info)[0] >= 0.02
+    assert simulator.request_times == {}
+
+class Recorder:
+    # node which remembers when it received messages
+    def __init__(self, info, simulator):
+        self.info = info
+        self.simulator = simulator
+        self.times = []
+
+    def process_message(self, message):
+        self.times.append(self.simulator.now)
+        return []
+
+def test_no_threads_are_started():
+    threads = threading.active_count()
+    simulator, gates = run_election(seed=1)
+
+    simulator.add_workload([(simulator.now, NetworkMessage('enter_request', visitors[0], gates[0].info))])
+    simulator.run()
+
+    # the leader writes the state at once, so the repository is up to date when the simulation ends
+    assert simulator.sent['enter_response'] == 1
+    assert gates[0].repository.read_state().visitors == [visitors[0].id]
+    assert threading.active_count() == threads
+
+def test_escrow_with_loss():
+    rng = random.Random(1)
+    simulator = Simulator(seed=1, link=Link(latency=0.001), tick_interval=0.1)
+    repository = MemoryRepository(State(capacity=50, visitors=[]))
+    gates = simulator.create_gates(create_topology(20, 3, rng), repository, GateNode.ADMISSION_ESCROW)
+
+    simulator.schedule(gates[0].info, LocalMessage('start_election'))
+    simulator.run()
+
+    # the park is full most of the time, so the leader keeps revoking slots while messages are lost
+    simulator.default_link.loss = 0.05
+    simulator.add_workload(create_visitor_workload(gates, 1000, 1000, 0.2, simulator.now, rng))
+    simulator.run(until=simulator.now + 10)
+
+    [leader] = [gate for gate in gates if gate.leader == gate.info]
+    assert simulator.dropped['escrow_revoked'] + simulator.dropped['escrow_returned'] > 0
+    assert leader.revoking == {} and leader.waiting_batches == []
+    assert all(gate.admission_batch is None for gate in gates)
+
+    # only the requests whose own message or answer was lost stay unanswered
+    assert len(simulator.get_latencies('enter_request')) > 850
+
+def test_processing_time():
+    simulator = Simulator(link=Link(latency=1), processing_time=2)
+    gate = GateNode(NodeInfo(100, None, 1), [], MemoryRepository(), clock=simulator.clock)
+    recorder = Recorder(visitors[0], simulator)
+    simulator.add_node(gate)
+    simulator.add_node(recorder)
+
+    simulator.send(NetworkMessage('hello', visitors[0], gate.info))
+    simulator.send(NetworkMessage('hello', visitors[0], gate.info))
+    simulator.run()
+
+    # the second message waits until the gate finished the first one
+    assert recorder.times == [4, 6]
+
+def test_loss():
+    simulator = Simulator(link=Link(loss=1))
+    simulator.send(NetworkMessage('hello', visitors[0], visitors[1]))
+    simulator.run()
+
+    assert simulator.dropped['hello'] == 1
+    assert simulator.events == []
+
+def test_reorder():
+    simulator = Simulator(seed=3, link=Link(latency=0, jitter=1))
+    arrivals = []
+
+    for i in range(20):
+        simulator.send(NetworkMessage('hello', visitors[0], visitors[1], number=i))
+
+    while simulator.events:
+        arrivals.append(simulator.events.pop(0))
+
+    # without reorder, messages on a link keep their order
+    times = [time for time, _, _, _ in sorted(arrivals)]
+    numbers = [message.payload['number'] for _, _, _, message in sorted(arrivals)]
+    assert numbers == list(range(20))
+    assert times == sorted(times)
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([3, 1, 2, 4], 50) == 2
+    assert percentile([3, 1, 2, 4], 99) == 4
@@ -0,0 +1,134 @@
+import sqlite3
+
+from amusementpark.visitor_repository import State
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS park (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    capacity INTEGER NOT NULL,
+    count INTEGER NOT NULL CHECK (count >= 0 AND count <= capacity)
+);
+CREATE TABLE IF NOT EXISTS visitors (
+    id INTEGER PRIMARY KEY
+);
+'''
+
+class SQLiteState(State):
+    """
+    SQLiteState is a park state read from a SQLite repository. The visitors who enter and leave are checked
+    against the database and kept in memory until the state is written, so no transaction is open while the
+    state is changed.
+    """
+
+    def __init__(self, connection, capacity, count):
+        self.connection = connection
+        self.capacity = capacity
+        self.stored_count = count # number of visitors in the database
+        self.changes = {} # visitors who entered (True) or left (False) since the state was written
+
+    @property
+    def visitors(self):
+        # the visitors are ordered by their id and not by the order in which they entered
+        visitors = {visitor for visitor, in self.connection.execute('SELECT id FROM visitors')}
+        visitors.update(visitor for visitor, entered in self.changes.items() if entered)
+        visitors.difference_update(visitor for visitor, entered in self.changes.items() if not entered)
+
+        return sorted(visitors)
+
+    @property
+    def count(self):
+        return self.stored_count + sum(1 if entered else -1 for entered in self.changes.values())
+
+    def enter(self, visitor):
+        assert visitor not in self
+        assert self.count < self.capacity
+        self.change(visitor, True)
+
+    def leave(self, visitor):
+        assert visitor in self
+        self.change(visitor, False)
+
+    def change(self, visitor, entered):
+        # a visitor who leaves after entering, or the other way round, is not changed in the database
+        if visitor in self.changes:
+            del self.changes[visitor]
+        else:
+            self.changes[visitor] = entered
+
+    def __contains__(self, visitor):
+        if visitor in self.changes:
+            return self.changes[visitor]
+
+        return self.connection.execute('SELECT 1 FROM visitors WHERE id = ?', (visitor,)).fetchone() is not None
+
+class SQLiteRepository:
+    """
+    SQLiteRepository keeps the park state in a SQLite database in WAL mode.
+
+    Reading the state only reads the capacity and the number of visitors. The visitors who enter and leave
+    are checked against the database and written in a single transaction when the state is written, so the
+    cost of a grant does not depend on the number of visitors in the park and the database is only locked
+    while the state is written. The constraints of the tables check the changes once more, in case another
+    process changed the database in the meantime.
+    """
+
+    def __init__(self, filename):
+        # the repository is shared by the gate nodes, which hold the mutex while using it
+        self.connection = sqlite3.connect(str(filename), isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = FULL')
+        self.connection.executescript(SCHEMA)
+
+    def read_state(self):
+        row = self.connection.execute('SELECT capacity, count FROM park').fetchone()
+
+        if row is None:
+            return None
+
+        capacity, count = row
+        return SQLiteState(self.connection, capacity, count)
+
+    def write_state(self, state):
+        if isinstance(state, SQLiteState) and state.connection is self.connection:
+            self.write_changes(state)
+            return
+
+        # the state does not come from this repository, so it replaces the stored state
+        visitors = state.visitors
+
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('DELETE FROM visitors')
+            self.connection.executemany('INSERT INTO visitors (id) VALUES (?)', ((visitor,) for visitor in visitors))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO park (id, capacity, count) VALUES (0, ?, ?)',
+                (state.capacity, len(visitors)))
+
+    def write_changes(self, state):
+        if not state.changes:
+            return
+
+        entered = [(visitor,) for visitor, entered in state.changes.items() if entered]
+        left = [(visitor,) for visitor, entered in state.changes.items() if not entered]
+
+        try:
+            with self.connection:
+                self.connection.execute('BEGIN IMMEDIATE')
+                cursor = self.connection.executemany('DELETE FROM visitors WHERE id = ?', left)
+
+                if cursor.rowcount != len(left):
+                    raise AssertionError('Visitor not found')
+
+                self.connection.executemany('INSERT INTO visitors (id) VALUES (?)', entered)
+                self.connection.execute('UPDATE park SET count = count + ?', (len(entered) - len(left),))
+        except sqlite3.IntegrityError as error:
+            raise AssertionError(str(error))
+
+        state.stored_count += len(entered) - len(left)
+        state.changes = {}
+
+    def delete_state(self):
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('DELETE FROM visitors')
+            self.connection.execute('DELETE FROM park')
@@ -0,0 +1,86 @@
+import pytest
+from amusementpark.sqlite_repository import SQLiteRepository
+from amusementpark.visitor_repository import State
+
+def test_read_write_delete(tmpdir):
+    repository = SQLiteRepository(tmpdir.join('repository.db'))
+
+    assert repository.read_state() is None
+
+    repository.write_state(State(capacity=10, visitors=[1, 2, 3]))
+    assert repository.read_state() == State(capacity=10, visitors=[1, 2, 3])
+
+    repository.delete_state()
+    assert repository.read_state() is None
+
+def test_enter_and_leave(tmpdir):
+    filename = tmpdir.join('repository.db')
+    repository = SQLiteRepository(filename)
+    repository.write_state(State(capacity=2, visitors=[100]))
+
+    state = repository.read_state()
+
+    with pytest.raises(AssertionError):
+        state.enter(100)
+
+    state.enter(200)
+
+    with pytest.raises(AssertionError):
+        state.enter(300)
+
+    with pytest.raises(AssertionError):
+        state.leave(300)
+
+    state.leave(100)
+    repository.write_state(state)
+
+    state = SQLiteRepository(filename).read_state()
+    assert state == State(capacity=2, visitors=[200])
+    assert state.count == 1
+    assert 200 in state
+
+def test_unwritten_changes_are_discarded(tmpdir):
+    repository = SQLiteRepository(tmpdir.join('repository.db'))
+    repository.write_state(State(capacity=10, visitors=[1]))
+
+    state = repository.read_state()
+    state.enter(2)
+    state.leave(1)
+
+    assert repository.read_state() == State(capacity=10, visitors=[1])
+
+def test_read_state_does_not_lock_database(tmpdir):
+    filename = tmpdir.join('repository.db')
+    repository = SQLiteRepository(filename)
+    repository.write_state(State(capacity=10, visitors=[1]))
+
+    state = repository.read_state()
+    state.enter(2)
+
+    # another process can write while the state is changed
+    other_repository = SQLiteRepository(filename)
+    other_state = other_repository.read_state()
+    other_state.enter(3)
+    other_repository.write_state(other_state)
+
+    repository.write_state(state)
+    assert repository.read_state() == State(capacity=10, visitors=[1, 2, 3])
+    assert repository.read_state().count == 3
+
+def test_conflicting_changes_are_refused(tmpdir):
+    filename = tmpdir.join('repository.db')
+    repository = SQLiteRepository(filename)
+    repository.write_state(State(capacity=10, visitors=[1]))
+
+    state = repository.read_state()
+    state.leave(1)
+
+    other_repository = SQLiteRepository(filename)
+    other_state = other_repository.read_state()
+    other_state.leave(1)
+    other_repository.write_state(other_state)
+
+    with pytest.raises(AssertionError):
+        repository.write_state(state)
+
+    assert repository.read_state() == State(capacity=10, visitors=[])
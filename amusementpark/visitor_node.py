@@ -1,25 +1,19 @@
+from amusementpark.dispatch import Dispatcher, handles
 from amusementpark.messages import NetworkMessage
 
-class VisitorNode:
+class VisitorNode(Dispatcher):
     STATE_IDLE = 'idle' # no task is in progress
     STATE_ENTERING = 'entering' # waiting for enter response
     STATE_ENTERED = 'entered' # received enter response allowing the entry
     STATE_LEAVING = 'leaving' # waiting for leave response
 
     def __init__(self, info):
+        super().__init__()
+
         self.info = info
         self.state = VisitorNode.STATE_IDLE
     
-    def process_message(self, message):
-        if message.type == 'enter_park':
-            yield from self.enter_park(message)
-        elif message.type == 'leave_park':
-            yield from self.leave_park(message)
-        elif message.type == 'enter_response':
-            self.process_enter_response(message)
-        elif message.type == 'leave_response':
-            self.process_leave_response(message)
-    
+    @handles('enter_park')
     def enter_park(self, message):
         gate = message.payload['gate']
 
@@ -29,6 +23,7 @@ class VisitorNode:
         else:
             self.handle_unexpected_state()
 
+    @handles('leave_park')
     def leave_park(self, message):
         gate = message.payload['gate']
 
@@ -38,6 +33,7 @@ class VisitorNode:
         else:
             self.handle_unexpected_state()
     
+    @handles('enter_response')
     def process_enter_response(self, message):
         allowed = message.payload['allowed']
 
@@ -49,6 +45,7 @@ class VisitorNode:
         else:
             self.handle_unexpected_state()
 
+    @handles('leave_response')
     def process_leave_response(self, message):
         allowed = message.payload['allowed']
 
@@ -1,20 +1,40 @@
 import os
 import json
 import collections
+from threading import Thread, Condition, Lock
+import logging
+
+log = logging.getLogger('amusementpark.visitor_repository')
 
 class State:
+    """
+    State of the park. Visitors are kept in a dictionary used as an ordered set, so entering, leaving and
+    counting visitors takes constant time while the visitor list keeps the order in which visitors entered.
+    """
+
     def __init__(self, capacity, visitors):
         self.capacity = capacity
-        self.visitors = visitors
-    
+        self.visitor_set = dict.fromkeys(visitors)
+
+    @property
+    def visitors(self):
+        return list(self.visitor_set)
+
+    @property
+    def count(self):
+        return len(self.visitor_set)
+
     def enter(self, visitor):
-        assert visitor not in self.visitors
-        assert len(self.visitors) < self.capacity
-        self.visitors.append(visitor)
+        assert visitor not in self.visitor_set
+        assert len(self.visitor_set) < self.capacity
+        self.visitor_set[visitor] = None
     
     def leave(self, visitor):
-        assert visitor in self.visitors
-        self.visitors.remove(visitor)
+        assert visitor in self.visitor_set
+        del self.visitor_set[visitor]
+
+    def __contains__(self, visitor):
+        return visitor in self.visitor_set
     
     def __eq__(self, other):
         if isinstance(other, State):
@@ -23,21 +43,170 @@ class State:
             return super().__eq__(other)
 
 class Repository:
+    """
+    Repository keeps the park state in a JSON file.
+
+    The state read last is cached together with the inode, modification time and size of the file, and it
+    is returned again while the file keeps the same stamp. A state which was read is changed by the caller
+    until it is written back, so the cache is only used for the next read after a write.
+
+    Another process can replace the file within the resolution of the modification time and keep the stamp,
+    so every write also stores a random generation in a file next to it. The state file keeps only the
+    capacity and the visitors, so it can still be read by older versions. The generation is written before
+    the state, and the cache is only used when the generation read is still the one written last.
+    """
+
     def __init__(self, filename):
         self.filename = filename
+        self.generation_filename = str(filename) + '.generation'
+
+        self.cached_state = None
+        self.cached_stamp = None
+        self.cached_generation = None # generation of the file written last
+
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def read_state(self):
+        stamp = self.get_stamp()
+
+        if stamp is not None and stamp == self.cached_stamp and self.read_generation() == self.cached_generation:
+            self.cache_hits += 1
+            state = self.cached_state
+        else:
+            self.cache_misses += 1
+
+            try:
+                with open(self.filename) as file:
+                    data = json.load(file)
+                    data.pop('generation', None) # stored in the state file by earlier versions
+                    state = State(**data)
+            except FileNotFoundError:
+                return None
+
+        self.cached_state = state
+        self.cached_stamp = None # the state is not valid until it is written
+        return state
+
+    def write_state(self, state):
+        # the new file replaces the old one, so the stamp changes even if the size and time stay the same
+        temporary_filename = str(self.filename) + '.tmp'
+
+        # a reader which sees the new generation and the old state only misses the cache
+        generation = os.urandom(8).hex()
+
+        with open(self.generation_filename, 'w') as file:
+            file.write(generation)
+
+        with open(temporary_filename, 'w') as file:
+            json.dump({'capacity': state.capacity, 'visitors': state.visitors}, file)
+
+        os.replace(temporary_filename, str(self.filename))
+
+        self.cached_state = state
+        self.cached_stamp = self.get_stamp()
+        self.cached_generation = generation
+
+    def delete_state(self):
+        os.remove(self.filename)
+
         try:
-            with open(self.filename) as file:
-                data = json.load(file)
-                return State(**data)
+            os.remove(self.generation_filename)
+        except FileNotFoundError:
+            pass
+
+        self.cached_state = None
+        self.cached_stamp = None
+        self.cached_generation = None
+
+    def read_generation(self):
+        try:
+            with open(self.generation_filename) as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def get_stamp(self):
+        try:
+            stat = os.stat(self.filename)
         except FileNotFoundError:
             return None
 
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_size)
+
+    def get_stats(self):
+        return {'cache_hits': self.cache_hits, 'cache_misses': self.cache_misses}
+
+class StateWriter:
+    """
+    StateWriter writes a park state which is kept in memory to a repository from a background thread.
+
+    Changes of the state have to be made while holding the lock of the writer. The writer holds the lock while
+    it writes the state, so that repositories which write only the changes of their own states can be used,
+    and states marked as changed while a write is in progress are written only once.
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.lock = Lock() # held while the state is changed or written
+        self.condition = Condition()
+        self.state = None # state waiting to be written
+        self.writing = False
+        self.write_count = 0
+
+    def run(self):
+        Thread(target=self.write_states, daemon=True).start()
+
     def write_state(self, state):
-        with open(self.filename, 'w') as file:
-            data = {'capacity': state.capacity, 'visitors': state.visitors}
-            json.dump(data, file)
+        with self.condition:
+            self.state = state
+            self.condition.notify_all()
 
-    def delete_state(self):
-        os.remove(self.filename)
+    def write_states(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.state is not None)
+                state = self.state
+                self.state = None
+                self.writing = True
+
+            try:
+                with self.lock:
+                    self.repository.write_state(state)
+
+                self.write_count += 1
+            except Exception:
+                log.exception('Cannot write state')
+
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        # wait until all changes were written
+        with self.condition:
+            return self.condition.wait_for(lambda: self.state is None and not self.writing, timeout)
+
+class SyncStateWriter:
+    """
+    SyncStateWriter has the interface of StateWriter, but writes the state at once in the calling thread, so that
+    no thread is started, e.g. in a simulation.
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.lock = Lock()
+        self.write_count = 0
+
+    def run(self):
+        pass
+
+    def write_state(self, state):
+        try:
+            self.repository.write_state(state)
+            self.write_count += 1
+        except Exception:
+            log.exception('Cannot write state')
+
+    def flush(self, timeout=None):
+        return True
@@ -1,5 +1,6 @@
+import json
 import pytest
-from amusementpark.visitor_repository import State, Repository
+from amusementpark.visitor_repository import State, Repository, SyncStateWriter
 
 def test_read_write_delete(tmpdir):
     filename = tmpdir.join('repository.json')
@@ -13,6 +14,47 @@ def test_read_write_delete(tmpdir):
     repository.delete_state()
     assert repository.read_state() is None
 
+def test_read_cache(tmpdir):
+    filename = tmpdir.join('repository.json')
+    repository = Repository(filename)
+    repository.write_state(State(capacity=10, visitors=[1]))
+
+    state = repository.read_state()
+    state.enter(2)
+    repository.write_state(state)
+
+    assert repository.read_state() is state
+    assert repository.get_stats() == {'cache_hits': 2, 'cache_misses': 0}
+
+    # the state was not written back, so it may have been changed
+    assert repository.read_state() == State(capacity=10, visitors=[1, 2])
+    assert repository.get_stats() == {'cache_hits': 2, 'cache_misses': 1}
+
+    repository.write_state(repository.read_state())
+    Repository(filename).write_state(State(capacity=10, visitors=[3, 4]))
+
+    assert repository.read_state() == State(capacity=10, visitors=[3, 4])
+    assert repository.get_stats() == {'cache_hits': 2, 'cache_misses': 3}
+
+def test_read_cache_with_same_stamp(tmpdir):
+    filename = tmpdir.join('repository.json')
+    repository = Repository(filename)
+    repository.write_state(State(capacity=10, visitors=[1]))
+
+    # another process replaces the file with one of the same size within the same modification time
+    Repository(filename).write_state(State(capacity=10, visitors=[2]))
+    repository.cached_stamp = repository.get_stamp()
+
+    assert repository.read_state() == State(capacity=10, visitors=[2])
+    assert repository.get_stats() == {'cache_hits': 0, 'cache_misses': 1}
+
+def test_file_format(tmpdir):
+    filename = tmpdir.join('repository.json')
+    Repository(filename).write_state(State(capacity=10, visitors=[1, 2]))
+
+    # the generation is kept out of the state file, which older versions read as the arguments of State
+    assert State(**json.loads(filename.read())) == State(capacity=10, visitors=[1, 2])
+
 def test_enter():
     state = State(capacity=2, visitors=[100])
 
@@ -32,4 +74,29 @@ def test_leave():
         state.leave(200)
     
     state.leave(100)
-    assert state.visitors == []
\ No newline at end of file
+    assert state.visitors == []
+
+def test_count_and_membership():
+    state = State(capacity=3, visitors=[100, 200])
+
+    assert state.count == 2
+    assert 100 in state
+    assert 300 not in state
+
+    state.leave(100)
+    state.enter(300)
+    state.enter(100)
+
+    assert state.count == 3
+    assert state.visitors == [200, 300, 100]
+
+def test_sync_state_writer(tmpdir):
+    repository = Repository(tmpdir.join('repository.json'))
+    writer = SyncStateWriter(repository)
+    state = State(capacity=10, visitors=[1])
+
+    writer.write_state(state)
+    state.enter(2)
+
+    assert Repository(repository.filename).read_state() == State(capacity=10, visitors=[1])
+    assert writer.flush() and writer.write_count == 1
@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import tempfile
+import time
+
+from amusementpark.broker import Broker
+from amusementpark.dispatch import Dispatcher, handles
+from amusementpark.gate_node import GateNode
+from amusementpark.messages import NetworkMessage, LocalMessage
+from amusementpark.network import Network
+from amusementpark.node_info import NodeInfo
+from amusementpark.simulator import create_topology, percentile
+from amusementpark.visitor_repository import State
+from benchmark_repository import create_repositories
+from helpers import create_node_infos, create_gate_nodes, wait_until
+
+ADMISSIONS = [GateNode.ADMISSION_MUTEX, GateNode.ADMISSION_SERVICE, GateNode.ADMISSION_ESCROW, GateNode.ADMISSION_TREE]
+TOPOLOGIES = ['line', 'ring', 'random']
+
+RESULTS_VERSION = 1 # changed when the format of the results changes
+
+class LoadNode(Dispatcher):
+    """
+    LoadNode is a visitor which enters and leaves the park through its gate whenever it gets a send_request
+    message, and records the time until the gate answers.
+
+    Every load node has its own network, because the gates answer visitors on the connection they opened.
+    """
+
+    def __init__(self, info, gate):
+        super().__init__()
+
+        self.info = info
+        self.gate = gate
+        self.inside = False
+        self.waiting = False # set when a request is sent, until the answer arrives
+        self.request_time = None
+
+        self.enter_latencies = []
+        self.leave_latencies = []
+        self.admitted_count = 0
+        self.refused_count = 0
+
+    @handles('send_request')
+    def send_request(self, message):
+        self.waiting = True
+        self.request_time = time.perf_counter()
+        yield NetworkMessage('leave_request' if self.inside else 'enter_request', self.info, self.gate)
+
+    @handles('enter_response')
+    def process_enter_response(self, message):
+        self.enter_latencies.append(time.perf_counter() - self.request_time)
+        self.inside = message.payload['allowed']
+
+        if self.inside:
+            self.admitted_count += 1
+        else:
+            self.refused_count += 1
+
+        self.waiting = False
+
+    @handles('leave_response')
+    def process_leave_response(self, message):
+        self.leave_latencies.append(time.perf_counter() - self.request_time)
+        self.inside = not message.payload['allowed']
+        self.waiting = False
+
+    def __str__(self):
+        return 'load/%d' % self.info.id
+
+def create_network_map(topology, gate_count, degree):
+    names = [str(i) for i in range(gate_count)]
+
+    if topology == 'random':
+        neighbours = create_topology(gate_count, degree)
+        return {names[i]: {names[j] for j in neighbours[i]} for i in neighbours}
+
+    network_map = {name: set() for name in names}
+
+    for i in range(gate_count - 1 if topology == 'line' else gate_count):
+        a, b = names[i], names[(i + 1) % gate_count]
+
+        if a != b:
+            network_map[a].add(b)
+            network_map[b].add(a)
+
+    return network_map
+
+def get_revision():
+    # commit of the benchmarked code, None outside of a git checkout
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def summarize(latencies):
+    return {
+        'requests': len(latencies),
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+    }
+
+def benchmark(args, dirname):
+    repository = create_repositories(dirname)[args.repository]
+    repository.write_state(State(capacity=args.capacity, visitors=[]))
+
+    network_map = create_network_map(args.topology, args.gates, args.degree)
+    gate_node_infos = create_node_infos(network_map.keys())
+    gate_nodes = create_gate_nodes(gate_node_infos, network_map, repository, args.admission,
+        heartbeat_interval=args.heartbeat_interval)
+
+    start = time.perf_counter()
+    _, broker, _ = random.choice(list(gate_nodes.values()))
+    broker.add_incoming_message(LocalMessage('start_election'))
+    wait_until(lambda: all(gate_node.leader is not None for gate_node, _, _ in gate_nodes.values()), timeout=30)
+    election_time = time.perf_counter() - start
+
+    leader = next(gate_node for gate_node, _, _ in gate_nodes.values()).leader
+    _, leader_broker, _ = next(nodes for nodes in gate_nodes.values() if nodes[0].info == leader)
+    leader_messages = leader_broker.get_stats()['incoming']['messages']
+
+    # every gate gets the same number of visitors, which enter and leave only through it
+    gates = list(gate_node_infos.values())
+    load_nodes = []
+
+    for i in range(args.visitors):
+        load_node = LoadNode(NodeInfo(1000000 + i, None, 1), gates[i % len(gates)])
+        load_broker = Broker(load_node)
+        load_broker.run(daemon=True)
+        Network(None, load_broker).run(daemon=True)
+        load_nodes.append((load_node, load_broker))
+
+    rng = random.Random(args.seed)
+    skipped_count = 0 # requests not sent because all visitors were waiting for an answer
+
+    start = time.perf_counter()
+    request_time = start
+
+    while request_time < start + args.duration:
+        request_time += 1 / args.rate
+        time.sleep(max(request_time - time.perf_counter(), 0))
+
+        idle_nodes = [(load_node, load_broker) for load_node, load_broker in load_nodes if not load_node.waiting]
+
+        if not idle_nodes:
+            skipped_count += 1
+            continue
+
+        load_node, load_broker = rng.choice(idle_nodes)
+        load_node.waiting = True
+        load_broker.add_incoming_message(LocalMessage('send_request'))
+
+    try:
+        wait_until(lambda: not any(load_node.waiting for load_node, _ in load_nodes), timeout=args.timeout)
+    except TimeoutError:
+        pass
+
+    duration = time.perf_counter() - start
+    leader_messages = leader_broker.get_stats()['incoming']['messages'] - leader_messages
+
+    load_nodes = [load_node for load_node, _ in load_nodes]
+    admitted_count = sum(load_node.admitted_count for load_node in load_nodes)
+    enter_latencies = [latency for load_node in load_nodes for latency in load_node.enter_latencies]
+    leave_latencies = [latency for load_node in load_nodes for latency in load_node.leave_latencies]
+
+    return {
+        'version': RESULTS_VERSION,
+        'revision': get_revision(),
+        'config': vars(args),
+        'election_time': election_time,
+        'duration': duration,
+        'admissions_per_second': admitted_count / duration,
+        'requests_per_second': (len(enter_latencies) + len(leave_latencies)) / duration,
+        'admitted': admitted_count,
+        'refused': sum(load_node.refused_count for load_node in load_nodes),
+        'skipped': skipped_count,
+        'unanswered': sum(load_node.waiting for load_node in load_nodes),
+        'enter_latency': summarize(enter_latencies),
+        'leave_latency': summarize(leave_latencies),
+        'gates': {
+            str(gate.id): summarize([
+                latency
+                for load_node in load_nodes if load_node.gate == gate
+                for latency in load_node.enter_latencies
+            ])
+            for gate in gates
+        },
+        'leader': {
+            'id': leader.id,
+            'messages': leader_messages,
+            'messages_per_second': leader_messages / duration,
+        },
+    }
+
+def print_results(results):
+    print('election: %.1f ms' % (results['election_time'] * 1000))
+    print('admissions: %.1f/s, requests: %.1f/s, refused %d, unanswered %d' % (
+        results['admissions_per_second'], results['requests_per_second'], results['refused'], results['unanswered']))
+    print('leader %d: %d messages, %.1f/s' % (
+        results['leader']['id'], results['leader']['messages'], results['leader']['messages_per_second']))
+    print()
+    print('%8s %10s %10s %10s %10s' % ('gate', 'requests', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+
+    for gate_id, latency in sorted(results['gates'].items()) + [('all', results['enter_latency'])]:
+        if latency['requests']:
+            print('%8s %10d %10.2f %10.2f %10.2f' % (
+                gate_id, latency['requests'], latency['p50'] * 1000, latency['p95'] * 1000, latency['p99'] * 1000))
+
+def main():
+    parser = argparse.ArgumentParser(description='Load the gates with visitors and measure the admission latency.')
+    parser.add_argument('--gates', type=int, default=5)
+    parser.add_argument('--topology', choices=TOPOLOGIES, default='ring')
+    parser.add_argument('--degree', type=int, default=3, help='average number of neighbours in a random topology')
+    parser.add_argument('--admission', choices=ADMISSIONS, default=GateNode.ADMISSION_SERVICE)
+    parser.add_argument('--repository', choices=['json', 'journal', 'sqlite', 'bitmap'], default='json')
+    parser.add_argument('--capacity', type=int, default=1000)
+    parser.add_argument('--visitors', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=200, help='requests sent every second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds the requests are sent for')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds to wait for the last answers')
+    parser.add_argument('--heartbeat-interval', type=float)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as dirname:
+        results = benchmark(args, dirname)
+
+    print_results(results)
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+
+    # the nodes do not stop, so the process exits without waiting for their threads
+    os._exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import os
+import tempfile
+import time
+
+from amusementpark.gate_node import GateNode
+from amusementpark.messages import LocalMessage
+from amusementpark.visitor_node import VisitorNode
+from amusementpark.visitor_repository import Repository, State
+from helpers import create_node_infos, create_gate_nodes, create_visitor_node, wait_until
+
+def create_line(gate_count):
+    names = [str(i) for i in range(gate_count)]
+
+    return {
+        name: {names[i + offset] for offset in (-1, 1) if 0 <= i + offset < gate_count}
+        for i, name in enumerate(names)
+    }
+
+def benchmark(admission, gate_count, request_count, dirname):
+    network_map = create_line(gate_count)
+
+    repository = Repository(os.path.join(dirname, '%s.json' % admission))
+    repository.write_state(State(capacity=100, visitors=[]))
+
+    gate_node_infos = create_node_infos(network_map.keys())
+    gate_nodes = create_gate_nodes(gate_node_infos, network_map, repository, admission)
+
+    _, broker, _ = gate_nodes['0']
+    broker.add_incoming_message(LocalMessage('start_election'))
+    wait_until(lambda: all(gate_node.leader is not None for gate_node, _, _ in gate_nodes.values()))
+
+    # a single visitor enters and leaves repeatedly, so every request waits for a full admission
+    _, visitor, broker, _ = create_visitor_node()
+    gate = gate_node_infos[str(gate_count - 1)]
+    enter_time = 0
+    leave_time = 0
+
+    for _ in range(request_count // 2):
+        start = time.perf_counter()
+        broker.add_incoming_message(LocalMessage('enter_park', gate=gate))
+        wait_until(lambda: visitor.state == VisitorNode.STATE_ENTERED, interval=0.0001)
+        enter_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        broker.add_incoming_message(LocalMessage('leave_park', gate=gate))
+        wait_until(lambda: visitor.state == VisitorNode.STATE_IDLE, interval=0.0001)
+        leave_time += time.perf_counter() - start
+
+    return enter_time / (request_count // 2), leave_time / (request_count // 2)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the admission latency of the admission modes.')
+    parser.add_argument('--gates', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=1000)
+    args = parser.parse_args()
+
+    print('%-10s %8s %10s %12s %12s' % ('admission', 'gates', 'requests', 'enter (ms)', 'leave (ms)'))
+
+    with tempfile.TemporaryDirectory() as dirname:
+        for admission in (GateNode.ADMISSION_MUTEX, GateNode.ADMISSION_SERVICE, GateNode.ADMISSION_ESCROW):
+            enter_time, leave_time = benchmark(admission, args.gates, args.requests, dirname)
+            print('%-10s %8d %10d %12.3f %12.3f' % (
+                admission, args.gates, args.requests, enter_time * 1e3, leave_time * 1e3))
+
+    # the nodes do not stop, so the process exits without waiting for their threads
+    os._exit(0)
+
+if __name__ == '__main__':
+    main()
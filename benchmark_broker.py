@@ -0,0 +1,93 @@
+import argparse
+import time
+
+from amusementpark.broker import Broker
+from amusementpark.messages import LocalMessage
+
+class EchoNode:
+    def __init__(self, message_count):
+        self.remaining = message_count
+
+    def process_message(self, message):
+        self.remaining -= 1
+        yield message
+
+        if self.remaining == 0:
+            yield None
+
+class FloodedNode:
+    """
+    FloodedNode spends some time on each message and records how long control messages waited.
+    """
+
+    def __init__(self, message_count, cost):
+        self.remaining = message_count
+        self.cost = cost
+        self.control_wait_times = []
+
+    def process_message(self, message):
+        if message.type != 'enter_request':
+            self.control_wait_times.append(time.perf_counter() - message.payload['sent'])
+
+        end = time.perf_counter() + self.cost
+
+        while time.perf_counter() < end:
+            pass
+
+        self.remaining -= 1
+
+        if self.remaining == 0:
+            yield None
+
+def benchmark(batch_size, message_count):
+    broker = Broker(EchoNode(message_count), batch_size=batch_size)
+    thread = broker.run()
+
+    start = time.perf_counter()
+
+    for _ in range(message_count):
+        broker.add_incoming_message(LocalMessage('echo'))
+
+    thread.join()
+    elapsed = time.perf_counter() - start
+
+    return elapsed, broker.get_stats()['incoming']
+
+def benchmark_flood(prioritized, message_count, control_interval, cost):
+    node = FloodedNode(message_count, cost)
+    broker = Broker(node, prioritized=prioritized)
+    thread = broker.run()
+
+    # visitor requests arrive faster than the node can process them, with a control message in between
+    for i in range(message_count):
+        message_type = 'mutex_granted' if i % control_interval == 0 else 'enter_request'
+        broker.add_incoming_message(LocalMessage(message_type, sent=time.perf_counter()))
+
+    thread.join()
+
+    wait_times = sorted(node.control_wait_times)
+    return wait_times[len(wait_times) // 2], wait_times[int(len(wait_times) * 0.99)], broker.get_stats()['incoming']
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare broker throughput with different batch sizes.')
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--flood-messages', type=int, default=20000)
+    args = parser.parse_args()
+
+    print('%-12s %12s %12s %16s' % ('batch size', 'messages/s', 'mean batch', 'mean wait (ms)'))
+
+    for batch_size in (1, 16, 256):
+        elapsed, stats = benchmark(batch_size, args.messages)
+        print('%-12d %12.0f %12.1f %16.3f' % (
+            batch_size, args.messages / elapsed, stats['mean_batch_size'], stats['mean_wait_time'] * 1e3))
+
+    print()
+    print('%-12s %18s %18s %20s' % ('prioritized', 'control p50 (ms)', 'control p99 (ms)', 'visitor mean (ms)'))
+
+    for prioritized in (False, True):
+        p50, p99, stats = benchmark_flood(prioritized, args.flood_messages, control_interval=500, cost=20e-6)
+        visitor_wait = stats['lanes']['visitor']['mean_wait_time'] if prioritized else stats['mean_wait_time']
+        print('%-12s %18.3f %18.3f %20.3f' % (prioritized, p50 * 1e3, p99 * 1e3, visitor_wait * 1e3))
+
+if __name__ == '__main__':
+    main()
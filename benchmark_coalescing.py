@@ -0,0 +1,53 @@
+import argparse
+import time
+
+from amusementpark.messages import NetworkMessage
+from amusementpark.network import Network, Peer
+from amusementpark.node_info import NodeInfo
+from benchmark_network import CountingBroker
+from helpers import get_free_port
+
+def benchmark(batch_size, burst_size, burst_count):
+    receiver_port = get_free_port()
+    broker = CountingBroker()
+    Network(receiver_port, broker).run(daemon=True)
+
+    gate = NodeInfo(100, ('localhost', get_free_port()), 4)
+    receiver = NodeInfo(2000, ('localhost', receiver_port), 1)
+    burst = [NetworkMessage('enter_response', gate, receiver, allowed=True) for _ in range(burst_size)]
+
+    Peer.MAX_BATCH_SIZE = batch_size
+    peer = Peer(Network(gate.address[1], CountingBroker()), receiver)
+    peer.run()
+
+    start = time.perf_counter()
+
+    for _ in range(burst_count):
+        broker.expect(burst_size)
+
+        # the whole burst is queued at once, like the responses produced by a single mutex grant
+        with peer.condition:
+            for message in burst:
+                peer.add_message(message)
+
+        broker.done.wait()
+
+    elapsed = time.perf_counter() - start
+
+    return peer.write_count, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure write coalescing on bursts of responses to one node.')
+    parser.add_argument('--burst-size', type=int, default=1000)
+    parser.add_argument('--bursts', type=int, default=20)
+    args = parser.parse_args()
+
+    messages = args.burst_size * args.bursts
+    print('%-12s %10s %10s %12s %12s' % ('batch size', 'messages', 'writes', 'time (s)', 'messages/s'))
+
+    for batch_size in (1, Peer.MAX_BATCH_SIZE):
+        write_count, elapsed = benchmark(batch_size, args.burst_size, args.bursts)
+        print('%-12d %10d %10d %12.3f %12.0f' % (batch_size, messages, write_count, elapsed, messages / elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import argparse
+import timeit
+
+from amusementpark.codec import BinaryCodec, PickleCodec
+from amusementpark.messages import NetworkMessage
+from amusementpark.node_info import NodeInfo
+
+gate = NodeInfo(456, ('localhost', 60507), 4)
+leader = NodeInfo(156, ('localhost', 60504), 9)
+visitor = NodeInfo(2000, ('localhost', 60600), 1)
+
+messages = {
+    'enter_request': NetworkMessage('enter_request', visitor, gate),
+    'enter_response': NetworkMessage('enter_response', gate, visitor, allowed=True),
+    'mutex_granted': NetworkMessage('mutex_granted', leader, gate),
+    'election_finished': NetworkMessage('election_finished', gate, leader, leader=leader, election=(1, gate.id)),
+}
+
+codecs = {
+    'pickle': PickleCodec,
+    'binary': lambda: BinaryCodec(node_table_size=0),
+    'binary+table': BinaryCodec,
+}
+
+def benchmark(codec_factory, message, number):
+    encoder = codec_factory()
+    decoder = codec_factory()
+
+    # warm up the node tables, like on a long-lived connection
+    data = encoder.encode(message)
+    decoder.decode(data)
+    data = encoder.encode(message)
+
+    encode_time = timeit.timeit(lambda: encoder.encode(message), number=number) / number
+    decode_time = timeit.timeit(lambda: decoder.decode(data), number=number) / number
+
+    return len(data), encode_time, decode_time
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the size and speed of message codecs.')
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    print('%-18s %-13s %8s %12s %12s' % ('message', 'codec', 'bytes', 'encode (us)', 'decode (us)'))
+
+    for message_name, message in messages.items():
+        for codec_name, codec_factory in codecs.items():
+            size, encode_time, decode_time = benchmark(codec_factory, message, args.number)
+            print('%-18s %-13s %8d %12.2f %12.2f' % (
+                message_name, codec_name, size, encode_time * 1e6, decode_time * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import argparse
+import time
+
+from amusementpark.gate_node import GateNode
+from amusementpark.messages import NetworkMessage
+from amusementpark.node_info import NodeInfo
+from amusementpark.visitor_repository import State
+
+class MemoryRepository:
+    def __init__(self, state):
+        self.state = state
+
+    def read_state(self):
+        return self.state
+
+    def write_state(self, state):
+        self.state = state
+
+class ChainGateNode(GateNode):
+    """
+    GateNode with the if/elif chain used before the dispatch table, as a reference.
+    """
+
+    def process_message(self, message):
+        if message.type == 'say_hello':
+            yield from self.say_hello(message)
+        elif message.type == 'start_election':
+            yield from self.start_election(message)
+        elif message.type == 'remove_leader':
+            yield from self.remove_leader(message)
+        elif message.type == 'terminate':
+            yield from self.terminate(message)
+        elif message.type == 'hello':
+            yield from self.process_hello(message)
+        elif message.type == 'election_started':
+            yield from self.process_election_started(message)
+        elif message.type == 'election_voted':
+            yield from self.process_election_voted(message)
+        elif message.type == 'election_finished':
+            yield from self.process_election_finished(message)
+        elif message.type == 'mutex_requested':
+            yield from self.process_mutex_requested(message)
+        elif message.type == 'mutex_released':
+            yield from self.process_mutex_released(message)
+        elif message.type == 'enter_request':
+            yield from self.process_enter_request(message)
+        elif message.type == 'leave_request':
+            yield from self.process_leave_request(message)
+        elif message.type == 'mutex_granted':
+            yield from self.process_mutex_granted(message)
+        elif message.type == 'leader_removed':
+            yield from self.process_leader_removed(message)
+        elif message.type == 'terminated':
+            self.process_terminated(message)
+
+def hello_scenario(node_class, scale):
+    # every neighbour says hello, like test_hello
+    gate = NodeInfo(100, 1, 4)
+    neighbours = [NodeInfo(1000 + i, 2, 2) for i in range(scale)]
+    node = node_class(gate, neighbours, None)
+
+    return node, [NetworkMessage('hello', neighbour, gate) for neighbour in neighbours]
+
+def mutex_scenario(node_class, scale):
+    # many gates request the mutex from the leader and release it, like test_request_mutex
+    leader = NodeInfo(100, 1, 4)
+    gates = [NodeInfo(1000 + i, 2, 2) for i in range(scale)]
+    node = node_class(leader, [], None)
+    node.leader = leader
+
+    return node, [NetworkMessage('mutex_requested', gate, leader) for gate in gates] + \
+        [NetworkMessage('mutex_released', gate, leader) for gate in gates]
+
+def admission_scenario(node_class, scale):
+    # visitors enter and leave through a gate one at a time, like test_enter_request and test_leave_request
+    gate = NodeInfo(100, 1, 4)
+    leader = NodeInfo(900, 9, 9)
+    visitors = [NodeInfo(2000 + i, 3, 1) for i in range(scale)]
+    node = node_class(gate, [], MemoryRepository(State(capacity=scale, visitors=[])))
+    node.leader = leader
+
+    messages = []
+
+    for visitor in visitors:
+        messages.append(NetworkMessage('enter_request', visitor, gate))
+        messages.append(NetworkMessage('mutex_granted', leader, gate))
+        messages.append(NetworkMessage('leave_request', visitor, gate))
+        messages.append(NetworkMessage('mutex_granted', leader, gate))
+
+    return node, messages
+
+def terminated_scenario(node_class, scale):
+    # neighbours leave the network, the last type in the old chain, like test_terminated
+    gate = NodeInfo(100, 1, 4)
+    neighbours = [NodeInfo(1000 + i, 2, 2) for i in range(scale)]
+    node = node_class(gate, list(neighbours), None)
+
+    # removing the first neighbour keeps the cost of the list removal low
+    return node, [NetworkMessage('terminated', neighbour, gate) for neighbour in neighbours]
+
+scenarios = {
+    'hello': hello_scenario,
+    'mutex': mutex_scenario,
+    'admission': admission_scenario,
+    'terminated': terminated_scenario,
+}
+
+def benchmark(scenario, node_class, scale, repeat):
+    times = []
+
+    for _ in range(repeat):
+        node, messages = scenario(node_class, scale)
+
+        start = time.perf_counter()
+
+        for message in messages:
+            for _ in node.process_message(message):
+                pass
+
+        times.append((time.perf_counter() - start) / len(messages))
+
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cost of processing a message in a gate node.')
+    parser.add_argument('--scale', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print('%-12s %10s %14s %14s' % ('scenario', 'messages', 'chain (us)', 'table (us)'))
+
+    for name, scenario in scenarios.items():
+        _, messages = scenario(GateNode, args.scale)
+        chain_time = benchmark(scenario, ChainGateNode, args.scale, args.repeat)
+        table_time = benchmark(scenario, GateNode, args.scale, args.repeat)
+
+        print('%-12s %10d %14.2f %14.2f' % (name, len(messages), chain_time * 1e6, table_time * 1e6))
+
+if __name__ == '__main__':
+    main()
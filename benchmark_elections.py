@@ -0,0 +1,56 @@
+import argparse
+import os
+import random
+import tempfile
+
+from amusementpark.gate_node import GateNode
+from amusementpark.messages import LocalMessage
+from amusementpark.visitor_repository import Repository
+from benchmark_tree import Router, create_topology, create_gates
+
+def benchmark(topology, initiator_count, repository):
+    gates = create_gates(topology, repository, GateNode.ADMISSION_MUTEX)
+    router = Router(gates)
+
+    # the initiators start their elections before any message is delivered
+    for gate in random.sample(gates, initiator_count):
+        router.process(gate, LocalMessage('start_election'))
+
+    router.run()
+
+    # all gates agree on a leader with the highest capacity
+    leader = gates[0].leader
+    assert leader.capacity == max(gate.info.capacity for gate in gates)
+    assert all(gate.state == GateNode.STATE_IDLE and gate.leader == leader for gate in gates)
+
+    return {
+        'rounds': router.rounds,
+        'messages': sum(router.sent.values()),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure elections started by several gates at once.')
+    parser.add_argument('--gates', type=int, default=100)
+    parser.add_argument('--degree', type=int, default=4)
+    parser.add_argument('--initiators', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    topology = create_topology(args.gates, args.degree)
+
+    print('%10s %10s %10s' % ('initiators', 'rounds', 'messages'))
+
+    with tempfile.TemporaryDirectory() as dirname:
+        repository = Repository(os.path.join(dirname, 'elections.json'))
+
+        for initiator_count in args.initiators:
+            results = [benchmark(topology, initiator_count, repository) for _ in range(args.repeat)]
+            print('%10d %10.1f %10.1f' % (
+                initiator_count,
+                sum(result['rounds'] for result in results) / args.repeat,
+                sum(result['messages'] for result in results) / args.repeat))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from amusementpark.gate_node import GateNode
+from amusementpark.messages import NetworkMessage, LocalMessage
+from amusementpark.node_info import NodeInfo
+from amusementpark.visitor_repository import Repository, State
+from benchmark_tree import Router, create_topology, create_gates
+
+def benchmark(topology, failover, removal_count, dirname):
+    repository = Repository(os.path.join(dirname, 'failover.json'))
+    repository.write_state(State(capacity=removal_count, visitors=[]))
+
+    random.seed(len(topology)) # both runs use the same capacities
+    gates = create_gates(topology, repository, GateNode.ADMISSION_SERVICE, failover)
+    router = Router(gates)
+    router.deliver(gates[0], LocalMessage('start_election'))
+
+    rounds = 0
+    messages = 0
+    elapsed = 0
+
+    for i in range(removal_count):
+        leader = next(gate for gate in gates if gate.leader == gate.info)
+        router.reset()
+        start = time.perf_counter()
+
+        router.deliver(leader, LocalMessage('remove_leader'))
+
+        if any(gate.leader is None for gate in gates): # no candidate took over
+            router.deliver(gates[0], LocalMessage('start_election'))
+
+        elapsed += time.perf_counter() - start
+        rounds += router.rounds
+        messages += sum(router.sent.values())
+
+        # without failover the election may choose the same leader again, the messages are the same
+        assert all(gate.leader == gates[0].leader for gate in gates)
+
+        # the new leader admits visitors
+        router.send(NetworkMessage('enter_request', NodeInfo(100000 + i, None, 1), gates[-1].info))
+        router.run()
+        assert router.sent['enter_response'] == 1
+
+    for gate in gates: # the state is written before the directory is removed
+        gate.release_park_state()
+
+    return {
+        'rounds': rounds / removal_count,
+        'messages': messages / removal_count,
+        'time': elapsed / removal_count,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare leader failover with a new election after the leader is removed.')
+    parser.add_argument('--gates', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--degree', type=int, default=4)
+    parser.add_argument('--removals', type=int, default=GateNode.FAILOVER_CANDIDATES - 1)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    print('%-10s %8s %10s %10s %10s' % ('mode', 'gates', 'rounds', 'messages', 'time (ms)'))
+
+    with tempfile.TemporaryDirectory() as dirname:
+        for gate_count in args.gates:
+            topology = create_topology(gate_count, args.degree)
+
+            for mode, failover in (('election', False), ('failover', True)):
+                result = benchmark(topology, failover, args.removals, dirname)
+                print('%-10s %8d %10.1f %10.1f %10.3f' % (
+                    mode, gate_count, result['rounds'], result['messages'], result['time'] * 1000))
+
+if __name__ == '__main__':
+    main()
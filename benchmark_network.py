@@ -0,0 +1,106 @@
+import argparse
+import socket
+import threading
+import time
+
+from amusementpark.async_network import AsyncNetwork
+from amusementpark.codec import CODEC_BINARY, encode_preamble
+from amusementpark.messages import NetworkMessage
+from amusementpark.message_queue import MessageQueue
+from amusementpark.network import Network, serialize_message, send_data
+from amusementpark.node_info import NodeInfo
+from helpers import get_free_port, wait_until
+
+class CountingBroker:
+    """
+    CountingBroker only counts the received messages, so the benchmark measures the network alone.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.target = None
+        self.done = threading.Event()
+        self.outgoing_messages = MessageQueue()
+
+    def expect(self, target):
+        with self.lock:
+            self.count = 0
+            self.target = target
+            self.done.clear()
+
+    def add_incoming_message(self, message):
+        with self.lock:
+            self.count += 1
+
+            if self.count == self.target:
+                self.done.set()
+
+    def get_outgoing_messages(self, block=True):
+        return self.outgoing_messages.get_batch(block=block)
+
+    def finish_outgoing_message(self, count=1):
+        self.outgoing_messages.task_done(count)
+
+def benchmark(network_class, connection_count, message_count):
+    port = get_free_port()
+    broker = CountingBroker()
+
+    network_class(port, broker).run(daemon=True)
+    threads_before = threading.active_count()
+
+    sender = NodeInfo(2000, ('localhost', 0), 1)
+    recipient = NodeInfo(100, ('localhost', port), 1)
+    data = serialize_message(NetworkMessage('enter_request', sender, recipient))
+
+    # every client sends one message, so that we know all connections were accepted
+    start = time.perf_counter()
+    broker.expect(connection_count)
+    clients = [socket.create_connection(('localhost', port)) for _ in range(connection_count)]
+
+    for client in clients:
+        send_data(client, encode_preamble(CODEC_BINARY))
+        send_data(client, data)
+
+    broker.done.wait()
+    connect_time = time.perf_counter() - start
+    threads = threading.active_count() - threads_before
+
+    start = time.perf_counter()
+    broker.expect(message_count)
+
+    for i in range(message_count):
+        send_data(clients[i % connection_count], data)
+
+    broker.done.wait()
+    receive_time = time.perf_counter() - start
+
+    for client in clients:
+        client.close()
+
+    # wait for the connections to be closed, so that the next benchmark starts from a clean state
+    wait_until(lambda: threading.active_count() <= threads_before)
+
+    return {
+        'threads': threads,
+        'connect_time': connect_time,
+        'messages_per_second': message_count / receive_time,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the threaded and the asyncio network implementation.')
+    parser.add_argument('--connections', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=50000)
+    args = parser.parse_args()
+
+    # threads are the threads started by the network for the connections
+    print('%-14s %12s %8s %14s %12s' % ('network', 'connections', 'threads', 'connect (s)', 'messages/s'))
+
+    for network_class in (Network, AsyncNetwork):
+        result = benchmark(network_class, args.connections, args.messages)
+        print('%-14s %12d %8d %14.3f %12.0f' % (
+            network_class.__name__, args.connections, result['threads'],
+            result['connect_time'], result['messages_per_second']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import argparse
+import tempfile
+import time
+import os
+
+from amusementpark.bitmap_repository import BitmapRepository
+from amusementpark.journal_repository import JournalRepository
+from amusementpark.sqlite_repository import SQLiteRepository
+from amusementpark.visitor_repository import Repository, State
+
+def create_repositories(dirname):
+    return {
+        'json': Repository(os.path.join(dirname, 'repository.json')),
+        'journal': JournalRepository(os.path.join(dirname, 'journal')),
+        'sqlite': SQLiteRepository(os.path.join(dirname, 'repository.db')),
+        'bitmap': BitmapRepository(os.path.join(dirname, 'repository.bitmap')),
+    }
+
+def benchmark(repository, size, batch_size, batch_count):
+    # the park is filled with size visitors, then every batch lets batch_size visitors leave and enter again,
+    # like a gate which was granted the mutex
+    repository.write_state(State(capacity=size + batch_size, visitors=range(size)))
+    visitor = 0
+
+    start = time.perf_counter()
+
+    for _ in range(batch_count):
+        state = repository.read_state()
+
+        for _ in range(batch_size):
+            state.leave(visitor)
+            state.enter(visitor)
+            visitor = (visitor + 1) % size
+
+        repository.write_state(state)
+
+    return (time.perf_counter() - start) / batch_count
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the time of one mutex grant for the repositories.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--batches', type=int, default=100)
+    args = parser.parse_args()
+
+    print('%-10s %10s %12s' % ('repository', 'visitors', 'grant (ms)'))
+
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as dirname:
+            for name, repository in create_repositories(dirname).items():
+                result = benchmark(repository, size, args.batch_size, args.batches)
+                print('%-10s %10d %12.3f' % (name, size, result * 1e3))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import argparse
+import time
+
+from amusementpark.visitor_repository import State
+
+class ListState:
+    """
+    ListState is the previous list based state, kept here as a reference for the benchmark.
+    """
+
+    def __init__(self, capacity, visitors):
+        self.capacity = capacity
+        self.visitors = list(visitors)
+
+    def enter(self, visitor):
+        assert visitor not in self.visitors
+        assert len(self.visitors) < self.capacity
+        self.visitors.append(visitor)
+
+    def leave(self, visitor):
+        assert visitor in self.visitors
+        self.visitors.remove(visitor)
+
+def benchmark(state_class, size, operations):
+    # the park is filled with size visitors, then visitors from the start of the park leave and enter again
+    state = state_class(capacity=size + 1, visitors=range(size))
+
+    start = time.perf_counter()
+
+    for i in range(operations):
+        visitor = i % size
+        state.leave(visitor)
+        state.enter(visitor)
+
+    return (time.perf_counter() - start) / (2 * operations)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the list based and the indexed park state.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--operations', type=int, default=200)
+    args = parser.parse_args()
+
+    print('%-10s %10s %16s' % ('state', 'visitors', 'operation (us)'))
+
+    for size in args.sizes:
+        for state_class in (ListState, State):
+            result = benchmark(state_class, size, args.operations)
+            print('%-10s %10d %16.2f' % (state_class.__name__, size, result * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import argparse
+import random
+import tempfile
+import os
+from collections import Counter, deque
+
+from amusementpark.gate_node import GateNode
+from amusementpark.messages import NetworkMessage, LocalMessage
+from amusementpark.node_info import NodeInfo
+from amusementpark.simulator import create_topology
+from amusementpark.visitor_repository import Repository, State
+
+class Router:
+    """
+    Router delivers messages between nodes in the same process in the order they were sent, so that the
+    messages of a protocol can be counted without a network.
+
+    The router also counts rounds, the longest chain of messages each caused by the previous one, which is the
+    time the protocol takes when every message takes the same time to be delivered.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = {node.info.id: node for node in nodes}
+        self.messages = deque()
+        self.round = 0 # round of the message being processed
+        self.rounds = 0
+        self.sent = Counter() # number of messages of each type
+        self.received = Counter() # number of messages of each type received by each node
+
+    def send(self, message):
+        self.messages.append((self.round + 1, message))
+
+    def deliver(self, node, message):
+        self.round = 0
+        self.process(node, message)
+        self.run()
+
+    def run(self):
+        while self.messages:
+            self.round, message = self.messages.popleft()
+            self.rounds = max(self.rounds, self.round)
+            self.sent[message.type] += 1
+            self.received[message.recipient.id, message.type] += 1
+
+            node = self.nodes.get(message.recipient.id)
+
+            if node is not None: # messages to visitors are only counted
+                self.process(node, message)
+
+        self.round = 0
+
+    def process(self, node, message):
+        for outgoing_message in node.process_message(message):
+            if outgoing_message is not None:
+                self.send(outgoing_message)
+
+    def reset(self):
+        self.rounds = 0
+        self.sent.clear()
+        self.received.clear()
+
+def create_gates(topology, repository, admission, failover=False):
+    infos = [NodeInfo(100 + i, None, random.randint(1, 1000)) for i in topology]
+
+    return [
+        GateNode(infos[i], [infos[neighbour] for neighbour in sorted(topology[i])], repository, admission,
+            failover=failover)
+        for i in topology
+    ]
+
+def benchmark(topology, admission, request_count, dirname):
+    repository = Repository(os.path.join(dirname, '%s.json' % admission))
+    repository.write_state(State(capacity=len(topology) * request_count, visitors=[]))
+
+    gates = create_gates(topology, repository, admission)
+    router = Router(gates)
+    router.deliver(gates[0], LocalMessage('start_election'))
+
+    leader = next(gate for gate in gates if gate.leader == gate.info)
+    router.reset()
+
+    # every gate gets requests from new visitors, which are all waiting before the first one is processed
+    visitor_id = 100000
+
+    for gate in gates:
+        for _ in range(request_count):
+            router.send(NetworkMessage('enter_request', NodeInfo(visitor_id, None, 1), gate.info))
+            visitor_id += 1
+
+    router.run()
+
+    assert router.sent['enter_response'] == len(gates) * request_count
+
+    return {
+        'leader_batches': router.received[leader.info.id, 'admission_requested'],
+        'messages': router.sent['admission_requested'] + router.sent['admission_answered'],
+    }
+
+def benchmark_broadcast(topology, dirname, flood):
+    repository = Repository(os.path.join(dirname, 'broadcast.json'))
+    repository.write_state(State(capacity=1, visitors=[]))
+
+    gates = create_gates(topology, repository, GateNode.ADMISSION_MUTEX)
+    router = Router(gates)
+    router.deliver(gates[0], LocalMessage('start_election'))
+
+    leader = next(gate for gate in gates if gate.leader == gate.info)
+
+    if flood: # without the tree, the announcement is sent over every edge
+        for gate in gates:
+            gate.tree_children = None
+
+    router.reset()
+    router.deliver(leader, LocalMessage('remove_leader'))
+
+    assert all(gate.leader is None for gate in gates)
+
+    return router.sent['leader_removed']
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the messages sent by the protocols on random topologies.')
+    parser.add_argument('--gates', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--degree', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    print('%-10s %8s %16s %16s' % ('admission', 'gates', 'leader batches', 'batch messages'))
+
+    with tempfile.TemporaryDirectory() as dirname:
+        for gate_count in args.gates:
+            topology = create_topology(gate_count, args.degree)
+
+            for admission in (GateNode.ADMISSION_SERVICE, GateNode.ADMISSION_TREE):
+                result = benchmark(topology, admission, args.requests, dirname)
+                print('%-10s %8d %16d %16d' % (admission, gate_count, result['leader_batches'], result['messages']))
+
+    print()
+    print('%8s %8s %16s %16s' % ('gates', 'edges', 'tree broadcast', 'flooding'))
+
+    with tempfile.TemporaryDirectory() as dirname:
+        for gate_count in args.gates:
+            topology = create_topology(gate_count, args.degree)
+            edge_count = sum(len(neighbours) for neighbours in topology.values()) // 2
+
+            tree = benchmark_broadcast(topology, dirname, flood=False)
+            flood = benchmark_broadcast(topology, dirname, flood=True)
+            print('%8d %8d %16d %16d' % (gate_count, edge_count, tree, flood))
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,11 @@
 import random
 import itertools
 import socket
+import time
 from amusementpark.gate_node import GateNode
 from amusementpark.visitor_node import VisitorNode
 from amusementpark.broker import Broker
+from amusementpark.heartbeat import Heartbeat, TimingWheel
 from amusementpark.network import Network
 from amusementpark.node_info import NodeInfo
 
@@ -14,23 +16,42 @@ def get_free_port():
     server.close()
     return port
 
+def wait_until(condition, timeout=5, interval=0.01):
+    # poll the condition until it is true or the timeout expires
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError('Condition not met within %s seconds' % timeout)
+
+        time.sleep(interval)
+
 def create_node_infos(node_names):
     return {
         name: NodeInfo(id=node_id, address=('localhost', get_free_port()), capacity=random.randint(1, 10))
         for name, node_id in zip(node_names, random.sample(range(100, 1000), k=len(node_names)))
     }
 
-def create_gate_nodes(node_infos, node_neighbours, repository):
+def create_gate_nodes(node_infos, node_neighbours, repository, admission=GateNode.ADMISSION_MUTEX,
+        heartbeat_interval=None):
     nodes = {}
 
+    # the heartbeats of all gates share a single timer thread
+    if heartbeat_interval is not None:
+        wheel = TimingWheel()
+        wheel.run()
+
     for name, info in node_infos.items():
         neighbours = [node_infos[neighbour] for neighbour in node_neighbours[name]]
         _, port = info.address
 
-        gate_node = GateNode(info, neighbours, repository)
-        broker = Broker(gate_node)
+        gate_node = GateNode(info, neighbours, repository, admission)
+        broker = Broker(gate_node, prioritized=True, tick_interval=1)
         network = Network(port, broker)
 
+        if heartbeat_interval is not None:
+            Heartbeat(broker, info, gate_node.neighbours, wheel, heartbeat_interval).run()
+
         broker.run()
         network.run()
 
@@ -40,11 +61,17 @@ def create_gate_nodes(node_infos, node_neighbours, repository):
 
 visitor_node_id = 2000
 
-def create_visitor_node():
+def create_visitor_node(client_only=True):
     global visitor_node_id
 
-    port = get_free_port()
-    node_info = NodeInfo(visitor_node_id, ('localhost', port), 1)
+    # client-only visitors have no server, gates answer them on the connection they opened
+    if client_only:
+        port = None
+        node_info = NodeInfo(visitor_node_id, None, 1)
+    else:
+        port = get_free_port()
+        node_info = NodeInfo(visitor_node_id, ('localhost', port), 1)
+
     visitor_node = VisitorNode(node_info)
     broker = Broker(visitor_node)
     network = Network(port, broker)
@@ -0,0 +1,72 @@
+import argparse
+import random
+import time
+
+from amusementpark.gate_node import GateNode
+from amusementpark.messages import LocalMessage
+from amusementpark.simulator import Simulator, Link, MemoryRepository, create_topology, create_visitor_workload, \
+    percentile
+from amusementpark.visitor_repository import State
+
+ADMISSIONS = [GateNode.ADMISSION_MUTEX, GateNode.ADMISSION_SERVICE, GateNode.ADMISSION_ESCROW, GateNode.ADMISSION_TREE]
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate the gates of a park in a single process.')
+    parser.add_argument('--gates', type=int, default=1000)
+    parser.add_argument('--degree', type=int, default=4)
+    parser.add_argument('--visitors', type=int, default=100000)
+    parser.add_argument('--admission', choices=ADMISSIONS, default=GateNode.ADMISSION_SERVICE)
+    parser.add_argument('--capacity', type=int, default=10000)
+    parser.add_argument('--rate', type=float, default=10000, help='visitors arriving every second')
+    parser.add_argument('--stay', type=float, default=1, help='average seconds a visitor stays in the park')
+    parser.add_argument('--latency', type=float, default=0.001)
+    parser.add_argument('--jitter', type=float, default=0.0005)
+    parser.add_argument('--loss', type=float, default=0, help='probability that a message is lost after the election')
+    parser.add_argument('--processing-time', type=float, default=0)
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for the last answers')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # the gates send lost requests again on ticks
+    simulator = Simulator(args.seed, Link(args.latency, args.jitter), args.processing_time, tick_interval=0.1)
+    repository = MemoryRepository(State(capacity=args.capacity, visitors=[]))
+    gates = simulator.create_gates(create_topology(args.gates, args.degree, rng), repository, args.admission)
+
+    start = time.perf_counter()
+    simulator.schedule(rng.choice(gates).info, LocalMessage('start_election'))
+    simulator.run()
+
+    leaders = {gate.leader for gate in gates}
+    print('election: %.1f ms, %d messages, %d leaders' % (
+        simulator.now * 1000, sum(simulator.sent.values()), len(leaders - {None})))
+
+    if None in leaders or len(leaders) > 1:
+        print('the election did not finish')
+        return
+
+    election_messages = sum(simulator.sent.values())
+    simulator.default_link.loss = args.loss # elections are not repeated, so messages are only lost afterwards
+    simulator.add_workload(create_visitor_workload(gates, args.visitors, args.rate, args.stay, simulator.now, rng))
+    simulator.run()
+
+    # requests which were sent again after a loss may still be waiting, the requests of visitors are not repeated
+    deadline = simulator.now + args.timeout
+
+    while simulator.request_times and simulator.now < deadline:
+        simulator.run(until=simulator.now + 1)
+
+    for request_type in ('enter_request', 'leave_request'):
+        latencies = simulator.get_latencies(request_type)
+        print('%s: %d answered, latency p50 %.2f ms, p95 %.2f ms, p99 %.2f ms' % (
+            request_type, len(latencies),
+            *(percentile(latencies, p) * 1000 if latencies else 0 for p in (50, 95, 99))))
+
+    leader = simulator.nodes[leaders.pop().id]
+    print('messages: %d, dropped %d, received by the leader %d' % (
+        sum(simulator.sent.values()) - election_messages, sum(simulator.dropped.values()),
+        simulator.received[leader.info.id]))
+    print('simulated %.2f s in %.2f s' % (simulator.now, time.perf_counter() - start))
+
+if __name__ == '__main__':
+    main()